@@ -0,0 +1,28 @@
+#!/usr/bin/env python3
+
+# Pre-compute the node heightmaps of a grid directory made by generate.py, so that the mod reads them instead of computing them at map generation.
+# Mod settings must be the same as in the game, otherwise the mod ignores the heightmaps (glaciers are not supported).
+# Usage: ./bake_heightmaps.py [river_data] [--blocksize 12] [--center] [--sea_level 1] [--min_catchment 25] [--max_catchment 40000] [--riverbed_slope 0.4] [--tile_size 80] [--workers 1]
+
+import sys
+
+from terrainlib import bake_heightmaps
+
+dirname = 'river_data'
+settings = {}
+args = sys.argv[1:]
+while args:
+    arg = args.pop(0)
+    if arg[:2] != '--':
+        dirname = arg
+    elif arg == '--center':
+        settings['center'] = True
+    else:
+        settings[arg[2:]] = float(args.pop(0))
+
+tile_size = int(settings.pop('tile_size', 80))
+workers = int(settings.pop('workers', 1))
+if 'sea_level' in settings:
+    settings['sea_level'] = int(settings['sea_level'])
+
+bake_heightmaps(dirname, tile_size=tile_size, workers=workers, **settings)
@@ -0,0 +1,336 @@
+#!/usr/bin/env python3
+
+# Benchmark of terrainlib's main functions, on seeded synthetic grids of several sizes and terrain styles.
+# Every run is appended to a history file; results can be compared with a saved baseline.
+# Usage examples:
+#   ./benchmark.py --sizes 256 1000 --save-baseline baseline.json
+#   ./benchmark.py --sizes 256 1000 --baseline baseline.json --threshold 0.2
+#   ./benchmark.py --sizes 1000 4000 --confs terrain_default.conf --precision
+
+import numpy as np
+import argparse
+import concurrent.futures
+import datetime
+import json
+import multiprocessing as mp
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import terrainlib
+from terrainlib import rivermapper, erosion, bounds
+from terrainlib.outofcore import peak_rss, reset_peak_rss
+
+benchmarks = ('noisemap', 'flow', 'flow_local', 'accumulate_flow', 'planar_boruvka', 'advection', 'twist', 'end_to_end')
+# Slower code paths that the ones above replace, run only if selected (and once, whatever --repeat), to measure speedups
+reference_benchmarks = ('noisemap_snoise2', 'flow_local_loop')
+speedups = {'noisemap': 'noisemap_snoise2', 'flow_local': 'flow_local_loop'} # Benchmark: its reference
+default_confs = ('terrain_default.conf', 'terrain_higher.conf', 'terrain_original.conf')
+
+def conf_settings(conf, size):
+    # Read a terrain style, with horizontal lengths scaled to the grid size
+    params = terrainlib.read_config_file(conf)
+    ratio = size / int(params.get('mapsize', 1000))
+    def get(name, default):
+        return float(params.get(name, default))
+    return {
+        'noise': {
+            'scale': get('scale', 400.0) * ratio,
+            'vscale': get('vscale', 300.0),
+            'offset': get('offset', 0.0),
+            'octaves': int(np.ceil(np.log2(size)))+1,
+            'persistence': get('persistence', 0.6),
+            'lacunarity': get('lacunarity', 2.0),
+        },
+        'K': get('K', 0.5),
+        'm': get('m', 0.5),
+        'd': get('d', 0.5),
+        'flex_radius': get('flex_radius', 20.0) * ratio,
+        'sea_level': get('sea_level', 0.0),
+        'dt': get('time', 10.0) / int(params.get('niter', 10)),
+        'flow_method': params.get('flow_method', 'semirandom'),
+    }
+
+def flow_local_loop(dem, method, rng):
+    """
+    Local flow routing node by node, as done by rivermapper.flow before it was vectorized (see flow_local). Kept as reference for benchmarks.
+    """
+    dirs1 = np.zeros(dem.shape, dtype=int)
+    dirs2 = np.zeros(dem.shape, dtype=int)
+    (X, Y) = dem.shape
+    Xmax, Ymax = X-1, Y-1
+    singular = []
+    for x in range(X):
+        z0 = z1 = z2 = dem[x,0]
+        for y in range(Y):
+            z0 = z1
+            z1 = z2
+            if y < Ymax:
+                z2 = dem[x, y+1]
+
+            plist = [
+                max(z1-dem[x+1,y],0) if x<Xmax else 0, # 1: x -> x+1
+                max(z1-z2,0),                          # 2: y -> y+1
+                max(z1-dem[x-1,y],0) if x>0    else 0, # 3: x -> x-1
+                max(z1-z0,0),                          # 4: y -> y-1
+            ]
+
+            pdir = 0
+            if method == 'steepest':
+                vmax = 0.0
+                for i, p in enumerate(plist):
+                    if p > vmax:
+                        vmax = p
+                        pdir = i+1
+            else:
+                r = rng.random() * sum(plist)
+                for i, p in enumerate(plist):
+                    if r < p:
+                        pdir = i+1
+                        break
+                    r -= p
+
+            dirs2[x,y] = pdir
+            if pdir == 0:
+                singular.append((x,y))
+            elif pdir == 1:
+                dirs1[x+1,y] += 1
+            elif pdir == 2:
+                dirs1[x,y+1] += 2
+            elif pdir == 3:
+                dirs1[x-1,y] += 4
+            elif pdir == 4:
+                dirs1[x,y-1] += 8
+    return dirs2, dirs1, singular
+
+def measure(func, repeat, setup=None):
+    # Minimal time over 'repeat' runs. 'setup' is run (untimed) before every run and returns the arguments of 'func'.
+    best = float('inf')
+    for i in range(repeat):
+        args = setup() if setup else ()
+        t0 = time.perf_counter()
+        func(*args)
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+def run_case(size, conf, seed, repeat, workers, niter, selected, compact=False):
+    s = conf_settings(conf, size)
+    rng = np.random.default_rng(seed)
+    xbase, ybase = rng.integers(-4096, 4096, size=2)
+    dem = terrainlib.noisemap(size+1, size+1, xbase=xbase, ybase=ybase, workers=workers, **s['noise'])
+    if compact:
+        dem = dem.astype(np.float32)
+
+    def reseed():
+        # Random generator used by semirandom flow routing, reset for every run
+        return (np.random.default_rng(seed),)
+
+    dirs, lakes, rivers, tree = rivermapper.flow(dem, method=s['flow_method'], return_tree=True, workers=workers, rng=np.random.default_rng(seed), compact=compact)
+    results = {}
+
+    if 'noisemap' in selected:
+        results['noisemap'] = measure(lambda: terrainlib.noisemap(size+1, size+1, xbase=xbase, ybase=ybase, workers=workers, **s['noise']), repeat)
+
+    if 'noisemap_snoise2' in selected:
+        # Call of the 'noise' module for every cell
+        results['noisemap_snoise2'] = measure(lambda: terrainlib.noisemap(size+1, size+1, xbase=xbase, ybase=ybase, method='snoise2', workers=workers, **s['noise']), 1)
+
+    if 'flow' in selected:
+        results['flow'] = measure(lambda rng: rivermapper.flow(dem, method=s['flow_method'], workers=workers, rng=rng, compact=compact), repeat, setup=reseed)
+
+    if 'flow_local' in selected:
+        results['flow_local'] = measure(lambda rng: rivermapper.flow_local(dem, method=s['flow_method'], workers=workers, rng=rng), repeat, setup=reseed)
+
+    if 'flow_local_loop' in selected:
+        results['flow_local_loop'] = measure(lambda rng: flow_local_loop(dem, s['flow_method'], rng), 1, setup=reseed)
+
+    if 'accumulate_flow' in selected:
+        results['accumulate_flow'] = measure(lambda: rivermapper.accumulate_flow(dirs, dtype=rivers.dtype), repeat)
+
+    if 'planar_boruvka' in selected:
+        dirs2, dirs1, singular = rivermapper.flow_local(dem, method=s['flow_method'], rng=np.random.default_rng(seed))
+        basin_id, links = rivermapper.boruvka_links(dem, dirs1, singular)
+        results['planar_boruvka'] = measure(rivermapper.planar_boruvka, repeat, setup=lambda: (dict(links),))
+
+    if 'advection' in selected:
+        surface = np.maximum(dem, lakes)
+        results['advection'] = measure(lambda: erosion.advection_vectorized(surface, dirs, rivers, s['dt'], K=s['K'], m=s['m'], sea_level=s['sea_level'], tree=tree, workers=workers), repeat)
+
+    if 'twist' in selected:
+        def twist():
+            masks = bounds.direction_masks(dirs)
+            bx, by = bounds.make_bounds(dirs, rivers, masks)
+            bounds.twist(bx, by, bounds.get_fixed(dirs, masks))
+        results['twist'] = measure(twist, repeat)
+
+    if 'end_to_end' in selected:
+        def end_to_end(rng):
+            model = erosion.EvolutionModel(dem, K=s['K'], m=s['m'], d=s['d'], sea_level=s['sea_level'], flex_radius=s['flex_radius'], flow_method=s['flow_method'], workers=workers, rng=rng, compact=compact)
+            for i in range(niter):
+                model.diffusion(s['dt'])
+                model.calculate_flow()
+                model.advection(s['dt'])
+                model.adjust_isostasy()
+            model.calculate_flow()
+            masks = bounds.direction_masks(model.dirs)
+            bx, by = bounds.make_bounds(model.dirs, model.rivers, masks)
+            bounds.twist(bx, by, bounds.get_fixed(model.dirs, masks))
+        results['end_to_end'] = measure(end_to_end, repeat, setup=reseed)
+
+    return results
+
+def simulate(size, conf, seed, niter, workers, compact):
+    # End-to-end simulation. Returns its duration, the peak memory of the process and the final grids.
+    s = conf_settings(conf, size)
+    rng = np.random.default_rng(seed)
+    xbase, ybase = rng.integers(-4096, 4096, size=2)
+    dem = terrainlib.noisemap(size+1, size+1, xbase=xbase, ybase=ybase, workers=workers, **s['noise'])
+    reset_peak_rss()
+    t0 = time.perf_counter()
+    model = erosion.EvolutionModel(dem, K=s['K'], m=s['m'], d=s['d'], sea_level=s['sea_level'], flex_radius=s['flex_radius'], flow_method=s['flow_method'], workers=workers, rng=rng, compact=compact)
+    del dem
+    for i in range(niter):
+        model.diffusion(s['dt'])
+        model.calculate_flow()
+        model.advection(s['dt'])
+        model.adjust_isostasy()
+    model.calculate_flow()
+    masks = bounds.direction_masks(model.dirs)
+    bx, by = bounds.make_bounds(model.dirs, model.rivers, masks)
+    offset_x, offset_y = bounds.twist(bx, by, bounds.get_fixed(model.dirs, masks))
+    duration = time.perf_counter() - t0
+    return duration, peak_rss(), model.dem, model.lakes, model.dirs, model.rivers, offset_x, offset_y
+
+def run_isolated(func, *args):
+    # Run 'func' in a new interpreter, so that its peak memory is measured independently
+    with concurrent.futures.ProcessPoolExecutor(1, mp_context=mp.get_context('spawn')) as executor:
+        return executor.submit(func, *args).result()
+
+def precision_check(size, conf, seed, niter, workers):
+    """
+    Run the same simulation in default (64-bit) and compact mode, and compare duration, peak memory and results.
+    """
+    t64, mem64, dem64, lakes64, dirs64, rivers64, ox64, oy64 = run_isolated(simulate, size, conf, seed, niter, workers, False)
+    t32, mem32, dem32, lakes32, dirs32, rivers32, ox32, oy32 = run_isolated(simulate, size, conf, seed, niter, workers, True)
+    ddem = np.abs(dem32 - dem64)
+    dlakes = np.abs(lakes32 - lakes64)
+    big = rivers64 >= 1000
+    # Offsets are saved in 8 bits
+    same_offsets = (np.floor(ox32*256) == np.floor(ox64*256)) & (np.floor(oy32*256) == np.floor(oy64*256))
+    return {
+        'time_default': t64,
+        'time_compact': t32,
+        'peak_rss_default': mem64,
+        'peak_rss_compact': mem32,
+        'elevation_range': float(dem64.max() - dem64.min()),
+        'dem_max_error': float(ddem.max()),
+        'dem_rms_error': float(np.sqrt(np.mean(ddem**2))),
+        'lakes_rms_error': float(np.sqrt(np.mean(dlakes**2))),
+        'same_dirs': float(np.mean(dirs32 == dirs64)),
+        'same_rivers': float(np.mean(rivers32 == rivers64)),
+        'same_big_rivers': float(np.mean(rivers32[big] == rivers64[big])) if big.any() else 1.0,
+        'offset_max_error': float(max(np.abs(ox32 - ox64).max(), np.abs(oy32 - oy64).max())),
+        'same_offsets': float(np.mean(same_offsets)),
+    }
+
+def print_precision(key, r):
+    print('  {:<20} {:>10} {:>10}'.format('', 'default', 'compact'))
+    print('  {:<20} {:>9.2f}s {:>9.2f}s'.format('time', r['time_default'], r['time_compact']))
+    print('  {:<20} {:>8.0f}MB {:>8.0f}MB'.format('peak memory', r['peak_rss_default']/2**20, r['peak_rss_compact']/2**20))
+    print('  Elevation error:    max {:.2e}, RMS {:.2e} (elevation range {:.0f})'.format(r['dem_max_error'], r['dem_rms_error'], r['elevation_range']))
+    print('  Lake level error:   RMS {:.2e}'.format(r['lakes_rms_error']))
+    print('  Identical:          directions {:.4%}, discharge {:.4%}, discharge of rivers >= 1000 cells {:.4%}'.format(r['same_dirs'], r['same_rivers'], r['same_big_rivers']))
+    print('  Offsets:            max error {:.2e}, identical in 8 bits {:.4%}'.format(r['offset_max_error'], r['same_offsets']))
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results, baseline, threshold):
+    """
+    Print the ratio between results and baseline for every common benchmark. Returns the list of benchmarks slower than baseline by more than 'threshold'.
+    """
+    print()
+    print('{:<48} {:>10} {:>10} {:>7}'.format('Benchmark', 'Base (s)', 'New (s)', 'Ratio'))
+    failed = []
+    for key, t in results.items():
+        if key not in baseline:
+            continue
+        ratio = t / baseline[key]
+        flag = ''
+        if ratio > 1 + threshold:
+            failed.append(key)
+            flag = '  SLOWER'
+        print('{:<48} {:>10.4f} {:>10.4f} {:>7.2f}{}'.format(key, baseline[key], t, ratio, flag))
+    return failed
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark terrainlib functions on synthetic grids.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[256, 1000, 2000], help='Grid sizes (mapsize)')
+    parser.add_argument('--confs', nargs='+', default=list(default_confs), help='Terrain configuration files')
+    parser.add_argument('--benchmarks', nargs='+', default=list(benchmarks), choices=benchmarks+reference_benchmarks, help='Benchmarks to run (reference benchmarks of slower code paths only if given: {})'.format(', '.join(reference_benchmarks)))
+    parser.add_argument('--seed', type=int, default=42, help='Random seed of synthetic grids')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of runs of every benchmark, the fastest is kept')
+    parser.add_argument('--niter', type=int, default=2, help='Number of iterations of the end-to-end benchmark')
+    parser.add_argument('--workers', type=int, default=1, help='Number of processes')
+    parser.add_argument('--history', default='benchmark_history.jsonl', help='File to which results are appended (one JSON object per line)')
+    parser.add_argument('--save-baseline', help='Save results in this file, to be used as baseline')
+    parser.add_argument('--baseline', help='Compare results with this baseline file')
+    parser.add_argument('--threshold', type=float, default=0.2, help='Relative slowdown above which the comparison fails')
+    parser.add_argument('--compact', action='store_true', help='Run benchmarks in compact mode (32-bit elevations and indices, 8-bit directions)')
+    parser.add_argument('--precision', action='store_true', help='Instead of benchmarks, compare an end-to-end simulation in default and compact modes: time, peak memory and differences of results')
+    args = parser.parse_args()
+    if args.precision and args.baseline:
+        parser.error('--precision results cannot be compared with a baseline')
+
+    confdir = os.path.dirname(os.path.abspath(__file__))
+    results = {}
+    for size in args.sizes:
+        for conf in args.confs:
+            fconf = conf if os.path.isfile(conf) else os.path.join(confdir, conf)
+            style = os.path.splitext(os.path.basename(conf))[0]
+            if args.compact:
+                style += '-compact'
+            print('Size {:d}, {}'.format(size, style))
+            if args.precision:
+                key = '{:d}/{}'.format(size, style)
+                results[key] = precision_check(size, fconf, args.seed, args.niter, args.workers)
+                print_precision(key, results[key])
+                continue
+            case = run_case(size, fconf, args.seed, args.repeat, args.workers, args.niter, args.benchmarks, compact=args.compact)
+            for name, t in case.items():
+                key = '{:d}/{}/{}'.format(size, style, name)
+                results[key] = t
+                print('  {:<20} {:10.4f} s'.format(name, t))
+            for name, reference in speedups.items():
+                if name in case and reference in case:
+                    print('  {:<20} {:10.1f} x faster than {}'.format(name, case[reference] / case[name], reference))
+
+    record = {
+        'date': datetime.datetime.now().isoformat(timespec='seconds'),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'args': {k: v for k, v in vars(args).items() if k not in ('history', 'save_baseline', 'baseline')},
+        'results': results,
+    }
+    if args.history:
+        with open(args.history, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(record, f, indent=1)
+
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)['results']
+        failed = compare(results, baseline, args.threshold)
+        if failed:
+            print()
+            print('{:d} benchmark(s) slower than baseline by more than {:.0%}'.format(len(failed), args.threshold))
+            sys.exit(1)
@@ -0,0 +1,17 @@
+#!/usr/bin/env python3
+
+# Convert a grid directory made by generate.py from flat format to tiled format, in place.
+# Usage: ./convert_grid.py [river_data] [tile_size]
+
+import sys
+
+from terrainlib import convert_grid_dir
+
+dirname = 'river_data'
+tile_size = 64
+if len(sys.argv) > 1:
+    dirname = sys.argv[1]
+if len(sys.argv) > 2:
+    tile_size = int(sys.argv[2])
+
+convert_grid_dir(dirname, tile_size=tile_size)
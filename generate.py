@@ -1,71 +1,35 @@
 #!/usr/bin/env python3
 
 import numpy as np
-from noise import snoise2
 import os
 import sys
 
 import terrainlib
 
-def noisemap(X, Y, scale=0.01, vscale=1.0, offset=0.0, log=False, **params):
-    # Determine noise offset randomly
-    xbase = np.random.randint(8192)-4096
-    ybase = np.random.randint(8192)-4096
-
-    if log:
-        vscale /= offset
-
-    # Generate the noise
-    n = np.zeros((X, Y))
-    for x in range(X):
-        for y in range(Y):
-            n[x,y] = snoise2(x/scale + xbase, y/scale + ybase, **params)
-
-    if log:
-        return np.exp(n*vscale) * offset
-    else:
-        return n*vscale + offset
-
 ### PARSE COMMAND-LINE ARGUMENTS
-argc = len(sys.argv)
-
-config_file = 'terrain_default.conf'
-output_dir = 'river_data'
-params_from_args = {}
-i = 1 # Index of arguments
-j = 1 # Number of 'orphan' arguments (the ones that are not preceded by '--something')
-while i < argc:
-    arg = sys.argv[i]
-    if arg[:2] == '--':
-        pname = arg[2:]
-        v = None
-        split = pname.split('=', maxsplit=1)
-        if len(split) == 2:
-            pname, v = split
-            i += 1
-        elif i+1 < argc:
-            v = sys.argv[i+1]
-            i += 2
-
-        if v is not None:
-            if pname == 'config':
-                config_file = v
-            elif pname == 'output':
-                output_dir = v
-            else:
-                params_from_args[pname] = v
-    else:
-        if j == 1:
-            config_file = arg
-        elif j == 2:
-            output_dir = arg
-        i += 1
-        j += 1
+params_from_args = terrainlib.parse_command_line(sys.argv)
+config_file = params_from_args.pop('config', 'terrain_default.conf')
+output_dir = params_from_args.pop('output', None)
+resume_dir = params_from_args.pop('resume', None)
+
+if resume_dir is not None:
+    # Resume from a checkpoint: use the same parameters as the interrupted run
+    print('Resuming from', resume_dir)
+    checkpoint_arrays, start_iter, checkpoint_state = terrainlib.load_checkpoint(resume_dir)
+    params = checkpoint_state['params']
+    if output_dir is None:
+        output_dir = checkpoint_state['output_dir']
+else:
+    params = terrainlib.read_config_file(config_file)
+    checkpoint_arrays = None
+    start_iter = 0
+    if output_dir is None:
+        output_dir = 'river_data'
 
 print(config_file, output_dir)
 
-params = terrainlib.read_config_file(config_file)
 params.update(params_from_args) # Params given from args prevail against conf file
+config_params = params.copy()
 
 ### READ SETTINGS
 def get_setting(name, default):
@@ -73,107 +37,181 @@ def get_setting(name, default):
         return params[name]
     return default
 
-mapsize = int(get_setting('mapsize', 1000))
-scale = float(get_setting('scale', 400.0))
-vscale = float(get_setting('vscale', 300.0))
-offset = float(get_setting('offset', 0.0))
-persistence = float(get_setting('persistence', 0.6))
-lacunarity = float(get_setting('lacunarity', 2.0))
-
-K = float(get_setting('K', 0.5))
-m = float(get_setting('m', 0.5))
-d = float(get_setting('d', 0.5))
-sea_level = float(get_setting('sea_level', 0.0))
-sea_level_variations = float(get_setting('sea_level_variations', 0.0))
-sea_level_variations_time = float(get_setting('sea_level_variations_time', 1.0))
-flex_radius = float(get_setting('flex_radius', 20.0))
-flow_method = get_setting('flow_method', 'semirandom')
-
-time = float(get_setting('time', 10.0))
-niter = int(get_setting('niter', 10))
+s = terrainlib.read_settings(params) # Settings of the generation process
+
+seed = get_setting('seed', None)
+if seed is None:
+    # Draw a seed, so that the run can be reproduced
+    seed = np.random.SeedSequence().entropy
+seed = int(seed)
+config_params['seed'] = str(seed)
+print('Seed:', seed)
+if resume_dir is not None and 'rng' in checkpoint_state:
+    rng = checkpoint_state['rng']
+else:
+    rng = np.random.default_rng(seed)
+
+scratch_dir = get_setting('scratch', None)
+memory_budget = get_setting('memory_budget', None)
+if memory_budget is not None:
+    memory_budget = float(memory_budget) * 2**20 # Given in MB
+
+checkpoint_dir = get_setting('checkpoint', resume_dir)
+checkpoint_interval = int(get_setting('checkpoint_interval', 1))
+
+cache_dir = get_setting('cache', None)
+cache_size = float(get_setting('cache_size', 4000)) * 2**20 # Given in MB
+
+preview_mode = get_setting('preview', 'window')
+if 'no-preview' in params:
+    preview_mode = 'none'
+preview_every = int(get_setting('preview_every', 1))
+preview_dir = os.path.abspath(get_setting('preview_dir', 'preview'))
+preview_size = int(get_setting('preview_size', 1000))
+
+profile = get_setting('profile', None)
+if profile is not None:
+    # Path prefix of profiling results, 'profile' if given as a flag
+    profile = os.path.abspath(profile or 'profile')
+    terrainlib.profiler.enable()
+
+def report_memory(stage):
+    # In out-of-core mode, print peak memory usage of every stage
+    if scratch_dir is not None:
+        print('  {}: peak RSS {:.0f} MB'.format(stage, terrainlib.peak_rss() / 2**20))
+        terrainlib.reset_peak_rss()
+
+# Start preview renderer before allocating big grids, as it runs in a forked process
+preview = terrainlib.Preview(preview_mode, directory=preview_dir, every=preview_every, max_size=preview_size)
+
+### CACHE OF INTERMEDIATE PRODUCTS
+cache = None
+cache_stage = None
+if cache_dir is not None:
+    cache = terrainlib.Cache(cache_dir, max_size=cache_size)
+    # Every stage is keyed by the parameters it depends on, and by the key of the previous stage
+    noise_key = cache.key('noise', seed, *(s[k] for k in ('mapsize', 'scale', 'vscale', 'offset', 'persistence', 'lacunarity', 'noise_method', 'sea_level', 'sea_level_variations', 'time', 'niter')))
+    model_key = cache.key('model', noise_key, *(s[k] for k in ('K', 'm', 'd', 'flex_radius', 'sea_level_variations_time', 'flow_method', 'basin_method', 'advection_method', 'compact')), scratch_dir is not None)
+    iteration_keys = [cache.key('iteration', model_key, i) for i in range(s['niter']+1)] # State after i iterations
+    flow_key = cache.key('flow', model_key)
+    twist_key = cache.key('twist', flow_key, s['twist_steps'], s['twist_tol'])
+
+    if checkpoint_arrays is None:
+        # Skip to the most advanced cached stage: last flow calculation, or latest iteration
+        cache_stage = 'flow'
+        entry = cache.get(flow_key, 'flow')
+        if entry is None:
+            cache_stage = 'iteration'
+            for i in range(s['niter'], 0, -1):
+                entry = cache.get(iteration_keys[i], 'iteration')
+                if entry is not None:
+                    break
+        if entry is not None:
+            checkpoint_arrays, checkpoint_state = entry
+            start_iter = checkpoint_state['iteration']
+            rng.bit_generator.state = checkpoint_state['rng']
+            print('Restored from cache: iteration {:d}{}'.format(start_iter, ', last flow calculation' if cache_stage == 'flow' else ''))
+        else:
+            cache_stage = None
+
+def cache_model(stage, iteration):
+    # Store model grids and the state needed to continue from them
+    if cache is not None:
+        key = flow_key if stage == 'flow' else iteration_keys[iteration]
+        arrays = {field: getattr(model, field) for field in ('dem', 'lakes', 'dirs', 'rivers', 'ref_isostasy')}
+        cache.put(key, stage, arrays, iteration=iteration, sea_level=float(model.sea_level), sea_ybase=sea_ybase, sea_level_ref=sea_level_ref, rng=rng.bit_generator.state)
 
 ### MAKE INITIAL TOPOGRAPHY
-n = np.zeros((mapsize+1, mapsize+1))
-
-# Set noise parameters
-params = {
-    "offset" : offset,
-    "vscale" : vscale,
-    "scale" : scale,
-    "octaves" : int(np.ceil(np.log2(mapsize)))+1,
-    "persistence" : persistence,
-    "lacunarity" : lacunarity,
-}
-
-params_sealevel = {
-    "octaves" : 1,
-    "persistence" : 1,
-    "lacunarity" : 2,
-}
-
-if sea_level_variations != 0.0:
-    sea_ybase = np.random.randint(8192)-4096
-    sea_level_ref = snoise2(time * (1-1/niter) / sea_level_variations, sea_ybase, **params_sealevel) * sea_level_variations
-    params['offset'] -= (sea_level_ref + sea_level)
-
-n = noisemap(mapsize+1, mapsize+1, **params)
+if checkpoint_arrays is not None:
+    sea_ybase = checkpoint_state['sea_ybase']
+    sea_level_ref = checkpoint_state['sea_level_ref']
+    n = checkpoint_arrays['dem']
+else:
+    sea_ybase, xbase, ybase = terrainlib.random_bases(rng) # Always drawn, so that the following random numbers do not depend on sea level settings
+    sea_level_ref = terrainlib.sea_level_reference(s, sea_ybase)
+
+    entry = cache.get(noise_key, 'noise') if cache is not None else None
+    if entry is not None:
+        n = entry[0]['noise']
+        rng.bit_generator.state = entry[1]['rng']
+    else:
+        with terrainlib.profile_stage('noise'):
+            n = terrainlib.initial_noise(s, xbase, ybase, workers=s['workers'])
+            n += terrainlib.initial_offset(s, sea_level_ref)
+        if cache is not None:
+            cache.put(noise_key, 'noise', {'noise': n}, rng=rng.bit_generator.state)
+    report_memory('Noise')
 
 ### COMPUTE LANDSCAPE EVOLUTION
 # Initialize landscape evolution model
 print('Initializing model')
-model = terrainlib.EvolutionModel(n, K=K, m=m, d=d, sea_level=sea_level, flex_radius=flex_radius, flow_method=flow_method)
-terrainlib.update(model.dem, model.lakes, t=5, sea_level=model.sea_level, title='Initializing...')
-
-dt = time/niter
-
-# Run the model's processes: the order in which the processes are run is arbitrary and could be changed.
-
-for i in range(niter):
-    disp_niter = 'Iteration {:d} of {:d}...'.format(i+1, niter)
-    if sea_level_variations != 0:
-        model.sea_level = snoise2((i*dt)/sea_level_variations_time, sea_ybase, **params_sealevel) * sea_level_variations - sea_level_ref
-    terrainlib.update(model.dem, model.lakes, sea_level=model.sea_level, title=disp_niter)
-    print(disp_niter)
-    print('Diffusion')
-    model.diffusion(dt)
-    print('Flow calculation')
+if checkpoint_arrays is not None:
+    model = terrainlib.make_model(n, s, sea_level=checkpoint_state['sea_level'], ref_isostasy=checkpoint_arrays['ref_isostasy'], scratch=scratch_dir, memory_budget=memory_budget, rng=rng)
+    model.lakes = checkpoint_arrays['lakes']
+    model.dirs = checkpoint_arrays['dirs']
+    model.rivers = checkpoint_arrays['rivers']
+else:
+    model = terrainlib.make_model(n, s, scratch=scratch_dir, memory_budget=memory_budget, rng=rng)
+del n
+report_memory('Initialization')
+preview.update(model.dem, model.lakes, iteration=start_iter, t=5, sea_level=model.sea_level, title='Initializing...')
+
+for i, process in terrainlib.evolve(model, s, sea_ybase, sea_level_ref, start=start_iter):
+    if process == 'diffusion':
+        disp_niter = 'Iteration {:d} of {:d}...'.format(i+1, s['niter'])
+        preview.update(model.dem, model.lakes, sea_level=model.sea_level, title=disp_niter)
+        print(disp_niter)
+        print('Diffusion')
+    elif process == 'flow':
+        report_memory('Diffusion')
+        print('Flow calculation')
+    elif process == 'advection':
+        report_memory('Flow calculation')
+        preview.update(model.dem, model.lakes, iteration=i+1, sea_level=model.sea_level, title=disp_niter)
+        print('Advection')
+    elif process == 'isostasy':
+        report_memory('Advection')
+        print('Isostatic equilibration')
+    else: # End of iteration, i iterations are done
+        report_memory('Isostatic equilibration')
+        cache_model('iteration', i)
+
+        if checkpoint_dir is not None and i % checkpoint_interval == 0:
+            print('Saving checkpoint')
+            terrainlib.save_checkpoint(checkpoint_dir, model, i, params=config_params, output_dir=output_dir, sea_ybase=sea_ybase, sea_level_ref=sea_level_ref)
+
+if cache_stage != 'flow':
+    print('Last flow calculation')
     model.calculate_flow()
-    terrainlib.update(model.dem, model.lakes, sea_level=model.sea_level, title=disp_niter)
-    print('Advection')
-    model.advection(dt)
-    print('Isostatic equilibration')
-    model.adjust_isostasy()
-
-print('Last flow calculation')
-model.calculate_flow()
+    report_memory('Flow calculation')
+    cache_model('flow', s['niter'])
 
 print('Done!')
 
 # Twist the grid
-bx, by = terrainlib.make_bounds(model.dirs, model.rivers)
-offset_x, offset_y = terrainlib.twist(bx, by, terrainlib.get_fixed(model.dirs))
-
-# Convert offset in 8-bits
-offset_x = np.clip(np.floor(offset_x * 256), -128, 127)
-offset_y = np.clip(np.floor(offset_y * 256), -128, 127)
+entry = cache.get(twist_key, 'twist') if cache is not None else None
+if entry is not None:
+    offset_x, offset_y = entry[0]['offset_x'], entry[0]['offset_y']
+else:
+    with terrainlib.profile_stage('twist'):
+        offset_x, offset_y, history = terrainlib.twist_model(model, s)
+    print('Twist residuals:', ' '.join('{:.3f}'.format(r) for r in history))
+    if cache is not None:
+        cache.put(twist_key, 'twist', {'offset_x': offset_x, 'offset_y': offset_y})
 
 ### SAVE OUTPUT
-if not os.path.isdir(output_dir):
-    os.mkdir(output_dir)
-os.chdir(output_dir)
-# Save the files
-terrainlib.save(model.dem, 'dem', dtype='>i2')
-terrainlib.save(model.lakes, 'lakes', dtype='>i2')
-terrainlib.save(offset_x, 'offset_x', dtype='i1')
-terrainlib.save(offset_y, 'offset_y', dtype='i1')
-
-terrainlib.save(model.dirs, 'dirs', dtype='u1')
-terrainlib.save(model.rivers, 'rivers', dtype='>u4')
-
-with open('size', 'w') as sfile:
-    sfile.write('{:d}\n{:d}'.format(mapsize+1, mapsize+1))
+terrainlib.save_model(output_dir, model, offset_x, offset_y, s)
 
 terrainlib.stats(model.dem, model.lakes)
 print()
+
+if profile is not None:
+    terrainlib.profiler.write(profile, params=config_params, mapsize=s['mapsize'], niter=s['niter'], workers=s['workers'])
+    terrainlib.profiler.print_summary()
+    print('Profile saved in {0}.json and {0}.csv'.format(profile))
+    print()
+if cache is not None:
+    cache.print_summary()
+    print()
 print('Grid is ready for use!')
-terrainlib.plot(model.dem, model.lakes, title='Final grid, ready for use!')
+preview.close(model.dem, model.lakes, title='Final grid, ready for use!')
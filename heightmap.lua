@@ -9,6 +9,58 @@ local riverbed_slope = mapgen_rivers.riverbed_slope
 
 local MAP_BOTTOM = -31000
 
+local load_map = dofile(modpath .. 'load.lua')
+local world_data_path = minetest.get_worldpath() .. '/river_data/'
+
+-- Pre-baked heightmaps, written by the generator (see terrainlib/heightmap.py).
+-- They are read instead of computing polygons if they were made with the same settings, and for the chunks they cover.
+local function load_baked()
+	local file = io.open(world_data_path .. 'heightmaps', 'r')
+	if not file then
+		return
+	end
+	local index = {}
+	for line in file:lines() do
+		local key, value = line:match('^%s*(%S+)%s*=%s*(%S+)%s*$')
+		if key then
+			index[key] = value
+		end
+	end
+	file:close()
+
+	local function same(key, value)
+		local v = tonumber(index[key])
+		return v ~= nil and math.abs(v-value) <= 1e-6 * math.max(math.abs(value), 1)
+	end
+	if tonumber(index.version) ~= 1 or mapgen_rivers.glaciers or (index.center == 'true') ~= mapgen_rivers.center
+			or not (same('blocksize', blocksize) and same('sea_level', sea_level) and same('riverbed_slope', riverbed_slope/blocksize)
+			and same('min_catchment', mapgen_rivers.min_catchment) and same('max_catchment', mapgen_rivers.max_catchment)) then
+		minetest.log('action', '[mapgen_rivers] Pre-baked heightmaps were made with other settings, they will not be used')
+		return
+	end
+
+	local xsize, zsize = tonumber(index.xsize), tonumber(index.zsize)
+	for _, filename in ipairs({'terrain_map', 'lake_map'}) do
+		local f = io.open(world_data_path .. filename, 'rb')
+		if not f then
+			return
+		end
+		f:close()
+	end
+	local xmin, zmin = tonumber(index.xmin), tonumber(index.zmin)
+	return {
+		xmin = xmin,
+		zmin = zmin,
+		xmax = xmin + xsize - 1,
+		zmax = zmin + zsize - 1,
+		xsize = xsize,
+		terrain = load_map('terrain_map', 2, true, xsize*zsize),
+		lake = load_map('lake_map', 2, true, xsize*zsize),
+	}
+end
+
+local baked = load_baked()
+
 -- Linear interpolation
 local function interp(v00, v01, v11, v10, xf, zf)
 	local v0 = v01*xf + v00*(1-xf)
@@ -16,14 +68,36 @@ local function interp(v00, v01, v11, v10, xf, zf)
 	return v1*zf + v0*(1-zf)
 end
 
-local function heightmaps(minp, maxp)
+local function baked_heightmaps(minp, maxp, terrain_height_map, lake_height_map)
+	local terrain, lake = baked.terrain, baked.lake
+	local xsize = baked.xsize
+
+	local i = 1
+	for z=minp.z, maxp.z do
+		local ib = (z-baked.zmin)*xsize + (minp.x-baked.xmin) + 1
+		for x=minp.x, maxp.x do
+			terrain_height_map[i] = terrain[ib]
+			lake_height_map[i] = lake[ib]
+			i = i + 1
+			ib = ib + 1
+		end
+	end
+
+	return terrain_height_map, lake_height_map
+end
+
+-- Give the terrain and lake heightmaps of the rectangle minp-maxp (2D).
+-- They are written in the tables 'terrain_height_map' and 'lake_height_map' if given, so that tables can be reused.
+local function heightmaps(minp, maxp, terrain_height_map, lake_height_map)
+	terrain_height_map = terrain_height_map or {}
+	lake_height_map = lake_height_map or {}
+	if baked and minp.x >= baked.xmin and maxp.x <= baked.xmax and minp.z >= baked.zmin and maxp.z <= baked.zmax then
+		return baked_heightmaps(minp, maxp, terrain_height_map, lake_height_map)
+	end
 
 	local polygons = make_polygons(minp, maxp)
 	local incr = maxp.z-minp.z+1
 
-	local terrain_height_map = {}
-	local lake_height_map = {}
-
 	local i = 1
 	for z=minp.z, maxp.z do
 		for x=minp.x, maxp.x do
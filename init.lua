@@ -2,6 +2,18 @@ mapgen_rivers = {}
 
 local modpath = minetest.get_modpath(minetest.get_current_modname()) .. '/'
 
+-- LuaJIT's FFI library, used by load.lua to read grid files faster. When mod security is enabled, 'require' is only available to trusted mods (secure.trusted_mods),
+-- and request_insecure_environment only works from the main scope of init.lua: it must be called here, before the other files are loaded.
+do
+	local env = minetest.request_insecure_environment and minetest.request_insecure_environment() or _G
+	if env.require then
+		local ok, lib = pcall(env.require, 'ffi')
+		if ok then
+			mapgen_rivers.ffi = lib
+		end
+	end
+end
+
 dofile(modpath .. 'settings.lua')
 
 local blocksize = mapgen_rivers.blocksize
@@ -19,6 +31,49 @@ end
 dofile(modpath .. 'noises.lua')
 
 local heightmaps = dofile(modpath .. 'heightmap.lua')
+local new_lru = dofile(modpath .. 'lru.lua')
+
+-- 2D heightmaps only depend on the X/Z rectangle: they are kept in a LRU cache, so that all chunks of a column (or chunks with the same rectangle, with distortion) compute them once.
+-- Tables of evicted heightmaps are reused for the next ones.
+local heightmap_cache_size = mapgen_rivers.heightmap_cache_size
+local spare_maps
+local heightmap_cache = new_lru(heightmap_cache_size, function(key, maps)
+	spare_maps = maps
+end)
+
+-- Numbers of heightmaps computed and reused, and time spent computing them (microseconds)
+local heightmap_stats = {computed = 0, reused = 0, time = 0}
+mapgen_rivers.heightmap_stats = heightmap_stats
+
+local function get_heightmaps(minp, maxp)
+	local key = minp.x .. ' ' .. minp.z .. ' ' .. maxp.x .. ' ' .. maxp.z
+	local maps = heightmap_cache.get(key)
+	if maps then
+		heightmap_stats.reused = heightmap_stats.reused + 1
+		return maps[1], maps[2]
+	end
+
+	local t0 = minetest.get_us_time()
+	maps = spare_maps or {{}, {}}
+	spare_maps = nil
+	heightmaps(minp, maxp, maps[1], maps[2])
+	heightmap_stats.computed = heightmap_stats.computed + 1
+	heightmap_stats.time = heightmap_stats.time + minetest.get_us_time() - t0
+
+	if heightmap_cache_size > 0 then
+		heightmap_cache.set(key, maps)
+	else
+		spare_maps = maps -- Not cached: reuse the tables for the next chunk
+	end
+	return maps[1], maps[2]
+end
+
+minetest.register_on_shutdown(function()
+	if heightmap_stats.computed > 0 then
+		minetest.log('action', ('[mapgen_rivers] Heightmaps: %d computed (%.2f ms on average), %d computations avoided by the cache'):format(
+			heightmap_stats.computed, heightmap_stats.time/heightmap_stats.computed/1000, heightmap_stats.reused))
+	end
+end)
 
 -- Linear interpolation
 local function interp(v00, v01, v11, v10, xf, zf)
@@ -103,9 +158,9 @@ local function generate(minp, maxp, seed)
 		local pmaxp = {x=math.floor(xmax)+1, z=math.floor(zmax)+1}
 		incr = pmaxp.x-pminp.x+1
 		i_origin = 1 - pminp.z*incr - pminp.x
-		terrain_map, lake_map = heightmaps(pminp, pmaxp)
+		terrain_map, lake_map = get_heightmaps(pminp, pmaxp)
 	else
-		terrain_map, lake_map = heightmaps(minp, maxp)
+		terrain_map, lake_map = get_heightmaps(minp, maxp)
 	end
 
 	local c_stone = minetest.get_content_id("default:stone")
@@ -1,12 +1,62 @@
+local modpath = minetest.get_modpath(minetest.get_current_modname()) .. '/'
 local worldpath = minetest.get_worldpath() .. "/river_data/"
 
-local function load_map(filename, bytes, signed, size)
-	local file = io.open(worldpath .. filename, 'rb')
-	local data = file:read('*all')
-	if #data < bytes*size then
-		data = minetest.decompress(data)
+local new_lru = dofile(modpath .. 'lru.lua')
+
+local tile_cache_size = mapgen_rivers.tile_cache_size
+
+-- LuaJIT's FFI reads the bytes of a string directly. It is loaded by init.lua, if available (see there).
+local ffi = mapgen_rivers.ffi
+local sunpack = string.unpack -- Lua 5.3+
+
+local function decode_ffi(data, bytes, signed, size)
+	local map = {}
+	if bytes == 1 then
+		local p = ffi.cast(signed and 'const int8_t*' or 'const uint8_t*', data)
+		for i=1, size do
+			map[i] = p[i-1]
+		end
+		return map
+	end
+
+	local p = ffi.cast('const uint8_t*', data)
+	local half = 2^(8*bytes-1)
+	local j = 0
+	for i=1, size do
+		local n = p[j]
+		for k=j+1, j+bytes-1 do
+			n = n*256 + p[k]
+		end
+		if signed and n >= half then
+			n = n - 2*half
+		end
+		map[i] = n
+		j = j + bytes
+	end
+	return map
+end
+
+local unpack_block = 256 -- Number of values per call to string.unpack
+local function decode_unpack(data, bytes, signed, size)
+	local map = {}
+	local fmt = (signed and 'i' or 'I') .. bytes
+	local block_fmt = '>' .. fmt:rep(unpack_block)
+	local pos = 1
+	local i = 0
+	while i + unpack_block <= size do
+		local values = {sunpack(block_fmt, data, pos)}
+		pos = values[unpack_block+1]
+		table.move(values, 1, unpack_block, i+1, map)
+		i = i + unpack_block
+	end
+	fmt = '>' .. fmt
+	for i=i+1, size do
+		map[i], pos = sunpack(fmt, data, pos)
 	end
+	return map
+end
 
+local function decode_bytes(data, bytes, signed, size)
 	local map = {}
 
 	for i=1, size do
@@ -23,9 +73,97 @@ local function load_map(filename, bytes, signed, size)
 
 		map[i] = n
 	end
-	file:close()
 
 	return map
 end
 
+-- Use the fastest way available: FFI, string.unpack, or string.byte for every element
+local decode_raw = ffi and decode_ffi or sunpack and decode_unpack or decode_bytes
+
+-- Decode 'size' integers of 'bytes' bytes each (big-endian) from a string, optionally applying 'convert' on them
+local function decode(data, bytes, signed, size, convert)
+	local map = decode_raw(data, bytes, signed, size)
+	if convert then
+		for i=1, size do
+			map[i] = convert(map[i])
+		end
+	end
+	return map
+end
+
+local function read_uint32(data, i)
+	local b1, b2, b3, b4 = data:byte(i, i+3)
+	return ((b1*256 + b2)*256 + b3)*256 + b4
+end
+
+-- Tiled format (see terrainlib/tiled.py): tiles are decompressed only when they are accessed, and kept in a LRU cache.
+-- Returns a table that can be indexed like a fully loaded map.
+local function load_tiled(file, filename, convert)
+	local header = file:read(20)
+	local version, kind, bytes, byteorder = header:byte(5), header:sub(6, 6), header:byte(7), header:sub(8, 8)
+	if version ~= 1 or (kind ~= 'i' and kind ~= 'u') or (bytes > 1 and byteorder ~= '>') then
+		error("[mapgen_rivers] Unsupported tiled grid format in " .. filename)
+	end
+	local signed = kind == 'i'
+	local Z, X, tile_size = read_uint32(header, 9), read_uint32(header, 13), read_uint32(header, 17)
+
+	local ntx = math.ceil(X / tile_size)
+	local ntz = math.ceil(Z / tile_size)
+	local offsets_data = file:read(4*(ntx*ntz+1))
+	local offsets = {}
+	for k=1, ntx*ntz+1 do
+		offsets[k] = read_uint32(offsets_data, 4*k-3)
+	end
+
+	local tiles = new_lru(tile_cache_size)
+
+	local function get_tile(tx, tz)
+		local k = tz*ntx + tx + 1
+		local tile = tiles.get(k)
+		if tile then
+			return tile
+		end
+
+		file:seek('set', offsets[k])
+		local data = minetest.decompress(file:read(offsets[k+1] - offsets[k]))
+		local w = math.min(tile_size, X-tx*tile_size)
+		local h = math.min(tile_size, Z-tz*tile_size)
+		tile = decode(data, bytes, signed, w*h, convert)
+		tile.w = w
+
+		tiles.set(k, tile)
+		return tile
+	end
+
+	return setmetatable({}, {
+		__index = function(_, i)
+			i = i - 1
+			local z = math.floor(i / X)
+			local x = i - z*X
+			local tx, tz = math.floor(x / tile_size), math.floor(z / tile_size)
+			local tile = get_tile(tx, tz)
+			return tile[(z-tz*tile_size)*tile.w + (x-tx*tile_size) + 1]
+		end,
+	})
+end
+
+local function load_map(filename, bytes, signed, size, convert)
+	local file = io.open(worldpath .. filename, 'rb')
+	local magic = file:read(4)
+	if magic == 'MGRT' and file:seek('end') ~= bytes*size then
+		file:seek('set', 0)
+		return load_tiled(file, filename, convert)
+	end
+
+	-- Flat format: load the whole map
+	file:seek('set', 0)
+	local data = file:read('*all')
+	if #data < bytes*size then
+		data = minetest.decompress(data)
+	end
+	file:close()
+
+	return decode(data, bytes, signed, size, convert)
+end
+
 return load_map
@@ -0,0 +1,65 @@
+-- Least recently used cache of at most 'size' entries.
+-- Entries are kept in a hash table, and form a doubly linked list from the most recently used (head) to the least recently used (tail).
+-- 'on_evict(key, value)' is called when an entry is removed to make room for another one (optional).
+-- Numbers of successful (hits) and failed (misses) lookups are counted in the 'hits' and 'misses' fields.
+local function new_lru(size, on_evict)
+	local lru = {hits = 0, misses = 0}
+	local entries = {}
+	local head, tail
+	local n = 0
+
+	function lru.get(key)
+		local entry = entries[key]
+		if not entry then
+			lru.misses = lru.misses + 1
+			return nil
+		end
+
+		lru.hits = lru.hits + 1
+		if entry ~= head then
+			-- Move to head
+			entry.prev.next = entry.next
+			if entry.next then
+				entry.next.prev = entry.prev
+			else
+				tail = entry.prev
+			end
+			entry.prev = nil
+			entry.next = head
+			head.prev = entry
+			head = entry
+		end
+		return entry.value
+	end
+
+	function lru.set(key, value)
+		if size <= 0 then
+			return
+		end
+		local entry = {key = key, value = value, next = head}
+		if head then
+			head.prev = entry
+		else
+			tail = entry
+		end
+		head = entry
+		entries[key] = entry
+		n = n + 1
+
+		if n > size then
+			-- Evict least recently used entry
+			local evicted = tail
+			entries[evicted.key] = nil
+			tail = evicted.prev
+			tail.next = nil
+			n = n - 1
+			if on_evict then
+				on_evict(evicted.key, evicted.value)
+			end
+		end
+	end
+
+	return lru
+end
+
+return new_lru
@@ -8,23 +8,34 @@ local world_data_path = minetest.get_worldpath() .. '/river_data/'
 minetest.mkdir(world_data_path)
 
 local load_map = dofile(modpath .. 'load.lua')
+local new_lru = dofile(modpath .. 'lru.lua')
 
+-- Copy a file of the mod data to the world if it is not there yet. Returns whether it has been copied.
 local function copy_if_needed(filename)
 	local wfilename = world_data_path..filename
 	local wfile = io.open(wfilename, 'rb')
 	if wfile then
 		wfile:close()
-		return
+		return false
 	end
 	local mfilename = mod_data_path..filename
 	local mfile = io.open(mfilename, 'rb')
+	if not mfile then
+		return false
+	end
 	local wfile = io.open(wfilename, 'wb')
-	wfile:write(mfile:read("*all"))
+	-- Copy by blocks: pre-baked heightmaps can be big
+	local block = mfile:read(2^20)
+	while block do
+		wfile:write(block)
+		block = mfile:read(2^20)
+	end
 	mfile:close()
 	wfile:close()
+	return true
 end
 
-copy_if_needed('size')
+local new_world = copy_if_needed('size')
 local sfile = io.open(world_data_path..'size', 'r')
 local X = tonumber(sfile:read('*l'))
 local Z = tonumber(sfile:read('*l'))
@@ -40,15 +51,19 @@ copy_if_needed('rivers')
 local rivers = load_map('rivers', 4, false, X*Z)
 
 copy_if_needed('offset_x')
-local offset_x = load_map('offset_x', 1, true, X*Z)
-for k, v in ipairs(offset_x) do
-	offset_x[k] = (v+0.5)/256
+local function offset_conv(v)
+	return (v+0.5)/256
 end
+local offset_x = load_map('offset_x', 1, true, X*Z, offset_conv)
 
 copy_if_needed('offset_y')
-local offset_z = load_map('offset_y', 1, true, X*Z)
-for k, v in ipairs(offset_z) do
-	offset_z[k] = (v+0.5)/256
+local offset_z = load_map('offset_y', 1, true, X*Z, offset_conv)
+
+-- Pre-baked heightmaps (see heightmap.lua) are made from the grid: copy them only along with it
+if new_world then
+	copy_if_needed('heightmaps')
+	copy_if_needed('terrain_map')
+	copy_if_needed('lake_map')
 end
 
 -- To index a flat array representing a 2D map
@@ -92,12 +107,147 @@ local glacier_factor = mapgen_rivers.glacier_factor
 
 local init = false
 
+local NO_SPAN = math.huge -- Empty pair of X positions
+
+-- Compute a polygon: its vertices, the data used by heightmap.lua, and for every Z position the X positions covered by it (scanline algorithm).
+-- It does not depend on the chunk being generated.
+local function make_polygon(xp, zp)
+	local iA = index(xp, zp)
+	local iB = index(xp+1, zp)
+	local iC = index(xp+1, zp+1)
+	local iD = index(xp, zp+1)
+	-- Extract the vertices of the polygon
+	local poly_x = {
+		(offset_x[iA]+xp)   * blocksize - map_offset.x,
+		(offset_x[iB]+xp+1) * blocksize - map_offset.x,
+		(offset_x[iC]+xp+1) * blocksize - map_offset.x,
+		(offset_x[iD]+xp)   * blocksize - map_offset.x,
+	}
+	local poly_z = {
+		(offset_z[iA]+zp)   * blocksize - map_offset.z,
+		(offset_z[iB]+zp)   * blocksize - map_offset.z,
+		(offset_z[iC]+zp+1) * blocksize - map_offset.z,
+		(offset_z[iD]+zp+1) * blocksize - map_offset.z,
+	}
+	local polygon = {x=poly_x, z=poly_z, i={iA, iB, iC, iD}}
+
+	local bounds = {} -- Will be a list of the intercepts of polygon edges for every Z position (scanline algorithm)
+	-- Calculate the min and max Z positions
+	local zmin = math.floor(math.min(unpack(poly_z)))+1
+	local zmax = math.floor(math.max(unpack(poly_z)))
+	-- And initialize the arrays
+	for z=zmin, zmax do
+		bounds[z] = {}
+	end
+
+	local i1 = 4
+	for i2=1, 4 do -- Loop on 4 edges
+		local z1, z2 = poly_z[i1], poly_z[i2]
+		-- Calculate the integer Z positions over which this edge spans
+		local lzmin = math.floor(math.min(z1, z2))+1
+		local lzmax = math.floor(math.max(z1, z2))
+		if lzmin <= lzmax then -- If there is at least one position in it
+			local x1, x2 = poly_x[i1], poly_x[i2]
+			-- Calculate coefficient of the equation defining the edge: X=aZ+b
+			local a = (x1-x2) / (z1-z2)
+			local b = (x1 - a*z1)
+			for z=lzmin, lzmax do
+				-- For every Z position involved, add the intercepted X position in the table
+				table.insert(bounds[z], a*z+b)
+			end
+		end
+		i1 = i2
+	end
+
+	-- Spans: for every Z position, 2 pairs of X positions (first and last) between which nodes belong to the polygon, in a flat array
+	local spans = {}
+	local k = 0
+	for z=zmin, zmax do
+		-- Now sort the bounds list
+		local zlist = bounds[z]
+		table.sort(zlist)
+		local c = math.floor(#zlist/2)
+		for l=1, 2 do
+			-- Take pairs of X coordinates: all positions between them belong to the polygon.
+			if l <= c then
+				spans[k+1] = math.floor(zlist[l*2-1])+1
+				spans[k+2] = math.floor(zlist[l*2])
+			else
+				spans[k+1] = NO_SPAN
+				spans[k+2] = -NO_SPAN
+			end
+			k = k + 2
+		end
+	end
+	polygon.zmin = zmin
+	polygon.zmax = zmax
+	polygon.spans = spans
+
+	local poly_dem = {dem[iA], dem[iB], dem[iC], dem[iD]}
+	polygon.dem = poly_dem
+	polygon.lake = {lakes[iA], lakes[iB], lakes[iC], lakes[iD]}
+
+	-- Now, rivers.
+	-- Load river flux values for the 4 corners
+	local riverA = river_width(rivers[iA])
+	local riverB = river_width(rivers[iB])
+	local riverC = river_width(rivers[iC])
+	local riverD = river_width(rivers[iD])
+	if glaciers then -- Widen the river
+		if get_temperature(poly_x[1], poly_dem[1], poly_z[1]) < 0 then
+			riverA = math.min(riverA*glacier_factor, 1)
+		end
+		if get_temperature(poly_x[2], poly_dem[2], poly_z[2]) < 0 then
+			riverB = math.min(riverB*glacier_factor, 1)
+		end
+		if get_temperature(poly_x[3], poly_dem[3], poly_z[3]) < 0 then
+			riverC = math.min(riverC*glacier_factor, 1)
+		end
+		if get_temperature(poly_x[4], poly_dem[4], poly_z[4]) < 0 then
+			riverD = math.min(riverD*glacier_factor, 1)
+		end
+	end
+
+	polygon.river_corners = {riverA, 1-riverB, 2-riverC, 1-riverD}
+
+	-- Flow directions
+	local dirA, dirB, dirC, dirD = dirs[iA], dirs[iB], dirs[iC], dirs[iD]
+	-- Determine the river flux on the edges, by testing dirs values
+	local river_west = (dirA==1 and riverA or 0) + (dirD==3 and riverD or 0)
+	local river_north = (dirA==2 and riverA or 0) + (dirB==4 and riverB or 0)
+	local river_east = 1 - (dirB==1 and riverB or 0) - (dirC==3 and riverC or 0)
+	local river_south = 1 - (dirD==2 and riverD or 0) - (dirC==4 and riverC or 0)
+
+	polygon.rivers = {river_west, river_north, river_east, river_south}
+
+	return polygon
+end
+
+-- LRU cache of polygons, shared by all chunks: chunks of the same column, and neighbouring chunks, cover the same polygons.
+-- Its counters of polygons found in the cache (hits) or computed (misses) since startup are exposed in mapgen_rivers.polygon_cache_stats.
+local polygon_cache = new_lru(mapgen_rivers.polygon_cache_size)
+mapgen_rivers.polygon_cache_stats = polygon_cache
+
+minetest.register_on_shutdown(function()
+	local total = polygon_cache.hits + polygon_cache.misses
+	if total > 0 then
+		minetest.log('action', ('[mapgen_rivers] Polygon cache: %d hits, %d misses (%.1f%% hit rate)'):format(polygon_cache.hits, polygon_cache.misses, 100*polygon_cache.hits/total))
+	end
+end)
+
+local function get_polygon(xp, zp)
+	local key = index(xp, zp)
+	local polygon = polygon_cache.get(key)
+	if not polygon then
+		polygon = make_polygon(xp, zp)
+		polygon_cache.set(key, polygon)
+	end
+	return polygon
+end
+
 -- On map generation, determine into which polygon every point (in 2D) will fall.
 -- Also store polygon-specific data
 local function make_polygons(minp, maxp)
-	print("Generating polygon map")
-	print(minp.x, maxp.x, minp.z, maxp.z)
-
 	if not init then
 		if glaciers then
 			noise_heat = minetest.get_perlin(mapgen_rivers.noise_params.heat)
@@ -111,69 +261,18 @@ local function make_polygons(minp, maxp)
 	-- Determine the minimum and maximum coordinates of the polygons that could be on the chunk, knowing that they have an average size of 'blocksize' and a maximal offset of 0.5 blocksize.
 	local xpmin, xpmax = math.max(math.floor((minp.x+map_offset.x)/blocksize - 0.5), 0), math.min(math.ceil((maxp.x+map_offset.x)/blocksize + 0.5), X-2)
 	local zpmin, zpmax = math.max(math.floor((minp.z+map_offset.z)/blocksize - 0.5), 0), math.min(math.ceil((maxp.z+map_offset.z)/blocksize + 0.5), Z-2)
-	print(xpmin, xpmax, zpmin, zpmax)
 
 	-- Iterate over the polygons
 	for xp = xpmin, xpmax do
 		for zp=zpmin, zpmax do
-			local iA = index(xp, zp)
-			local iB = index(xp+1, zp)
-			local iC = index(xp+1, zp+1)
-			local iD = index(xp, zp+1)
-			-- Extract the vertices of the polygon
-			local poly_x = {
-				(offset_x[iA]+xp)   * blocksize - map_offset.x,
-				(offset_x[iB]+xp+1) * blocksize - map_offset.x,
-				(offset_x[iC]+xp+1) * blocksize - map_offset.x,
-				(offset_x[iD]+xp)   * blocksize - map_offset.x,
-			}
-			local poly_z = {
-				(offset_z[iA]+zp)   * blocksize - map_offset.z,
-				(offset_z[iB]+zp)   * blocksize - map_offset.z,
-				(offset_z[iC]+zp+1) * blocksize - map_offset.z,
-				(offset_z[iD]+zp+1) * blocksize - map_offset.z,
-			}
-			if xp==xpmin and zp==zpmin then
-				print(xp, zp, poly_x[1], poly_z[1])
-			end
-			local polygon = {x=poly_x, z=poly_z, i={iA, iB, iC, iD}}
-
-			local bounds = {} -- Will be a list of the intercepts of polygon edges for every Z position (scanline algorithm)
-			-- Calculate the min and max Z positions 
-			local zmin = math.max(math.floor(math.min(unpack(poly_z)))+1, minp.z)
-			local zmax = math.min(math.floor(math.max(unpack(poly_z))), maxp.z)
-			-- And initialize the arrays
-			for z=zmin, zmax do
-				bounds[z] = {}
-			end
-
-			local i1 = 4
-			for i2=1, 4 do -- Loop on 4 edges
-				local z1, z2 = poly_z[i1], poly_z[i2]
-				-- Calculate the integer Z positions over which this edge spans
-				local lzmin = math.floor(math.min(z1, z2))+1
-				local lzmax = math.floor(math.max(z1, z2))
-				if lzmin <= lzmax then -- If there is at least one position in it
-					local x1, x2 = poly_x[i1], poly_x[i2]
-					-- Calculate coefficient of the equation defining the edge: X=aZ+b
-					local a = (x1-x2) / (z1-z2)
-					local b = (x1 - a*z1)
-					for z=math.max(lzmin, minp.z), math.min(lzmax, maxp.z) do
-						-- For every Z position involved, add the intercepted X position in the table
-						table.insert(bounds[z], a*z+b)
-					end
-				end
-				i1 = i2
-			end
-			for z=zmin, zmax do
-				-- Now sort the bounds list
-				local zlist = bounds[z]
-				table.sort(zlist)
-				local c = math.floor(#zlist/2)
-				for l=1, c do
-					-- Take pairs of X coordinates: all positions between them belong to the polygon.
-					local xmin = math.max(math.floor(zlist[l*2-1])+1, minp.x)
-					local xmax = math.min(math.floor(zlist[l*2]), maxp.x)
+			local polygon = get_polygon(xp, zp)
+			local spans = polygon.spans
+			local pzmin = polygon.zmin
+			for z=math.max(pzmin, minp.z), math.min(polygon.zmax, maxp.z) do
+				local k = (z-pzmin)*4
+				for l=1, 3, 2 do
+					local xmin = math.max(spans[k+l], minp.x)
+					local xmax = math.min(spans[k+l+1], maxp.x)
 					local i = (z-minp.z) * chulens + (xmin-minp.x) + 1
 					for x=xmin, xmax do
 						-- Fill the map at these places
@@ -182,43 +281,6 @@ local function make_polygons(minp, maxp)
 					end
 				end
 			end
-
-			local poly_dem = {dem[iA], dem[iB], dem[iC], dem[iD]}
-			polygon.dem = poly_dem
-			polygon.lake = {lakes[iA], lakes[iB], lakes[iC], lakes[iD]}
-
-			-- Now, rivers.
-			-- Load river flux values for the 4 corners
-			local riverA = river_width(rivers[iA])
-			local riverB = river_width(rivers[iB])
-			local riverC = river_width(rivers[iC])
-			local riverD = river_width(rivers[iD])
-			if glaciers then -- Widen the river
-				if get_temperature(poly_x[1], poly_dem[1], poly_z[1]) < 0 then
-					riverA = math.min(riverA*glacier_factor, 1)
-				end
-				if get_temperature(poly_x[2], poly_dem[2], poly_z[2]) < 0 then
-					riverB = math.min(riverB*glacier_factor, 1)
-				end
-				if get_temperature(poly_x[3], poly_dem[3], poly_z[3]) < 0 then
-					riverC = math.min(riverC*glacier_factor, 1)
-				end
-				if get_temperature(poly_x[4], poly_dem[4], poly_z[4]) < 0 then
-					riverD = math.min(riverD*glacier_factor, 1)
-				end
-			end
-
-			polygon.river_corners = {riverA, 1-riverB, 2-riverC, 1-riverD}
-
-			-- Flow directions
-			local dirA, dirB, dirC, dirD = dirs[iA], dirs[iB], dirs[iC], dirs[iD]
-			-- Determine the river flux on the edges, by testing dirs values
-			local river_west = (dirA==1 and riverA or 0) + (dirD==3 and riverD or 0)
-			local river_north = (dirA==2 and riverA or 0) + (dirB==4 and riverB or 0)
-			local river_east = 1 - (dirB==1 and riverB or 0) - (dirC==3 and riverC or 0)
-			local river_south = 1 - (dirD==2 and riverD or 0) - (dirC==4 and riverC or 0)
-
-			polygon.rivers = {river_west, river_north, river_east, river_south}
 		end
 	end
 
@@ -56,3 +56,6 @@ mapgen_rivers.biomes = get_settings('biomes', 'bool', true)
 mapgen_rivers.glaciers = get_settings('glaciers', 'bool', false)
 mapgen_rivers.glacier_factor = get_settings('glacier_factor', 'float', 8)
 mapgen_rivers.elevation_chill = get_settings('elevation_chill', 'float', 0.25)
+mapgen_rivers.tile_cache_size = get_settings('tile_cache_size', 'int', 64)
+mapgen_rivers.polygon_cache_size = get_settings('polygon_cache_size', 'int', 4096)
+mapgen_rivers.heightmap_cache_size = get_settings('heightmap_cache_size', 'int', 32)
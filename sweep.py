@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+
+# Generate several candidate grids by sweeping parameters, in parallel.
+# Usage: ./sweep.py [config_file] [output_dir] [--parameter value1,value2,...] [--seeds 1,2,3] [--processes 4]
+# Every parameter of generate.py can be given a comma-separated list of values, on the command line or in the config file.
+# Candidates are all combinations of these values, for every seed. Candidates with the same seed and noise parameters share the initial noise map.
+# Every candidate is saved in its own directory in output_dir, and a summary of all candidates is written in output_dir/summary.csv.
+
+import numpy as np
+import itertools
+import csv
+import os
+import sys
+
+import terrainlib
+from terrainlib.parallel import get_executor, SharedArray
+from terrainlib.pipeline import noise_settings
+
+def run_candidate(task):
+    """
+    Run the landscape evolution model for one candidate, and save the grid. Returns the statistics of the final map.
+    Same process as generate.py, without preview and checkpoints: a candidate gives the same grid as generate.py with the same seed.
+    """
+    name, params, seed, noise_desc, output_dir, workers = task
+    s = dict(terrainlib.read_settings(params), workers=workers)
+    rng = np.random.default_rng(seed)
+    sea_ybase, xbase, ybase = terrainlib.random_bases(rng)
+    sea_level_ref = terrainlib.sea_level_reference(s, sea_ybase)
+
+    noise = SharedArray.attach(noise_desc)
+    n = noise.array + terrainlib.initial_offset(s, sea_level_ref)
+    noise.close()
+
+    model = terrainlib.make_model(n, s, rng=rng)
+    del n
+
+    for i, process in terrainlib.evolve(model, s, sea_ybase, sea_level_ref):
+        pass
+    model.calculate_flow()
+
+    offset_x, offset_y, history = terrainlib.twist_model(model, s)
+    dirname = os.path.join(output_dir, name)
+    terrainlib.save_model(dirname, model, offset_x, offset_y, s)
+
+    # Parameters of the candidate, that can be given back to generate.py
+    with open(os.path.join(dirname, 'candidate.conf'), 'w') as f:
+        for key, value in dict(params, seed=seed).items():
+            f.write('{} = {}\n'.format(key, value))
+
+    return terrainlib.stats(model.dem, model.lakes, quiet=True)
+
+if __name__ == '__main__':
+    params_from_args = terrainlib.parse_command_line(sys.argv)
+    config_file = params_from_args.pop('config', 'terrain_default.conf')
+    output_dir = params_from_args.pop('output', 'sweep')
+    params = terrainlib.read_config_file(config_file)
+    params.update(params_from_args)
+
+    seeds = [int(v) for v in params.pop('seeds', '0').split(',')]
+    processes = int(params.pop('processes', os.cpu_count() or 1))
+    workers = int(params.pop('workers', 1))
+
+    # Split swept parameters (comma-separated lists) from fixed ones
+    swept = {key: [v.strip() for v in value.split(',')] for key, value in params.items() if ',' in value}
+    fixed = {key: value for key, value in params.items() if key not in swept}
+    combinations = [dict(zip(swept.keys(), values)) for values in itertools.product(*swept.values())]
+    print('{:d} candidates: {:d} parameter combinations, {:d} seeds'.format(len(combinations)*len(seeds), len(combinations), len(seeds)))
+
+    os.makedirs(output_dir, exist_ok=True)
+    executor = get_executor(processes)
+    if executor is not None:
+        workers = 1 # Candidates are already run in parallel
+
+    # Compute every distinct initial noise map once, in shared memory
+    noises = {}
+    candidates = []
+    for seed in seeds:
+        for combination in combinations:
+            cparams = dict(fixed, **combination)
+            s = terrainlib.read_settings(cparams)
+            key = (seed,) + tuple(s[p] for p in noise_settings)
+            if key not in noises:
+                print('Noise for seed {:d}'.format(seed))
+                sea_ybase, xbase, ybase = terrainlib.random_bases(np.random.default_rng(seed))
+                noises[key] = SharedArray.copy_of(terrainlib.initial_noise(s, xbase, ybase, workers=processes))
+            name = '_'.join(['seed{:d}'.format(seed)] + ['{}{}'.format(k, v) for k, v in combination.items()])
+            candidates.append((name, cparams, seed, noises[key].desc, output_dir, workers))
+    print('{:d} distinct noise maps'.format(len(noises)))
+
+    try:
+        if executor is not None:
+            results = list(executor.map(run_candidate, candidates))
+        else:
+            results = [run_candidate(c) for c in candidates]
+    finally:
+        for noise in noises.values():
+            noise.close()
+
+    # Summary table
+    stat_keys = list(results[0].keys())
+    with open(os.path.join(output_dir, 'summary.csv'), 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['name', 'seed'] + list(swept.keys()) + stat_keys)
+        for (name, cparams, seed, *_), result in zip(candidates, results):
+            writer.writerow([name, seed] + [cparams[k] for k in swept] + ['{:.4f}'.format(result[k]) for k in stat_keys])
+
+    print()
+    print('{:<40} {:>11} {:>8} {:>8} {:>8}'.format('Candidate', 'Continents', 'Lakes', 'Lowest', 'Highest'))
+    for (name, *_), result in zip(candidates, results):
+        print('{:<40} {:>11.2%} {:>8.2%} {:>8.0f} {:>8.0f}'.format(name, result['continents'], result['lakes'], result['lowest_elevation'], result['highest_elevation']))
+    print()
+    print('Summary saved in', os.path.join(output_dir, 'summary.csv'))
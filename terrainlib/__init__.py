@@ -1,7 +1,15 @@
 # Load packages and provide easy access to important functions
 
-from .settings import read_config_file
+from .settings import read_config_file, parse_command_line
 from .erosion import EvolutionModel
-from .save import save
-from .bounds import make_bounds, twist, get_fixed
-from .view import stats, update, plot
+from .save import save, save_grids
+from .tiled import TiledGrid, load_grid, convert_grid_dir
+from .heightmap import Heightmaps, bake_heightmaps
+from .bounds import direction_masks, make_bounds, twist, get_fixed
+from .view import stats, update, plot, Preview
+from .simplex import noisemap, snoise2
+from .checkpoint import save_checkpoint, load_checkpoint
+from .cache import Cache
+from .outofcore import peak_rss, reset_peak_rss
+from .profiling import profiler, stage as profile_stage
+from .pipeline import read_settings, random_bases, sea_level_reference, initial_noise, initial_offset, make_model, evolve, twist_model, save_model
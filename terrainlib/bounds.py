@@ -1,74 +1,117 @@
 import numpy as np
 
-def make_bounds(dirs, rivers):
+def direction_masks(dirs):
     """
-    Give an array of all horizontal and vertical bounds
+    Give the masks of nodes flowing in every direction (1 to 4), to be shared by make_bounds and get_fixed
     """
+    return [dirs==k for k in range(1, 5)]
 
-    (Y, X) = dirs.shape
-    bounds_h = np.zeros((Y, X-1), dtype=rivers.dtype)
-    bounds_v = np.zeros((Y-1, X), dtype=rivers.dtype)
-
-    bounds_v += (rivers * (dirs==1))[:-1,:]
-    bounds_h += (rivers * (dirs==2))[:,:-1]
-    bounds_v -= (rivers * (dirs==3))[1:,:]
-    bounds_h -= (rivers * (dirs==4))[:,1:]
+def make_bounds(dirs, rivers, masks=None):
+    """
+    Give an array of all horizontal and vertical bounds
+    """
+    if masks is None:
+        masks = direction_masks(dirs)
+    m1, m2, m3, m4 = masks
+    if rivers.dtype.kind == 'u':
+        # Unsigned discharge (compact and out-of-core modes) would wrap around when subtracted
+        rivers = rivers.astype(np.int32 if rivers.size < 2**31 else np.int64)
+
+    bounds_v = rivers[:-1,:] * m1[:-1,:]
+    bounds_h = rivers[:,:-1] * m2[:,:-1]
+    bounds_v -= rivers[1:,:] * m3[1:,:]
+    bounds_h -= rivers[:,1:] * m4[:,1:]
 
     return bounds_h, bounds_v
 
-def get_fixed(dirs):
+def get_fixed(dirs, masks=None):
     """
     Give the list of points that should not be twisted
     """
+    if masks is None:
+        masks = direction_masks(dirs)
+    m1, m2, m3, m4 = masks
 
     borders = np.zeros(dirs.shape, dtype='?')
-    borders[-1,:] |= dirs[-1,:]==1
-    borders[:,-1] |= dirs[:,-1]==2
-    borders[0,:] |= dirs[0,:]==3
-    borders[:,0] |= dirs[:,0]==4
+    borders[-1,:] |= m1[-1,:]
+    borders[:,-1] |= m2[:,-1]
+    borders[0,:] |= m3[0,:]
+    borders[:,0] |= m4[:,0]
 
     donors = np.zeros(dirs.shape, dtype='?')
-    donors[1:,:] |= dirs[:-1,:]==1
-    donors[:,1:] |= dirs[:,:-1]==2
-    donors[:-1,:] |= dirs[1:,:]==3
-    donors[:,:-1] |= dirs[:,1:]==4
+    donors[1:,:] |= m1[:-1,:]
+    donors[:,1:] |= m2[:,:-1]
+    donors[:-1,:] |= m3[1:,:]
+    donors[:,:-1] |= m4[:,1:]
     return borders | ~donors
 
-def twist(bounds_x, bounds_y, fixed, d=0.1, n=5):
+def twist(bounds_x, bounds_y, fixed, d=0.1, n=5, tol=0.0, return_history=False):
     """
     Twist the grid (define an offset for every node). Model river bounds as if they were elastics.
     Smoothes preferentially big rivers.
+    Every step moves nodes by 'd' in the direction of the force they undergo. At most 'n' steps are run, and iterations stop when the residual (RMS of forces on moveable nodes, relative to the first step) falls below 'tol'.
+    Offsets are given in single precision. If 'return_history' is True, the list of residuals of every step is returned too.
     """
 
-    moveable = ~fixed
-
     (Y, X) = fixed.shape
-    offset_x = np.zeros((Y, X))
-    offset_y = np.zeros((Y, X))
-
+    abs_x = np.abs(bounds_x).astype(np.float32)
+    abs_y = np.abs(bounds_y).astype(np.float32)
+    moveable = (~fixed).astype(np.float32)
+    nmoveable = max(int(moveable.sum()), 1)
+    step = moveable * np.float32(d)
+
+    # Buffers reused at every step
+    offset_x = np.zeros((Y, X), dtype=np.float32)
+    offset_y = np.zeros((Y, X), dtype=np.float32)
+    force_x = np.empty((Y, X), dtype=np.float32)
+    force_y = np.empty((Y, X), dtype=np.float32)
+    length = np.empty((Y, X), dtype=np.float32)
+    diff_h = np.empty((Y, X-1), dtype=np.float32)
+    diff_v = np.empty((Y-1, X), dtype=np.float32)
+
+    history = []
     for i in range(n):
-        force_long = np.abs(bounds_x) * (1+np.diff(offset_x, axis=1))
-        force_trans = np.abs(bounds_y) * np.diff(offset_x, axis=0)
-
-        force_x = np.zeros((Y, X))
-        force_x[:,:-1] = force_long
-        force_x[:,1:] -= force_long
-        force_x[:-1,:]+= force_trans
-        force_x[1:,:] -= force_trans
-
-        force_long = np.abs(bounds_y) * (1+np.diff(offset_y, axis=0))
-        force_trans = np.abs(bounds_x) * np.diff(offset_y, axis=1)
-
-        force_y = np.zeros((Y, X))
-        force_y[:-1,:] = force_long
-        force_y[1:,:] -= force_long
-        force_y[:,:-1]+= force_trans
-        force_y[:,1:] -= force_trans
-
-        length = np.hypot(force_x, force_y)
-        length[length==0] = 1
-        coeff = d / length * moveable # Normalize, take into account the direction only
-        offset_x += force_x * coeff
-        offset_y += force_y * coeff
-
+        # Forces along X: longitudinal on horizontal bounds, transversal on vertical bounds
+        np.subtract(offset_x[:,1:], offset_x[:,:-1], out=diff_h)
+        diff_h += 1
+        diff_h *= abs_x
+        force_x[:,:-1] = diff_h
+        force_x[:,-1] = 0
+        force_x[:,1:] -= diff_h
+        np.subtract(offset_x[1:,:], offset_x[:-1,:], out=diff_v)
+        diff_v *= abs_y
+        force_x[:-1,:] += diff_v
+        force_x[1:,:] -= diff_v
+
+        # Forces along Y
+        np.subtract(offset_y[1:,:], offset_y[:-1,:], out=diff_v)
+        diff_v += 1
+        diff_v *= abs_y
+        force_y[:-1,:] = diff_v
+        force_y[-1,:] = 0
+        force_y[1:,:] -= diff_v
+        np.subtract(offset_y[:,1:], offset_y[:,:-1], out=diff_h)
+        diff_h *= abs_x
+        force_y[:,:-1] += diff_h
+        force_y[:,1:] -= diff_h
+
+        np.hypot(force_x, force_y, out=length)
+        flat = length.ravel()
+        residual = float(np.sqrt(np.einsum('i,i,i->', flat, flat, moveable.ravel(), dtype=np.float64) / nmoveable))
+        if i == 0:
+            residual0 = residual or 1.0
+        history.append(residual / residual0)
+        if residual == 0 or history[-1] < tol:
+            break
+
+        # Normalize, take into account the direction only (length is 0 only where forces are 0)
+        np.maximum(length, np.finfo(np.float32).tiny, out=length)
+        np.divide(step, length, out=length)
+        force_x *= length
+        force_y *= length
+        offset_x += force_x
+        offset_y += force_y
+
+    if return_history:
+        return offset_x, offset_y, history
     return offset_x, offset_y
@@ -0,0 +1,117 @@
+import numpy as np
+import hashlib
+import json
+import os
+import shutil
+
+# Content-addressed cache of intermediate products (noise map, model state after every iteration, final flow, twist offsets).
+# Every entry is a directory named by a hash of the stage name, the parameters it depends on and the version of terrainlib's code.
+# It contains uncompressed .npy files (memory-mapped when loaded) and a JSON file for scalar state.
+# When the total size exceeds the limit, least recently used entries are removed.
+# For every stage, a hit is counted when its product is loaded, and a miss when it is computed and stored.
+
+def code_version():
+    """
+    Hash of the source files of terrainlib: any change of the code invalidates the cache.
+    """
+    h = hashlib.sha256()
+    dirname = os.path.dirname(os.path.abspath(__file__))
+    for fname in sorted(os.listdir(dirname)):
+        if fname.endswith('.py'):
+            h.update(fname.encode())
+            with open(os.path.join(dirname, fname), 'rb') as f:
+                h.update(f.read())
+    return h.hexdigest()
+
+def _entry_size(path):
+    return sum(os.path.getsize(os.path.join(path, fname)) for fname in os.listdir(path))
+
+class Cache:
+    def __init__(self, dirname, max_size=None):
+        """
+        'max_size' is the maximal total size of the cache in bytes (no limit if None).
+        """
+        os.makedirs(dirname, exist_ok=True)
+        self.dirname = dirname
+        self.max_size = max_size
+        self.version = code_version()
+        self.stats = {}
+
+    def key(self, *parts):
+        """
+        Key of a stage, from the stage name and the parameters (JSON-serializable) it depends on. Keys of upstream stages can be given as parameters.
+        """
+        data = json.dumps([self.version] + list(parts), sort_keys=True)
+        return hashlib.sha256(data.encode()).hexdigest()[:32]
+
+    def _path(self, key):
+        return os.path.join(self.dirname, key)
+
+    def has(self, key):
+        return os.path.isfile(os.path.join(self._path(key), 'state.json'))
+
+    def get(self, key, stage):
+        """
+        Load an entry of 'stage'. Returns the dict of arrays (memory-mapped, copy-on-write) and the state dict, or None if the entry does not exist.
+        """
+        if not self.has(key):
+            return None
+        self.stats.setdefault(stage, [0, 0])[0] += 1
+
+        path = self._path(key)
+        with open(os.path.join(path, 'state.json'), 'r') as f:
+            state = json.load(f)
+        arrays = {name: np.load(os.path.join(path, name + '.npy'), mmap_mode='c') for name in state.pop('arrays')}
+        os.utime(path) # Mark as recently used
+        return arrays, state
+
+    def put(self, key, stage, arrays, **state):
+        """
+        Store a dict of arrays of 'stage', and additional JSON-serializable state, then remove old entries if the cache is too big.
+        """
+        self.stats.setdefault(stage, [0, 0])[1] += 1
+        path = self._path(key)
+        tmp = path + '.tmp'
+        if os.path.isdir(tmp):
+            shutil.rmtree(tmp)
+        os.mkdir(tmp)
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp, name + '.npy'), array)
+        state = dict(state, arrays=list(arrays.keys()))
+        with open(os.path.join(tmp, 'state.json'), 'w') as f:
+            json.dump(state, f)
+
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        os.replace(tmp, path)
+        self.evict(keep=key)
+
+    def evict(self, keep=None):
+        """
+        Remove least recently used entries (except 'keep') until the cache fits in max_size.
+        """
+        if self.max_size is None:
+            return
+        entries = []
+        total = 0
+        for name in os.listdir(self.dirname):
+            path = self._path(name)
+            if not os.path.isdir(path):
+                continue
+            size = _entry_size(path)
+            total += size
+            if name != keep:
+                entries.append((os.path.getmtime(path), size, path))
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= self.max_size:
+                break
+            shutil.rmtree(path)
+            total -= size
+
+    def print_summary(self):
+        hits = sum(h for h, m in self.stats.values())
+        misses = sum(m for h, m in self.stats.values())
+        print('Cache: {:d} hits, {:d} misses'.format(hits, misses))
+        for stage, (h, m) in self.stats.items():
+            print('  {:<12} {:4d} hits {:4d} misses'.format(stage, h, m))
@@ -0,0 +1,78 @@
+import numpy as np
+import numpy.random as npr
+import json
+import os
+import shutil
+
+# Save and restore the state of an EvolutionModel between iterations.
+# Every checkpoint is a directory of uncompressed .npy files (fast to write, can be memory-mapped) and a JSON file for scalar state.
+# Checkpoints are written in a new subdirectory, and the 'latest' file is switched to it only once it is complete.
+
+fields = ('dem', 'lakes', 'dirs', 'rivers', 'ref_isostasy')
+
+def save_checkpoint(dirname, model, iteration, **state):
+    """
+    Save model fields, iteration index, sea level and state of the random generator (the model's one, or the global one if the model has none).
+    Additional keyword arguments must be JSON-serializable, they are given back by load_checkpoint.
+    """
+    os.makedirs(dirname, exist_ok=True)
+    name = 'iter_{:05d}'.format(iteration)
+    path = os.path.join(dirname, name)
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    os.mkdir(path)
+
+    for field in fields:
+        np.save(os.path.join(path, field + '.npy'), getattr(model, field))
+
+    state = dict(state)
+    if model.rng is not None:
+        state['rng_generator'] = model.rng.bit_generator.state
+    else:
+        rng_name, rng_keys, rng_pos, rng_has_gauss, rng_gauss = npr.get_state()
+        np.save(os.path.join(path, 'rng_keys.npy'), rng_keys)
+        state['rng'] = [rng_name, int(rng_pos), int(rng_has_gauss), float(rng_gauss)]
+
+    state.update({
+        'iteration': iteration,
+        'sea_level': float(model.sea_level),
+    })
+    with open(os.path.join(path, 'state.json'), 'w') as f:
+        json.dump(state, f, indent=1)
+
+    # Switch to the new checkpoint, then remove older ones
+    latest = os.path.join(dirname, 'latest')
+    with open(latest + '.tmp', 'w') as f:
+        f.write(name)
+    os.replace(latest + '.tmp', latest)
+    for old in os.listdir(dirname):
+        if old.startswith('iter_') and old != name:
+            shutil.rmtree(os.path.join(dirname, old))
+
+def load_checkpoint(dirname, mmap_mode=None):
+    """
+    Load the latest checkpoint in 'dirname'.
+    Returns a dict of model fields, the iteration index and the state dict. If the model had its own random generator, it is restored in state['rng'], otherwise the state of the global random generator is restored.
+    """
+    with open(os.path.join(dirname, 'latest'), 'r') as f:
+        path = os.path.join(dirname, f.read().strip())
+
+    arrays = {}
+    for field in fields:
+        arrays[field] = np.load(os.path.join(path, field + '.npy'), mmap_mode=mmap_mode)
+
+    with open(os.path.join(path, 'state.json'), 'r') as f:
+        state = json.load(f)
+
+    if 'rng_generator' in state:
+        rng_state = state.pop('rng_generator')
+        bit_generator = getattr(npr, rng_state['bit_generator'])()
+        bit_generator.state = rng_state
+        state['rng'] = npr.Generator(bit_generator)
+    else:
+        rng_name, rng_pos, rng_has_gauss, rng_gauss = state.pop('rng')
+        rng_keys = np.load(os.path.join(path, 'rng_keys.npy'))
+        npr.set_state((rng_name, rng_keys, rng_pos, rng_has_gauss, rng_gauss))
+
+    iteration = state.pop('iteration')
+    return arrays, iteration, state
@@ -1,6 +1,9 @@
 import numpy as np
 import scipy.ndimage as im
-from .rivermapper import flow
+from .rivermapper import flow, flow_tree, flow_order, IncrementalFlow
+from .parallel import get_executor, run_bands, SharedArray
+from .outofcore import ScratchSpace
+from .profiling import profiled
 
 def advection(dem, dirs, rivers, time, K=1, m=0.5, sea_level=0):
     """
@@ -47,14 +50,177 @@ def advection(dem, dirs, rivers, time, K=1, m=0.5, sea_level=0):
 
     return dem_new
 
-def diffusion(dem, time, d=1):
+def advection_vectorized(dem, dirs, rivers, time, K=1, m=0.5, sea_level=0, tree=None, workers=1):
+    """
+    Same as advection, but processes all pixels at once.
+    Cumulative advection times to the outlet are computed once along the river tree (downstream to upstream),
+    then for every pixel the downstream pixel reached by the erosion wave is searched by binary lifting on the receiver tree.
+    'tree' is the (receivers, order, bounds) tuple given by rivermapper.flow_tree; it is computed from 'dirs' if not provided.
+    With several workers, drainage basins are split between processes, since they are independent from each other.
+    """
+
+    adv_time = 1 / (K*rivers**m)
+    dem = np.maximum(dem, sea_level).ravel()
+
+    if tree is None:
+        tree = flow_tree(dirs)
+    rcv, order, bounds = tree
+    outlet = rcv == np.arange(rcv.size)
+    adv_time = np.where(outlet, 0, adv_time.ravel())
+
+    executor = get_executor(workers)
+    if executor is None:
+        return erosion_waves(dem, adv_time, rcv, order, bounds, time).reshape(dirs.shape)
+
+    # Find the outlet of every pixel, and sort pixels by outlet
+    outlets = np.arange(rcv.size)
+    for i in range(len(bounds)-2, -1, -1):
+        level = order[bounds[i]:bounds[i+1]]
+        outlets[level] = outlets[rcv[level]]
+    part = np.argsort(outlets, kind='stable')
+    outlets = outlets[part]
+
+    # Cut into chunks of similar size, only between basins
+    starts = np.flatnonzero(outlets[1:] != outlets[:-1]) + 1
+    targets = np.arange(1, workers) * rcv.size // workers
+    cuts = np.unique(starts[np.minimum(np.searchsorted(starts, targets), starts.size-1)]) if starts.size > 0 else []
+    cuts = [0] + list(cuts) + [rcv.size]
+    del outlets, starts
+
+    arrays = [SharedArray.copy_of(a) for a in (dem, adv_time, rcv, part)]
+    out = SharedArray(dem.shape, dem.dtype)
+    try:
+        descs = [a.desc for a in arrays]
+        tasks = [(descs, out.desc, c0, c1, time) for c0, c1 in zip(cuts[:-1], cuts[1:])]
+        list(executor.map(_advection_task, tasks))
+        return out.array.reshape(dirs.shape).copy()
+    finally:
+        for a in arrays + [out]:
+            a.close()
+
+def _advection_task(task):
+    descs, out_desc, c0, c1, time = task
+    dem, adv_time, rcv, part = arrays = [SharedArray.attach(desc) for desc in descs]
+    out = SharedArray.attach(out_desc)
+
+    nodes = np.sort(part.array[c0:c1])
+    rcv_local = np.searchsorted(nodes, rcv.array[nodes])
+    order, bounds = flow_order(rcv_local)
+    out.array[nodes] = erosion_waves(dem.array[nodes], adv_time.array[nodes], rcv_local, order, bounds, time)
+
+    del nodes, rcv_local
+    for a in arrays + [out]:
+        a.close()
+
+def erosion_waves(dem, adv_time, rcv, order, bounds, time):
+    """
+    Core of advection_vectorized, on flat arrays. 'adv_time' must be 0 at outlets.
+    """
+    order = order.astype(np.intp, copy=False) # Compact indices would be converted at every lookup
+    nodes = np.arange(rcv.size)
+    outlet = rcv == nodes
+
+    # Cumulative advection time and number of pixels to the outlet, computed from the outlets upstream
+    cumtime = np.zeros(rcv.size)
+    depth = np.zeros(rcv.size, dtype=int)
+    for i in range(len(bounds)-2, -1, -1):
+        level = order[bounds[i]:bounds[i+1]]
+        r = rcv[level]
+        cumtime[level] = adv_time[level] + cumtime[r]
+        depth[level] = depth[r] + ~outlet[level]
+
+    # Number of pixels that an erosion wave can cross during 'time'
+    if outlet.all():
+        nsteps = 0
+    else:
+        nsteps = depth.max()
+        adv_min = adv_time[~outlet].min()
+        if adv_min > 0:
+            nsteps = min(nsteps, int(np.ceil(time / adv_min)))
+
+    # Jump tables: jumps[k] gives the pixel 2^k steps downstream
+    jumps = [rcv]
+    for k in range(1, int(nsteps).bit_length()):
+        jumps.append(jumps[-1][jumps[-1]])
+
+    # For every pixel, find the last pixel downstream whose cumulative time is still above the threshold
+    threshold = cumtime - time
+    current = nodes
+    for jump in reversed(jumps):
+        candidate = jump[current]
+        current = np.where(cumtime[candidate] > threshold, candidate, current)
+
+    # Linear interpolation between this pixel and its receiver
+    current_adv = adv_time[current]
+    c = np.zeros(rcv.size)
+    np.divide(cumtime[current] - threshold, current_adv, out=c, where=current_adv>0)
+    return c*dem[rcv[current]] + (1-c)*dem[current]
+
+advection_methods = {
+    'loop' : advection,
+    'vectorized' : advection_vectorized,
+}
+
+def _gaussian_filter(dem, sigma=1):
+    return im.gaussian_filter(dem, sigma, mode='reflect')
+
+def gaussian_filter(dem, sigma, workers=1, band=None, out=None):
+    """
+    Gaussian blur, computed by bands of rows in parallel if workers > 1, or band by band if 'band' is given.
+    Bands overlap by the radius of the kernel (4 sigma, as in scipy), so the result is the same as a single filter on the whole grid.
+    """
+    halo = int(4*sigma + 0.5)
+    return run_bands(_gaussian_filter, [dem], dem.dtype, halo=halo, workers=workers, band=band, kwargs={'sigma': sigma}, out=out)
+
+def diffusion(dem, time, d=1, workers=1, band=None, out=None):
     radius = d * time**.5
     if radius == 0:
         return dem
-    return im.gaussian_filter(dem, radius, mode='reflect') # Diffusive erosion is a simple Gaussian blur
+    return gaussian_filter(dem, radius, workers=workers, band=band, out=out) # Diffusive erosion is a simple Gaussian blur
+
+def _model_field(name):
+    # Grids of the model. In compact mode, they are stored with compact types, in memory-mapped scratch files in out-of-core mode.
+    def getter(self):
+        return self._fields[name]
+    def setter(self, value):
+        if self.scratch is not None and not self.scratch.owns(value):
+            array = self.scratch.empty(name, value.shape, compact_dtypes[name])
+            array[...] = value
+            value = array
+        elif self.compact:
+            value = np.asarray(value, dtype=compact_dtypes[name])
+        self._fields[name] = value
+    return property(getter, setter)
+
+compact_dtypes = {
+    'dem' : np.float32,
+    'lakes' : np.float32,
+    'ref_isostasy' : np.float32,
+    'isostasy' : np.float32,
+    'dirs' : np.uint8,
+    'rivers' : np.uint32,
+}
 
 class EvolutionModel:
-    def __init__(self, dem, K=1, m=0.5, d=1, sea_level=0, flow=False, flex_radius=100, flow_method='semirandom'):
+    dem = _model_field('dem')
+    lakes = _model_field('lakes')
+    dirs = _model_field('dirs')
+    rivers = _model_field('rivers')
+    ref_isostasy = _model_field('ref_isostasy')
+
+    def __init__(self, dem, K=1, m=0.5, d=1, sea_level=0, flow=False, flex_radius=100, flow_method='semirandom', basin_method='kruskal', advection_method='vectorized', workers=1, ref_isostasy=None, scratch=None, memory_budget=None, rng=None, compact=False, incremental_flow=False, max_flow_change=0.1):
+        """
+        'rng' is the numpy.random.Generator used by semirandom flow routing (the global random generator if None).
+        'compact' enables the compact mode: grids are stored with compact types (32-bit floats for elevations, 8-bit directions, 32-bit integer discharge), and flow is computed with 32-bit indices. Results are close to, but not bit-identical with, the default mode.
+        'scratch' enables the out-of-core mode: grids are stored in memory-mapped files in this directory, and Gaussian filters and local flow routing are processed by bands of rows that fit in 'memory_budget' (in bytes).
+        'incremental_flow' enables the incremental flow calculation (see rivermapper.IncrementalFlow), with full recalculation when more than 'max_flow_change' of the nodes changed. Results are the same.
+        """
+        self._fields = {}
+        self.scratch = None
+        if scratch is not None:
+            self.scratch = ScratchSpace(scratch)
+        self.compact = compact or scratch is not None
+        self.memory_budget = memory_budget
         self.dem = dem
         #self.bedrock = dem
         self.K = K
@@ -62,8 +228,19 @@ class EvolutionModel:
         self.d = d
         self.sea_level = sea_level
         self.flex_radius = flex_radius
-        self.define_isostasy()
+        self.workers = workers
+        self.rng = rng
+        self.incremental_flow = IncrementalFlow(max_flow_change) if incremental_flow else None
+        if ref_isostasy is None:
+            self.define_isostasy()
+        else:
+            self.ref_isostasy = ref_isostasy
         self.flow_method = flow_method
+        self.basin_method = basin_method
+        if advection_method in advection_methods:
+            self.advection_method = advection_method
+        else:
+            raise KeyError('Advection method \'{}\' does not exist'.format(advection_method))
         #set_flow_method(flow_method)
         if flow:
             self.calculate_flow()
@@ -71,25 +248,55 @@ class EvolutionModel:
             self.lakes = dem
             self.dirs = np.zeros(dem.shape, dtype=int)
             self.rivers = np.zeros(dem.shape, dtype=int)
+            self.tree = None
             self.flow_uptodate = False
 
+    def _empty(self, name):
+        # New grid for the given field in out-of-core mode, None otherwise (functions will allocate their result)
+        if self.scratch is None:
+            return None
+        return self.scratch.empty(name, self.dem.shape, compact_dtypes[name])
+
+    def _band(self, halo=0, cell_bytes=32):
+        # Number of rows per band so that a band with its halo and temporaries (about 'cell_bytes' per cell) fits in the memory budget
+        if self.memory_budget is None:
+            return None
+        rows = int(self.memory_budget // (self.dem.shape[1] * cell_bytes)) - 2*halo
+        return max(rows, 16)
+
+    @profiled('calculate_flow')
     def calculate_flow(self):
-        self.dirs, self.lakes, self.rivers = flow(self.dem, method=self.flow_method)
+        flow_func = self.incremental_flow.flow if self.incremental_flow is not None else flow
+        self.dirs, self.lakes, self.rivers, self.tree = flow_func(self.dem, method=self.flow_method, basin_method=self.basin_method, return_tree=True, workers=self.workers, band=self._band(1, 96), rng=self.rng, compact=self.compact) # Keep receivers and topological order for reuse by other processes
         self.flow_uptodate = True
 
+    @profiled('advection')
     def advection(self, time):
-        dem = advection(np.maximum(self.dem, self.lakes), self.dirs, self.rivers, time, K=self.K, m=self.m, sea_level=self.sea_level)
-        self.dem = np.minimum(dem, self.dem)
+        if self.advection_method == 'vectorized':
+            dem = advection_vectorized(np.maximum(self.dem, self.lakes), self.dirs, self.rivers, time, K=self.K, m=self.m, sea_level=self.sea_level, tree=self.tree, workers=self.workers)
+        else:
+            dem = advection(np.maximum(self.dem, self.lakes), self.dirs, self.rivers, time, K=self.K, m=self.m, sea_level=self.sea_level)
+        self.dem = np.minimum(dem, self.dem, out=self._empty('dem'))
         self.flow_uptodate = False
 
+    @profiled('diffusion')
     def diffusion(self, time):
-        self.dem = diffusion(self.dem, time, d=self.d)
+        radius = self.d * time**.5
+        if radius == 0:
+            return # No change: do not take a scratch grid, that would overwrite the current DEM at the next one
+        band = self._band(int(4 * radius + 0.5))
+        self.dem = diffusion(self.dem, time, d=self.d, workers=self.workers, band=band, out=self._empty('dem'))
         self.flow_uptodate = False
 
+    @profiled('define_isostasy')
     def define_isostasy(self):
-        self.ref_isostasy = im.gaussian_filter(self.dem, self.flex_radius, mode='reflect') # Define a blurred version of the DEM that will be considered as the reference isostatic elevation.
+        band = self._band(int(4 * self.flex_radius + 0.5))
+        self.ref_isostasy = gaussian_filter(self.dem, self.flex_radius, workers=self.workers, band=band, out=self._empty('ref_isostasy')) # Define a blurred version of the DEM that will be considered as the reference isostatic elevation.
 
+    @profiled('adjust_isostasy')
     def adjust_isostasy(self, rate=1):
-        isostasy = im.gaussian_filter(self.dem, self.flex_radius, mode='reflect') # Calculate blurred DEM
-        correction = (self.ref_isostasy - isostasy) * rate # Compare it with the reference isostasy
-        self.dem = self.dem + correction # Adjust
+        band = self._band(int(4 * self.flex_radius + 0.5))
+        isostasy = gaussian_filter(self.dem, self.flex_radius, workers=self.workers, band=band, out=self._empty('isostasy')) # Calculate blurred DEM
+        correction = np.subtract(self.ref_isostasy, isostasy, out=isostasy) # Compare it with the reference isostasy
+        correction *= rate
+        self.dem = np.add(self.dem, correction, out=self._empty('dem')) # Adjust
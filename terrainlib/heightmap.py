@@ -0,0 +1,375 @@
+import numpy as np
+import os
+from contextlib import contextmanager
+
+from .parallel import get_executor, SharedArray
+from .tiled import grid_fields, load_grid, TiledWriter
+
+# Vectorized version of the upscaling done by the mod at map generation (polygons.lua and heightmap.lua):
+# grid cells are turned into polygons by grid offsets, rasterized to nodes with the same scanline rule, and every node
+# gets a terrain and a lake height from the polygon it falls in, with rivers carved according to the catchment area.
+# Computations follow the Lua code operation by operation in double precision, so that results are identical to what the mod generates
+# (without distortion, which is applied by init.lua after this step).
+#
+# Grids are indexed [z, x], like the flat arrays of the mod (index z*X+x). Node heightmaps are indexed [z-minp.z, x-minp.x],
+# with minp and maxp (x, z) tuples giving the first and last node of a rectangle, both included, as in heightmap.lua.
+
+MAP_BOTTOM = -31000
+
+# Edges of polygons, as (first vertex, second vertex), in the order in which polygons.lua processes them
+edges = [(3, 0), (0, 1), (1, 2), (2, 3)]
+
+def transform_quadri(X, Y, x, y):
+    """
+    Coordinates of points (x, y) in irregular quadrilaterals, between 0 (one edge) and 1 (opposite edge).
+    X and Y give the coordinates of the 4 vertices, along their first axis.
+    """
+    # Square distances to vertices, shared by the 2 edges of every vertex
+    dist2 = [(X[k]-x)**2 + (Y[k]-y)**2 for k in range(4)]
+    dist = [np.sqrt(d) for d in dist2]
+
+    def distance_to_segment(i1, i2):
+        # Distance between points and the segment from vertex i1 to vertex i2
+        x1, y1, x2, y2 = X[i1], Y[i1], X[i2], Y[i2]
+        a = (x1-x2)**2 + (y1-y2)**2
+        b, c = dist2[i1], dist2[i2]
+        d = np.abs(x1 * (y2-y) + x2 * (y-y1) + x * (y1-y2)) / np.sqrt(a)
+        return np.where(a + b < c, dist[i1], np.where(a + c < b, dist[i2], d))
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # Compare distance to 2 opposite edges, they give the X coordinate
+        d23 = distance_to_segment(1, 2)
+        d41 = distance_to_segment(3, 0)
+        xc = d41 / (d23+d41)
+        # Same for the 2 other edges, they give the Y coordinate
+        d12 = distance_to_segment(0, 1)
+        d34 = distance_to_segment(2, 3)
+        yc = d12 / (d12+d34)
+    return xc, yc
+
+def _interp(v00, v01, v11, v10, xf, zf):
+    v0 = v01*xf + v00*(1-xf)
+    v1 = v11*xf + v10*(1-xf)
+    return v1*zf + v0*(1-zf)
+
+class Heightmaps:
+    """
+    Terrain and lake heightmaps at node resolution, computed from a grid (arrays indexed [z, x], as saved by generate.py).
+    Settings have the same names and defaults as the mod settings (without 'mapgen_rivers_' prefix).
+    Glaciers need the heat noise of the game: 'temperature' is then a function giving the temperature at arrays of positions (x, y, z).
+    """
+    def __init__(self, dem, lakes, dirs, rivers, offset_x, offset_y, blocksize=12, sea_level=1, min_catchment=25, max_catchment=40000,
+                 riverbed_slope=0.4, center=False, glaciers=False, glacier_factor=8, temperature=None):
+        self.dem = dem
+        self.lakes = lakes
+        self.dirs = dirs
+        self.rivers = rivers
+        self.offset_x = offset_x
+        self.offset_y = offset_y
+        (self.Z, self.X) = dem.shape
+
+        self.settings = dict(blocksize=blocksize, sea_level=sea_level, min_catchment=min_catchment, max_catchment=max_catchment,
+                             riverbed_slope=riverbed_slope, center=center, glaciers=glaciers, glacier_factor=glacier_factor)
+        self.blocksize = blocksize
+        self.sea_level = sea_level
+        self.min_catchment = min_catchment
+        self.riverbed_slope = riverbed_slope * blocksize
+        self.glacier_factor = glacier_factor
+        self.temperature = temperature if glaciers else None
+        if glaciers and temperature is None:
+            raise ValueError('Glaciers need a temperature function')
+
+        self.map_offset = (blocksize*self.X/2, blocksize*self.Z/2) if center else (0, 0)
+
+        # Width coefficients, see polygons.lua
+        self.wpower = np.log(2*blocksize)/np.log(max_catchment/min_catchment)
+        self.wfactor = 1 / max_catchment ** self.wpower
+
+    @classmethod
+    def from_dir(cls, dirname, **settings):
+        """
+        Load a grid directory (as written by generate.py, in flat or tiled format).
+        """
+        shape = tuple(np.loadtxt(os.path.join(dirname, 'size'), dtype='u4'))
+        grids = {field: load_grid(os.path.join(dirname, field), dtype, shape) for field, dtype in grid_fields.items()}
+        return cls(**grids, **settings)
+
+    def river_width(self, flow):
+        flow = np.abs(flow.astype(np.float64))
+        with np.errstate(divide='ignore'):
+            width = np.minimum(self.wfactor * flow ** self.wpower, 1)
+        return np.where(flow < self.min_catchment, 0, width)
+
+    def polygon_range(self, minp, maxp):
+        """
+        Range of polygons (grid cells) that can cover the rectangle of nodes, as (xpmin, xpmax, zpmin, zpmax), included.
+        """
+        bs = self.blocksize
+        mx, mz = self.map_offset
+        xpmin = max(int(np.floor((minp[0]+mx)/bs - 0.5)), 0)
+        xpmax = min(int(np.ceil((maxp[0]+mx)/bs + 0.5)), self.X-2)
+        zpmin = max(int(np.floor((minp[1]+mz)/bs - 0.5)), 0)
+        zpmax = min(int(np.ceil((maxp[1]+mz)/bs + 0.5)), self.Z-2)
+        return xpmin, xpmax, zpmin, zpmax
+
+    def make_polygons(self, xpmin, xpmax, zpmin, zpmax):
+        """
+        Data of polygons xpmin to xpmax, zpmin to zpmax (included), as a dict of arrays indexed [zp-zpmin, xp-xpmin, ...].
+        Vertices are given in the order A (xp, zp), B (xp+1, zp), C (xp+1, zp+1), D (xp, zp+1).
+        """
+        bs = self.blocksize
+        mx, mz = self.map_offset
+        zs, xs = slice(zpmin, zpmax+2), slice(xpmin, xpmax+2)
+        xp = np.arange(xpmin, xpmax+1, dtype=np.float64)[None,:]
+        zp = np.arange(zpmin, zpmax+1, dtype=np.float64)[:,None]
+
+        def corners(grid):
+            g = grid[zs, xs]
+            return np.stack((g[:-1,:-1], g[:-1,1:], g[1:,1:], g[1:,:-1]), axis=-1)
+
+        ox = (corners(self.offset_x).astype(np.float64) + 0.5) / 256
+        oz = (corners(self.offset_y).astype(np.float64) + 0.5) / 256
+        # Same operations as in polygons.lua: (offset+xp)+1 is not always equal to offset+(xp+1) in floating point
+        poly_x = np.stack((
+            (ox[...,0]+xp)   * bs - mx,
+            (ox[...,1]+xp+1) * bs - mx,
+            (ox[...,2]+xp+1) * bs - mx,
+            (ox[...,3]+xp)   * bs - mx,
+        ), axis=-1)
+        poly_z = np.stack((
+            (oz[...,0]+zp)   * bs - mz,
+            (oz[...,1]+zp)   * bs - mz,
+            (oz[...,2]+zp+1) * bs - mz,
+            (oz[...,3]+zp+1) * bs - mz,
+        ), axis=-1)
+
+        # Edges X=aZ+b, spanning integer Z positions lo to hi
+        x1, x2 = poly_x[...,[e[0] for e in edges]], poly_x[...,[e[1] for e in edges]]
+        z1, z2 = poly_z[...,[e[0] for e in edges]], poly_z[...,[e[1] for e in edges]]
+        lo = np.floor(np.minimum(z1, z2)) + 1
+        hi = np.floor(np.maximum(z1, z2))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            a = np.where(lo <= hi, (x1-x2) / (z1-z2), 0)
+            b = np.where(lo <= hi, x1 - a*z1, 0)
+
+        dem = corners(self.dem).astype(np.float64)
+        lake = corners(self.lakes).astype(np.float64)
+        river = self.river_width(corners(self.rivers))
+        if self.temperature is not None:
+            # Widen glacier rivers
+            cold = self.temperature(poly_x, dem, poly_z) < 0
+            river = np.where(cold, np.minimum(river*self.glacier_factor, 1), river)
+        riverA, riverB, riverC, riverD = np.moveaxis(river, -1, 0)
+
+        # River flux on the edges, from flow directions
+        dirA, dirB, dirC, dirD = np.moveaxis(corners(self.dirs), -1, 0)
+        river_corners = np.stack((riverA, 1-riverB, 2-riverC, 1-riverD), axis=-1)
+        river_edges = np.stack((
+            np.where(dirA==1, riverA, 0) + np.where(dirD==3, riverD, 0),
+            np.where(dirA==2, riverA, 0) + np.where(dirB==4, riverB, 0),
+            1 - np.where(dirB==1, riverB, 0) - np.where(dirC==3, riverC, 0),
+            1 - np.where(dirD==2, riverD, 0) - np.where(dirC==4, riverC, 0),
+        ), axis=-1)
+
+        return dict(x=poly_x, z=poly_z, a=a, b=b, lo=lo, hi=hi, dem=dem, lake=lake, river_corners=river_corners, rivers=river_edges)
+
+    def locate(self, minp, maxp, polygons):
+        """
+        Polygon in which every node of the rectangle falls, as an array of indices in the flattened arrays of 'polygons', -1 where there is none.
+        Polygons are rasterized with the scanline algorithm of polygons.lua, all at once, and where they overlap, the last one in the order of polygons.lua wins.
+        """
+        shape = (maxp[1]-minp[1]+1, maxp[0]-minp[0]+1)
+        (nzp, nxp) = polygons['a'].shape[:2]
+        # Order of polygons.lua: X outer loop, Z inner loop
+        order = np.arange(nzp*nxp).reshape(nzp, nxp).T.ravel()
+        poly_z = polygons['z'].reshape(-1, 4)[order]
+        a, b, lo, hi = [polygons[name].reshape(-1, 4)[order,None,:] for name in ('a', 'b', 'lo', 'hi')]
+
+        # Z positions covered by every polygon
+        zmin = np.maximum(np.floor(poly_z.min(axis=1))+1, minp[1])
+        zmax = np.minimum(np.floor(poly_z.max(axis=1)), maxp[1])
+        rows = max(int((zmax-zmin).max(initial=-1))+1, 0)
+        z = zmin[:,None] + np.arange(rows)
+        ze = z[...,None]
+
+        # Intercepts of edges for every Z position, sorted
+        spans = (lo <= ze) & (ze <= hi)
+        bounds = np.where(spans, a*ze + b, np.inf)
+        bounds.sort(axis=-1)
+        n = np.where(z <= zmax[:,None], spans.sum(axis=-1), 0)
+
+        # Take pairs of X coordinates: all positions between them belong to the polygon
+        xmin = np.maximum(np.floor(bounds[...,0::2])+1, minp[0])
+        xmax = np.minimum(np.floor(bounds[...,1::2]), maxp[0])
+        valid = (n[...,None] >= [2, 4]) & (xmin <= xmax)
+        poly_id = np.broadcast_to(order[:,None,None], valid.shape)[valid]
+        length = (xmax - xmin + 1)[valid].astype(np.intp)
+        start = ((np.broadcast_to(ze, valid.shape)[valid] - minp[1]) * shape[1] + xmin[valid] - minp[0]).astype(np.intp)
+
+        # Fill the spans, in order
+        ends = np.cumsum(length)
+        nodes = np.arange(ends[-1] if len(ends) else 0) + np.repeat(start - (ends - length), length)
+        located = np.full(shape, -1, dtype=np.intp)
+        located.ravel()[nodes] = np.repeat(poly_id, length)
+        return located
+
+    def heightmaps(self, minp, maxp):
+        """
+        Terrain and lake heightmaps of the rectangle of nodes minp to maxp (included), as int32 arrays indexed [z-minp.z, x-minp.x].
+        Nodes that fall in no polygon (outside the grid) are at MAP_BOTTOM.
+        """
+        xpmin, xpmax, zpmin, zpmax = self.polygon_range(minp, maxp)
+        shape = (maxp[1]-minp[1]+1, maxp[0]-minp[0]+1)
+        terrain = np.full(shape, MAP_BOTTOM, dtype=np.int32)
+        lake = np.full(shape, MAP_BOTTOM, dtype=np.int32)
+        if xpmin > xpmax or zpmin > zpmax:
+            return terrain, lake
+
+        polygons = self.make_polygons(xpmin, xpmax, zpmin, zpmax)
+        located = self.locate(minp, maxp, polygons)
+        found = located >= 0
+        # Data of the polygon of every node, gathered all at once
+        fields = ('x', 'z', 'rivers', 'river_corners', 'dem', 'lake')
+        packed = np.concatenate([polygons[name].reshape(-1, 4).T for name in fields])
+        data = dict(zip(fields, np.split(packed.take(located[found], axis=1), len(fields))))
+        z, x = np.nonzero(found)
+        x = (x + minp[0]).astype(np.float64)
+        z = (z + minp[1]).astype(np.float64)
+
+        xf, zf = transform_quadri(data['x'], data['z'], x, z)
+        r_west, r_north, r_east, r_south = data['rivers']
+        c_NW, c_NE, c_SE, c_SW = data['river_corners']
+
+        # Depth factor for each edge and corner: < 0 outside river, = 0 on riverbank, > 0 inside river
+        depth_factors = (
+            r_west - xf,
+            r_north - zf,
+            xf - r_east,
+            zf - r_south,
+            c_NW-xf-zf,
+            xf-zf-c_NE,
+            xf+zf-c_SE,
+            zf-xf-c_SW,
+        )
+
+        # Find the maximal depth factor and determine to which river it belongs
+        depth_factor_max = np.zeros(x.shape)
+        imax = np.zeros(x.shape, dtype=int)
+        for i, factor in enumerate(depth_factors):
+            higher = factor >= depth_factor_max
+            depth_factor_max[higher] = factor[higher]
+            imax[higher] = i+1
+
+        # Transform the coordinates to have xf and zf = 0 or 1 in rivers
+        with np.errstate(divide='ignore', invalid='ignore'):
+            x0 = np.maximum(np.maximum(r_west, c_NW-zf), zf-c_SW)
+            x1 = np.minimum(np.minimum(r_east, c_NE+zf), c_SE-zf)
+            z0 = np.maximum(np.maximum(r_north, c_NW-xf), xf-c_NE)
+            z1 = np.minimum(np.minimum(r_south, c_SW+xf), c_SE-xf)
+            xf_bank = (xf-x0) / (x1-x0)
+            zf_bank = (zf-z0) / (z1-z0)
+        xf = np.select([imax==0, np.isin(imax, (1, 5, 8)), np.isin(imax, (3, 6, 7))], [xf_bank, 0, 1], xf)
+        zf = np.select([imax==0, np.isin(imax, (2, 5, 6)), np.isin(imax, (4, 7, 8))], [zf_bank, 0, 1], zf)
+
+        # Elevation by interpolation
+        vdem = data['dem']
+        terrain_height = np.floor(0.5 + _interp(*vdem, xf, zf))
+
+        # Lake height from the corner toward which the interpolation slopes down
+        slope_x = zf*(vdem[2]-vdem[3]) + (1-zf)*(vdem[1]-vdem[0]) < 0
+        slope_z = xf*(vdem[2]-vdem[1]) + (1-xf)*(vdem[3]-vdem[0]) < 0
+        lake_id = np.where(slope_x, np.where(slope_z, 2, 1), np.where(slope_z, 3, 0))
+        lake_height = np.maximum(np.floor(np.take_along_axis(data['lake'], lake_id[None,:], axis=0)[0]), terrain_height)
+
+        river = (imax > 0) & (depth_factor_max > 0)
+        river_bed = np.maximum(lake_height, self.sea_level) - np.floor(1+depth_factor_max*self.riverbed_slope)
+        terrain_height = np.where(river, np.minimum(river_bed, terrain_height), terrain_height)
+
+        terrain[found] = terrain_height
+        lake[found] = lake_height
+        return terrain, lake
+
+    @contextmanager
+    def renderer(self, workers=1):
+        """
+        Context giving a function render(minp, maxp, tile_size) that computes heightmaps of large rectangles by tiles of 'tile_size' nodes, in parallel if 'workers' > 1.
+        Grids are copied in shared memory once, for all the calls in the context.
+        """
+        executor = get_executor(workers)
+        if executor is None:
+            yield lambda minp, maxp, tile_size=256: _assemble(minp, maxp, tile_size, lambda tiles: (self.heightmaps(*tile) for tile in tiles))
+            return
+
+        grids = [SharedArray.copy_of(grid) for grid in (self.dem, self.lakes, self.dirs, self.rivers, self.offset_x, self.offset_y)]
+        try:
+            descs = [g.desc for g in grids]
+            settings = dict(self.settings, temperature=self.temperature)
+            yield lambda minp, maxp, tile_size=256: _assemble(minp, maxp, tile_size, lambda tiles: executor.map(_render_tile, [(descs, settings, tile) for tile in tiles]))
+        finally:
+            for g in grids:
+                g.close()
+
+    def render(self, minp, maxp, tile_size=256, workers=1):
+        """
+        Same as heightmaps, for large rectangles: computed by tiles of 'tile_size' nodes, in parallel if 'workers' > 1.
+        The result does not depend on the tile size.
+        """
+        with self.renderer(workers) as render:
+            return render(minp, maxp, tile_size)
+
+def _assemble(minp, maxp, tile_size, compute):
+    # Cut a rectangle into tiles, compute them with compute(tiles) and assemble the results
+    shape = (maxp[1]-minp[1]+1, maxp[0]-minp[0]+1)
+    tiles = [((minp[0]+x0, minp[1]+z0), (minp[0]+min(x0+tile_size, shape[1])-1, minp[1]+min(z0+tile_size, shape[0])-1))
+             for z0 in range(0, shape[0], tile_size) for x0 in range(0, shape[1], tile_size)]
+    terrain = np.empty(shape, dtype=np.int32)
+    lake = np.empty(shape, dtype=np.int32)
+    for ((x0, z0), (x1, z1)), result in zip(tiles, compute(tiles)):
+        sz, sx = slice(z0-minp[1], z1-minp[1]+1), slice(x0-minp[0], x1-minp[0]+1)
+        terrain[sz,sx], lake[sz,sx] = result
+    return terrain, lake
+
+def _render_tile(task):
+    descs, settings, (minp, maxp) = task
+    grids = [SharedArray.attach(desc) for desc in descs]
+    result = Heightmaps(*[g.array for g in grids], **settings).heightmaps(minp, maxp)
+    for g in grids:
+        g.close()
+    return result
+
+def bake_heightmaps(dirname, tile_size=80, chunk_origin=-32, level=9, workers=1, **settings):
+    """
+    Pre-compute the node heightmaps of the whole map from the grid in 'dirname', for the mod to read them instead of computing polygons.
+    Terrain and lake heights are saved as int16 in tiled format ('terrain_map' and 'lake_map'), and an index file 'heightmaps' gives their position and the settings they were made with.
+    Tiles are aligned with map chunks, that start at 'chunk_origin' (-32 by default in Minetest): with 'tile_size' equal to the size of chunks (80 by default), every chunk reads one tile.
+    'settings' are mod settings (see Heightmaps). Glaciers are not supported.
+    """
+    if settings.get('glaciers'):
+        raise ValueError('Heightmaps with glaciers cannot be pre-baked')
+    hm = Heightmaps.from_dir(dirname, **settings)
+    bs = hm.blocksize
+    mx, mz = hm.map_offset
+
+    # Rectangle covering all polygons (offsets are less than half a cell), extended to the previous chunk boundary
+    xmin = int(np.floor(-bs/2 - mx))
+    zmin = int(np.floor(-bs/2 - mz))
+    xmin -= (xmin - chunk_origin) % tile_size
+    zmin -= (zmin - chunk_origin) % tile_size
+    xsize = int(np.ceil((hm.X-0.5)*bs - mx)) - xmin + 1
+    zsize = int(np.ceil((hm.Z-0.5)*bs - mz)) - zmin + 1
+
+    shape = (zsize, xsize)
+    with hm.renderer(workers) as render, \
+         TiledWriter(os.path.join(dirname, 'terrain_map'), shape, '>i2', tile_size=tile_size, level=level) as terrain_file, \
+         TiledWriter(os.path.join(dirname, 'lake_map'), shape, '>i2', tile_size=tile_size, level=level) as lake_file:
+        for z0 in range(zmin, zmin+zsize, tile_size):
+            z1 = min(z0+tile_size, zmin+zsize) - 1
+            terrain, lake = render((xmin, z0), (xmin+xsize-1, z1))
+            terrain_file.write_rows(np.clip(terrain, -32768, 32767))
+            lake_file.write_rows(np.clip(lake, -32768, 32767))
+
+    index = dict(version=1, xmin=xmin, zmin=zmin, xsize=xsize, zsize=zsize, **hm.settings)
+    with open(os.path.join(dirname, 'heightmaps'), 'w') as f:
+        for key, value in index.items():
+            if key not in ('glaciers', 'glacier_factor'):
+                f.write('{} = {}\n'.format(key, str(value).lower() if isinstance(value, bool) else value))
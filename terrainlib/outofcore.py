@@ -0,0 +1,60 @@
+import numpy as np
+import os
+import sys
+from collections import defaultdict
+
+try:
+    import resource
+except ImportError: # Not available on Windows
+    resource = None
+
+# Helpers for the out-of-core mode: grids stored in memory-mapped scratch files, and memory usage reporting.
+
+class ScratchSpace:
+    """
+    Allocate grids as memory-mapped .npy files in a directory.
+    Every name alternates between two files, so that a new version of a grid can be computed from the previous one.
+    """
+    def __init__(self, dirname):
+        os.makedirs(dirname, exist_ok=True)
+        self.dirname = dirname
+        self.count = defaultdict(int)
+
+    def empty(self, name, shape, dtype):
+        i = self.count[name] % 2
+        self.count[name] += 1
+        fname = os.path.join(self.dirname, '{}.{:d}.npy'.format(name, i))
+        return np.lib.format.open_memmap(fname, mode='w+', dtype=dtype, shape=tuple(shape))
+
+    def owns(self, array):
+        """
+        Whether 'array' is a grid allocated in this scratch space.
+        """
+        return isinstance(array, np.memmap) and array.filename is not None and os.path.dirname(os.path.abspath(array.filename)) == os.path.abspath(self.dirname)
+
+def peak_rss():
+    """
+    Peak resident memory of the process in bytes, since start or since the last call to reset_peak_rss.
+    """
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    # Fallback: maximal RSS since process start (in kB on Linux, bytes on macOS)
+    if resource is None:
+        return 0
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+def reset_peak_rss():
+    """
+    Reset the peak resident memory counter to the current value (Linux only, no effect elsewhere).
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
@@ -0,0 +1,156 @@
+import numpy as np
+import atexit
+import functools
+import os
+import multiprocessing as mp
+from multiprocessing import shared_memory, resource_tracker
+from concurrent.futures import ProcessPoolExecutor
+
+from .profiling import profiler
+
+# Helpers to run parts of the pipeline in several processes.
+# Worker processes are forked, so that the calling script is not imported again in them. Where fork is not available, everything runs serially.
+# Arrays are exchanged through shared memory to avoid copying them for every task.
+
+def _timed(func, *args):
+    # Run a task and give the CPU time it took in the worker process, with its result
+    t0 = os.times()
+    result = func(*args)
+    t1 = os.times()
+    return (t1.user - t0.user) + (t1.system - t0.system), result
+
+class _Pool(ProcessPoolExecutor):
+    """
+    Process pool whose tasks report their CPU time to the profiler, when it is enabled.
+    os.times() only counts the CPU time of child processes that have been waited for, and pool workers are only waited for when the pool is shut down.
+    """
+    def map(self, fn, *iterables, **kwargs):
+        if not profiler.enabled:
+            return super().map(fn, *iterables, **kwargs)
+        return self._add_cpu(super().map(functools.partial(_timed, fn), *iterables, **kwargs))
+
+    @staticmethod
+    def _add_cpu(results):
+        for cpu, result in results:
+            profiler.add_cpu(cpu)
+            yield result
+
+_pools = {}
+_pools_pid = None
+
+def get_executor(workers):
+    """
+    Give a process pool with 'workers' processes, or None if tasks should run serially.
+    Pools are created on first use and shared by all later calls, as forking worker processes at every call would cost more than the work on small grids.
+    They must not be shut down by callers: this is done at exit, or by shutdown_executors.
+    """
+    global _pools_pid
+    if workers > 1 and 'fork' in mp.get_all_start_methods():
+        if _pools_pid != os.getpid():
+            _pools.clear() # Pools of the parent process, in a forked process
+            _pools_pid = os.getpid()
+        if workers not in _pools:
+            resource_tracker.ensure_running() # Shared by worker processes, so that shared memory attached by them is not seen as leaked
+            _pools[workers] = _Pool(max_workers=workers, mp_context=mp.get_context('fork'))
+        return _pools[workers]
+    return None
+
+def shutdown_executors():
+    """
+    Shut down the process pools given by get_executor.
+    """
+    if _pools_pid == os.getpid():
+        for pool in _pools.values():
+            pool.shutdown()
+    _pools.clear()
+
+atexit.register(shutdown_executors)
+
+class SharedArray:
+    """
+    NumPy array stored in shared memory. Pass 'desc' to worker processes and attach it there with SharedArray.attach.
+    """
+    def __init__(self, shape, dtype, name=None):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        if name is None:
+            size = max(int(np.prod(self.shape)) * self.dtype.itemsize, 1)
+            self.shm = shared_memory.SharedMemory(create=True, size=size)
+            self.owner = True
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+            self.owner = False
+        self.array = np.ndarray(self.shape, dtype=self.dtype, buffer=self.shm.buf)
+
+    @classmethod
+    def copy_of(cls, array):
+        shared = cls(array.shape, array.dtype)
+        shared.array[...] = array
+        return shared
+
+    @classmethod
+    def attach(cls, desc):
+        return cls(*desc)
+
+    @property
+    def desc(self):
+        return (self.shape, self.dtype.str, self.shm.name)
+
+    def close(self):
+        del self.array
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+def _run_band(task):
+    func, descs, out_desc, x0, x1, halo, kwargs = task
+    inputs = [SharedArray.attach(desc) for desc in descs]
+    out = SharedArray.attach(out_desc)
+    X = out.shape[0]
+    lo, hi = max(x0-halo, 0), min(x1+halo, X)
+    result = func(*[a.array[lo:hi] for a in inputs], **kwargs)
+    out.array[x0:x1] = result[x0-lo:x1-lo]
+    del result
+    for a in inputs + [out]:
+        a.close()
+
+def run_bands(func, arrays, dtype, halo=0, workers=1, band=None, kwargs={}, out=None):
+    """
+    Apply 'func' on bands of rows of 'arrays' (all with the same number of rows), in parallel, and assemble the results.
+    Every band is given 'halo' more rows on each side, that are cropped from the result: func(*bands, **kwargs) must return an array with as many rows as its inputs.
+    'func' must be defined at module level.
+    In a single process, arrays are processed as a whole, or band by band if 'band' is given (to limit memory usage).
+    The result is written in 'out' if provided.
+    """
+    X = arrays[0].shape[0]
+    executor = get_executor(workers)
+    if executor is None:
+        if band is None:
+            result = func(*arrays, **kwargs)
+            if out is None:
+                return result
+            out[...] = result
+            return out
+
+        if out is None:
+            out = np.empty(arrays[0].shape, dtype=dtype)
+        for x0 in range(0, X, band):
+            x1 = min(x0+band, X)
+            lo, hi = max(x0-halo, 0), min(x1+halo, X)
+            out[x0:x1] = func(*[a[lo:hi] for a in arrays], **kwargs)[x0-lo:x1-lo]
+        return out
+
+    if band is None:
+        band = -(-X // workers)
+    inputs = [SharedArray.copy_of(a) for a in arrays]
+    shared_out = SharedArray(arrays[0].shape, dtype)
+    try:
+        tasks = [(func, [a.desc for a in inputs], shared_out.desc, x0, min(x0+band, X), halo, kwargs) for x0 in range(0, X, band)]
+        list(executor.map(_run_band, tasks))
+        if out is None:
+            return shared_out.array.copy()
+        out[...] = shared_out.array
+        return out
+    finally:
+        for a in inputs + [shared_out]:
+            a.close()
@@ -0,0 +1,160 @@
+import numpy as np
+import os
+
+from .erosion import EvolutionModel
+from .simplex import noisemap, snoise2
+from .bounds import direction_masks, make_bounds, twist, get_fixed
+from .save import save_grids
+from .heightmap import bake_heightmaps
+from .profiling import stage
+
+# Grid generation process shared by generate.py and sweep.py: settings, initial topography, iterations of the landscape evolution model, twist and output.
+
+def _flag(value):
+    # Flags can be given without value
+    return value.lower() in ('', 'true', 'yes', '1')
+
+# Settings of the process, with their type and default value
+setting_types = {
+    'mapsize': (int, 1000),
+    'scale': (float, 400.0),
+    'vscale': (float, 300.0),
+    'offset': (float, 0.0),
+    'persistence': (float, 0.6),
+    'lacunarity': (float, 2.0),
+    'noise_method': (str, 'numpy'),
+    'K': (float, 0.5),
+    'm': (float, 0.5),
+    'd': (float, 0.5),
+    'sea_level': (float, 0.0),
+    'sea_level_variations': (float, 0.0),
+    'sea_level_variations_time': (float, 1.0),
+    'flex_radius': (float, 20.0),
+    'flow_method': (str, 'semirandom'),
+    'basin_method': (str, 'kruskal'),
+    'advection_method': (str, 'vectorized'),
+    'incremental_flow': (_flag, 'false'),
+    'max_flow_change': (float, 0.1),
+    'workers': (int, 1),
+    'time': (float, 10.0),
+    'niter': (int, 10),
+    'compact': (_flag, 'false'),
+    'twist_steps': (int, 5),
+    'twist_tol': (float, 0.0),
+    'tile_size': (int, 64), # 0 for flat format
+    'compression_level': (int, 9),
+    'heightmaps': (_flag, 'false'),
+}
+
+# Parameters determining the initial noise map (except its offset, that is added afterwards)
+noise_settings = ('mapsize', 'scale', 'vscale', 'persistence', 'lacunarity', 'noise_method')
+
+sea_level_noise = {
+    "octaves" : 1,
+    "persistence" : 1,
+    "lacunarity" : 2,
+}
+
+def read_settings(params):
+    """
+    Settings of the process from a dict of parameters given as strings (config file or command line), with default values for the missing ones.
+    """
+    return {name: convert(params.get(name, default)) for name, (convert, default) in setting_types.items()}
+
+def random_bases(rng):
+    """
+    Draw the noise bases of a grid from 'rng': sea level variations, then X and Y of the initial topography.
+    """
+    return tuple(int(rng.integers(-4096, 4096)) for i in range(3))
+
+def sea_level_reference(s, sea_ybase):
+    """
+    Sea level variation at the end of the process, or None if sea level does not vary.
+    """
+    if s['sea_level_variations'] == 0.0:
+        return None
+    return snoise2(s['time'] * (1-1/s['niter']) / s['sea_level_variations'], sea_ybase, **sea_level_noise) * s['sea_level_variations']
+
+def initial_noise(s, xbase, ybase, workers=1):
+    """
+    Initial topography, without its offset (see initial_offset).
+    """
+    size = s['mapsize']+1
+    return noisemap(size, size, scale=s['scale'], vscale=s['vscale'], offset=0.0, octaves=int(np.ceil(np.log2(s['mapsize'])))+1,
+        persistence=s['persistence'], lacunarity=s['lacunarity'], xbase=xbase, ybase=ybase, method=s['noise_method'], workers=workers)
+
+def initial_offset(s, sea_level_ref):
+    """
+    Offset of the initial topography, so that the final sea level is 'sea_level'.
+    """
+    if sea_level_ref is None:
+        return s['offset']
+    return s['offset'] - (sea_level_ref + s['sea_level'])
+
+def make_model(dem, s, **kwargs):
+    """
+    Landscape evolution model with the settings 's'. Other arguments of EvolutionModel can be given (they prevail).
+    """
+    args = dict(K=s['K'], m=s['m'], d=s['d'], sea_level=s['sea_level'], flex_radius=s['flex_radius'], flow_method=s['flow_method'], basin_method=s['basin_method'],
+        advection_method=s['advection_method'], workers=s['workers'], compact=s['compact'], incremental_flow=s['incremental_flow'], max_flow_change=s['max_flow_change'])
+    args.update(kwargs)
+    return EvolutionModel(dem, **args)
+
+def evolve(model, s, sea_ybase, sea_level_ref, start=0):
+    """
+    Run the iterations of the model from iteration 'start'. The order in which the processes are run is arbitrary and could be changed.
+    Generator yielding (i, process) before every process of iteration i ('diffusion', 'flow', 'advection', 'isostasy'), and (i+1, 'done') at its end, so that the caller can report progress or save the state.
+    """
+    dt = s['time'] / s['niter']
+    for i in range(start, s['niter']):
+        if s['sea_level_variations'] != 0:
+            model.sea_level = snoise2((i*dt)/s['sea_level_variations_time'], sea_ybase, **sea_level_noise) * s['sea_level_variations'] - sea_level_ref
+        yield i, 'diffusion'
+        model.diffusion(dt)
+        yield i, 'flow'
+        model.calculate_flow()
+        yield i, 'advection'
+        model.advection(dt)
+        yield i, 'isostasy'
+        model.adjust_isostasy()
+        yield i+1, 'done'
+
+def twist_model(model, s):
+    """
+    Twist the grid along rivers. Returns the offsets and the list of residuals of every step.
+    """
+    masks = direction_masks(model.dirs)
+    bx, by = make_bounds(model.dirs, model.rivers, masks)
+    return twist(bx, by, get_fixed(model.dirs, masks), n=s['twist_steps'], tol=s['twist_tol'], return_history=True)
+
+def save_model(dirname, model, offset_x, offset_y, s):
+    """
+    Save the grid in directory 'dirname', and bake heightmaps if enabled.
+    """
+    # Convert offset in 8-bits
+    offset_x = np.clip(np.floor(offset_x * 256), -128, 127)
+    offset_y = np.clip(np.floor(offset_y * 256), -128, 127)
+
+    os.makedirs(dirname, exist_ok=True)
+    with stage('save'):
+        save_grids([
+            (model.dem, os.path.join(dirname, 'dem'), '>i2'),
+            (model.lakes, os.path.join(dirname, 'lakes'), '>i2'),
+            (offset_x, os.path.join(dirname, 'offset_x'), 'i1'),
+            (offset_y, os.path.join(dirname, 'offset_y'), 'i1'),
+            (model.dirs, os.path.join(dirname, 'dirs'), 'u1'),
+            (model.rivers, os.path.join(dirname, 'rivers'), '>u4'),
+        ], tile_size=s['tile_size'], level=s['compression_level'])
+
+    with open(os.path.join(dirname, 'size'), 'w') as sfile:
+        sfile.write('{:d}\n{:d}'.format(s['mapsize']+1, s['mapsize']+1))
+
+    if s['heightmaps']:
+        with stage('heightmaps'):
+            bake_heightmaps(dirname, level=s['compression_level'], workers=s['workers'])
+    else:
+        # Remove heightmaps baked from a previous grid
+        for fname in ('heightmaps', 'terrain_map', 'lake_map'):
+            fname = os.path.join(dirname, fname)
+            if os.path.isfile(fname):
+                os.remove(fname)
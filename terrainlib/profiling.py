@@ -0,0 +1,160 @@
+import os
+import time
+import json
+import csv
+import functools
+
+from .outofcore import peak_rss, reset_peak_rss
+
+# Stage-level instrumentation: wall time, CPU time (including worker processes), peak resident memory and item counts.
+# Stages are nested, and named by their path, e.g. 'calculate_flow/flow/basins'.
+# Disabled by default: then stage() returns a shared no-op context and count() returns immediately.
+
+def _cpu_time():
+    t = os.times()
+    return t.user + t.system + t.children_user + t.children_system
+
+class _NullStage:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+_null_stage = _NullStage()
+
+class _Stage:
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.counts = {}
+
+    def __enter__(self):
+        stack = self.profiler.stack
+        if stack:
+            parent = stack[-1]
+            parent.peak = max(parent.peak, peak_rss())
+            self.path = parent.path + '/' + self.name
+        else:
+            self.path = self.name
+        stack.append(self)
+        reset_peak_rss()
+        self.peak = 0
+        self.worker_cpu = 0.0
+        self.cpu = _cpu_time()
+        self.wall = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        wall = time.perf_counter() - self.wall
+        cpu = _cpu_time() - self.cpu + self.worker_cpu
+        self.peak = max(self.peak, peak_rss())
+        stack = self.profiler.stack
+        stack.pop()
+        if stack:
+            stack[-1].peak = max(stack[-1].peak, self.peak)
+        self.profiler.records.append({
+            'stage': self.path,
+            'start': self.wall - self.profiler.t0,
+            'wall': wall,
+            'cpu': cpu,
+            'peak_rss': self.peak,
+            'counts': self.counts,
+        })
+
+class Profiler:
+    def __init__(self):
+        self.enabled = False
+        self.records = []
+        self.stack = []
+        self.t0 = time.perf_counter()
+
+    def enable(self):
+        self.enabled = True
+        self.t0 = time.perf_counter()
+
+    def stage(self, name):
+        """
+        Context manager measuring a stage.
+        """
+        if not self.enabled:
+            return _null_stage
+        return _Stage(self, name)
+
+    def count(self, **counts):
+        """
+        Add item counts to the innermost running stage.
+        """
+        if not self.enabled or not self.stack:
+            return
+        stage_counts = self.stack[-1].counts
+        for key, value in counts.items():
+            stage_counts[key] = stage_counts.get(key, 0) + int(value)
+
+    def add_cpu(self, seconds):
+        """
+        Add CPU time spent in worker processes of a pool (see parallel.py) to the running stages.
+        """
+        for s in self.stack:
+            s.worker_cpu += seconds
+
+    def summary(self):
+        """
+        Records aggregated by stage, in order of first appearance: number of calls, total wall and CPU times, maximal peak memory, summed counts.
+        """
+        stages = {}
+        for record in sorted(self.records, key=lambda r: r['start']):
+            s = stages.setdefault(record['stage'], {'stage': record['stage'], 'calls': 0, 'wall': 0.0, 'cpu': 0.0, 'peak_rss': 0, 'counts': {}})
+            s['calls'] += 1
+            s['wall'] += record['wall']
+            s['cpu'] += record['cpu']
+            s['peak_rss'] = max(s['peak_rss'], record['peak_rss'])
+            for key, value in record['counts'].items():
+                s['counts'][key] = s['counts'].get(key, 0) + value
+        return list(stages.values())
+
+    def write(self, prefix, **info):
+        """
+        Write all records and the summary in prefix.json, and the summary in prefix.csv.
+        Keyword arguments are stored as run information in the JSON file.
+        """
+        summary = self.summary()
+        with open(prefix + '.json', 'w') as f:
+            json.dump({'info': info, 'summary': summary, 'records': self.records}, f, indent=1)
+
+        count_keys = sorted({key for s in summary for key in s['counts']})
+        with open(prefix + '.csv', 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['stage', 'calls', 'wall', 'cpu', 'peak_rss'] + count_keys)
+            for s in summary:
+                writer.writerow([s['stage'], s['calls'], '{:.6f}'.format(s['wall']), '{:.6f}'.format(s['cpu']), s['peak_rss']] + [s['counts'].get(key, '') for key in count_keys])
+
+    def print_summary(self):
+        print('{:<44} {:>6} {:>10} {:>10} {:>10}  {}'.format('Stage', 'Calls', 'Wall (s)', 'CPU (s)', 'Peak (MB)', 'Counts'))
+        for s in self.summary():
+            depth = s['stage'].count('/')
+            name = '  ' * depth + s['stage'].rsplit('/', 1)[-1]
+            counts = ', '.join('{}={:d}'.format(key, value) for key, value in s['counts'].items())
+            print('{:<44} {:>6d} {:>10.3f} {:>10.3f} {:>10.0f}  {}'.format(name, s['calls'], s['wall'], s['cpu'], s['peak_rss'] / 2**20, counts))
+
+profiler = Profiler()
+
+def stage(name):
+    return profiler.stage(name)
+
+def count(**counts):
+    profiler.count(**counts)
+
+def profiled(name):
+    """
+    Decorator measuring every call of a function as a stage.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not profiler.enabled:
+                return func(*args, **kwargs)
+            with _Stage(profiler, name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -2,6 +2,9 @@ import numpy as np
 import numpy.random as npr
 from collections import defaultdict
 
+from .parallel import run_bands
+from .profiling import stage, count as profile_count
+
 # This file provide functions to construct the river tree from an elevation model.
 # Based on a research paper:
 #   | Cordonnier, G., Bovy, B., and Braun, J.:
@@ -13,76 +16,84 @@ from collections import defaultdict
 # Only flow_local and accumulate_flow are custom algorithms.
 
 # Define two different method for local flow routing
-def flow_local_steepest(plist):
-    vmax = 0.0
-    imax = 0.0
-    for i, p in enumerate(plist):
-        if p > vmax:
-            vmax = p
-            imax = i
-    if vmax > 0.0:
-        return imax+1
-    return 0
-
-def flow_local_semirandom(plist):
+# Both take an array of denivellations of shape (4, X, Y), one layer per direction, and return the flow directions for the whole grid
+def flow_local_steepest(drops, random=None):
+    """
+    Every node flows toward its steepest lower neighbour.
+    """
+    dirs = np.argmax(drops, axis=0) + 1
+    dirs[drops.max(axis=0) <= 0] = 0
+    return dirs
+
+def flow_local_semirandom(drops, random=None):
     """
     Determines a flow direction based on denivellation for every neighbouring node.
     Denivellation must be positive for downward and zero for flat or upward:
     dz = max(zref-z, 0)
+    'random' gives uniform random numbers in [0, 1) for every node; they are drawn if not provided.
     """
-    psum = sum(plist)
-    if psum == 0:
-        return 0
-    r = npr.random() * psum
-    for i, p in enumerate(plist):
-        if r < p:
-            return i+1
-        r -= p
+    cumdrops = np.cumsum(drops, axis=0)
+    psum = cumdrops[-1]
+    if random is None:
+        random = npr.random(psum.shape)
+    r = random * psum
+    dirs = np.argmax(r < cumdrops, axis=0) + 1
+    dirs[psum <= 0] = 0
+    return dirs
 
 flow_local_methods = {
     'steepest' : flow_local_steepest,
     'semirandom' : flow_local_semirandom,
 }
 
-def flow(dem, method='semirandom'):
-    if method in flow_local_methods:
-        flow_local = flow_local_methods[method]
-    else:
+def flow_dirs(dem, random=None, method='semirandom', dtype=int):
+    """
+    Give a flow direction to every node (0 for singular nodes), by the given method.
+    Denivellations are computed in the precision of 'dem'.
+    """
+    drops = np.zeros((4,)+dem.shape, dtype=dem.dtype)
+    np.subtract(dem[:-1,:], dem[1:,:], out=drops[0,:-1,:]) # 1: x -> x+1
+    np.subtract(dem[:,:-1], dem[:,1:], out=drops[1,:,:-1]) # 2: y -> y+1
+    np.subtract(dem[1:,:], dem[:-1,:], out=drops[2,1:,:])  # 3: x -> x-1
+    np.subtract(dem[:,1:], dem[:,:-1], out=drops[3,:,1:])  # 4: y -> y-1
+    np.maximum(drops, 0, out=drops)
+
+    return flow_local_methods[method](drops, random=random).astype(dtype, copy=False)
+
+def flow_local(dem, method='semirandom', workers=1, band=None, rng=None, dtype=int):
+    """
+    Flow locally: give a flow direction to every node (0 for singular nodes).
+    Returns flow directions, the donors of every node as a bitmask, and the list of singular nodes.
+    With several workers or if 'band' is given, the grid is processed by bands of rows; random numbers are drawn for the whole grid beforehand, so that the result does not depend on the number of workers.
+    Random numbers are drawn from 'rng' (a numpy.random.Generator), or from the global random generator if not given.
+    Directions and donor bitmasks are given as 'dtype'.
+    """
+    if method not in flow_local_methods:
         raise KeyError('Flow method \'{}\' does not exist'.format(method))
 
-    # Flow locally
-    dirs1 = np.zeros(dem.shape, dtype=int)
-    dirs2 = np.zeros(dem.shape, dtype=int)
+    arrays = [dem]
+    if method == 'semirandom':
+        arrays.append((npr if rng is None else rng).random(dem.shape))
+    dirs2 = run_bands(flow_dirs, arrays, dtype, halo=1, workers=workers, band=band, kwargs={'method': method, 'dtype': dtype})
+
+    bits = np.array([1, 2, 4, 8], dtype=dtype)
+    dirs1 = np.zeros(dem.shape, dtype=dtype)
+    dirs1[1:,:] |= (dirs2[:-1,:]==1) * bits[0]
+    dirs1[:,1:] |= (dirs2[:,:-1]==2) * bits[1]
+    dirs1[:-1,:] |= (dirs2[1:,:]==3) * bits[2]
+    dirs1[:,:-1] |= (dirs2[:,1:]==4) * bits[3]
+
+    singular = np.argwhere(dirs2==0)
+
+    return dirs2, dirs1, singular
+
+def boruvka_links(dem, dirs1, singular):
+    """
+    Compute basins, and the lowest pass between every pair of neighbouring basins.
+    Returns the basin index of every node, and the dict of links given to planar_boruvka.
+    """
     (X, Y) = dem.shape
     Xmax, Ymax = X-1, Y-1
-    singular = []
-    for x in range(X):
-        z0 = z1 = z2 = dem[x,0]
-        for y in range(Y):
-            z0 = z1
-            z1 = z2
-            if y < Ymax:
-                z2 = dem[x, y+1]
-
-            plist = [
-                max(z1-dem[x+1,y],0) if x<Xmax else 0, # 1: x -> x+1
-                max(z1-z2,0),                          # 2: y -> y+1
-                max(z1-dem[x-1,y],0) if x>0    else 0, # 3: x -> x-1
-                max(z1-z0,0),                          # 4: y -> y-1
-            ]
-            
-            pdir = flow_local(plist)
-            dirs2[x,y] = pdir
-            if pdir == 0:
-                singular.append((x,y))
-            elif pdir == 1:
-                dirs1[x+1,y] += 1
-            elif pdir == 2:
-                dirs1[x,y+1] += 2
-            elif pdir == 3:
-                dirs1[x-1,y] += 4
-            elif pdir == 4:
-                dirs1[x,y-1] += 8
 
     # Compute basins
     basin_id = np.zeros(dem.shape, dtype=int)
@@ -104,10 +115,7 @@ def flow(dem, method='semirandom'):
             if d & 8:
                 queue.append((x,y+1))
 
-    del dirs1
-
     # Link basins
-    nsing = len(singular)
     links = {}
     def add_link(b0, b1, elev, bound):
         b = (min(b0,b1),max(b0,b1))
@@ -133,13 +141,27 @@ def flow(dem, method='semirandom'):
             b0 = b1
         add_link(-1, b1, dem[Xmax,y], (False, X, y))
 
+    return basin_id, links
+
+def link_basins_boruvka(dem, dirs2, dirs1, singular):
+    """
+    Link basins using dictionaries and the Planar Boruvka algorithm.
+    Flow directions are modified in place so that every basin drains outside of the grid.
+    Returns the water level of every node.
+    """
+    (X, Y) = dem.shape
+    nsing = len(singular)
+    basin_id, links = boruvka_links(dem, dirs1, singular)
+    profile_count(basins=nsing, links=len(links))
+
     # Computing basin tree
-    graph = planar_boruvka(links)
+    with stage('boruvka'):
+        graph = planar_boruvka(links)
 
     basin_links = defaultdict(dict)
     for elev, b1, b2, bound in graph:
         basin_links[b1][b2] = basin_links[b2][b1] = (elev, bound)
-    basins = np.zeros(nsing+1)
+    basins = np.zeros(nsing+1, dtype=dem.dtype)
     stack = [(-1, float('-inf'))]
 
     # Applying basin flowing
@@ -176,54 +198,473 @@ def flow(dem, method='semirandom'):
             del basin_links[b2][b1]
         del basin_links[b1]
 
+    return basins[basin_id]
+
+def basin_roots(dirs2, dtype=int):
+    """
+    Give the flat index of the singular node every node flows to, following local flow directions.
+    """
+    root = receivers(dirs2, dtype=dtype)
+    while True:
+        root_next = root[root]
+        if np.array_equal(root_next, root):
+            return root
+        root = root_next
+
+def basin_ids(root, singular, shape, dtype=int):
+    """
+    Give the basin index of every node from its root, basins being numbered in the order of 'singular'.
+    """
+    basin_index = np.zeros(root.size, dtype=dtype)
+    basin_index[singular[:,0]*shape[1] + singular[:,1]] = np.arange(len(singular))
+    return basin_index[root].reshape(shape)
+
+def link_basins_kruskal(dem, dirs2, singular, index_dtype=int, basin_id=None):
+    """
+    Link basins using flat edge arrays and Kruskal's algorithm with an array-backed union-find.
+    Same result as link_basins_boruvka, with much less memory on grids with many depressions.
+    Node and basin indices are stored as 'index_dtype' (must be signed).
+    'basin_id' gives the basin of every node (see basin_ids); it is computed from 'dirs2' if not provided.
+    """
+    (X, Y) = dem.shape
+    nsing = len(singular)
+    outside = nsing # Index given to the outside of the grid (basin -1)
+
+    # Compute basins: find the singular node every node flows to
+    if basin_id is None:
+        basin_id = basin_ids(basin_roots(dirs2, dtype=index_dtype), singular, dem.shape, dtype=index_dtype)
+
+    # List all candidate passes between neighbouring basins, in the same order as link_basins_boruvka
+    def candidates(basin_id, dem):
+        (X, Y) = basin_id.shape
+        border = np.full((X, 1), -1, dtype=basin_id.dtype)
+        b0 = np.hstack((border, basin_id))
+        b1 = np.hstack((basin_id, border))
+        elev = np.hstack((dem[:,:1], np.maximum(dem[:,:-1], dem[:,1:]), dem[:,-1:]))
+        x, y = np.indices((X, Y+1), dtype=basin_id.dtype)
+        return b0.ravel(), b1.ravel(), elev.ravel(), x.ravel(), y.ravel()
+
+    b0y, b1y, elevy, xy, yy = candidates(basin_id, dem)
+    b0x, b1x, elevx, yx, xx = candidates(basin_id.T, dem.T)
+    b0 = np.concatenate((b0y, b0x))
+    b1 = np.concatenate((b1y, b1x))
+    elev = np.concatenate((elevy, elevx))
+    bx = np.concatenate((xy, xx))
+    by = np.concatenate((yy, yx))
+    isY = np.zeros(b0.size, dtype='?')
+    isY[:b0y.size] = True
+    del b0y, b1y, elevy, xy, yy, b0x, b1x, elevx, yx, xx
+
+    keep = np.flatnonzero(b0 != b1)
+    lo = np.minimum(b0[keep], b1[keep])
+    hi = np.maximum(b0[keep], b1[keep])
+    elev, bx, by, isY = elev[keep], bx[keep], by[keep], isY[keep]
+    del b0, b1, keep
+
+    # Keep the lowest pass for every pair of basins (first one in case of equality)
+    # Passes are grouped by pair with a stable sort on a single key, then the first pass at the minimal elevation of every group is selected
+    pair = (lo.astype(np.int64, copy=False)+1) * (nsing+1) + hi
+    order = np.argsort(pair, kind='stable')
+    pair = pair[order]
+    start = np.ones(order.size, dtype='?')
+    start[1:] = pair[1:] != pair[:-1]
+    group = np.cumsum(start) - 1
+    elev_sorted = elev[order]
+    lowest = np.flatnonzero(elev_sorted == np.minimum.reduceat(elev_sorted, np.flatnonzero(start))[group])
+    first = np.ones(lowest.size, dtype='?')
+    first[1:] = group[lowest[1:]] != group[lowest[:-1]]
+    sel = order[lowest[first]]
+    lo, hi, elev, bx, by, isY = lo[sel], hi[sel], elev[sel], bx[sel], by[sel], isY[sel]
+    del pair, order, start, group, elev_sorted, lowest, first, sel
+
+    profile_count(basins=nsing, links=lo.size)
+
+    # Kruskal: add links by increasing elevation, ignoring those that would close a loop
+    # Links are sorted by basin pair, so a stable sort on elevation breaks ties by pair
+    with stage('kruskal'):
+        order = np.argsort(elev, kind='stable')
+        lo[lo<0] = outside
+        parent = list(range(nsing+1))
+        tree = []
+        for e, u, v in zip(order.tolist(), lo[order].tolist(), hi[order].tolist()):
+            while parent[u] != u:
+                parent[u] = parent[parent[u]]
+                u = parent[u]
+            while parent[v] != v:
+                parent[v] = parent[parent[v]]
+                v = parent[v]
+            if u != v:
+                parent[u] = v
+                tree.append(e)
+                if len(tree) == nsing:
+                    break
+        del parent, order
+    tree = np.array(tree, dtype=int)
+    lo, hi, elev, bx, by, isY = lo[tree], hi[tree], elev[tree], bx[tree], by[tree], isY[tree]
+
+    # Traverse the tree from the outside, level by level, to find through which link every basin drains
+    ends = np.concatenate((lo, hi))
+    others = np.concatenate((hi, lo))
+    links = np.concatenate((np.arange(tree.size), np.arange(tree.size)))
+    order = np.argsort(ends, kind='stable')
+    others, links = others[order], links[order]
+    degree = np.bincount(ends, minlength=nsing+1)
+    start = np.cumsum(degree) - degree
+
+    basins = np.zeros(nsing+1, dtype=dem.dtype)
+    basins[outside] = float('-inf')
+    visited = np.zeros(nsing+1, dtype='?')
+    visited[outside] = True
+    drain_link = np.zeros(nsing+1, dtype=int)
+    front = np.array([outside])
+    while front.size > 0:
+        count = degree[front]
+        parents = np.repeat(front, count)
+        pos = np.arange(count.sum()) - np.repeat(np.cumsum(count) - count, count) + np.repeat(start[front], count)
+        children, clinks = others[pos], links[pos]
+        new = ~visited[children]
+        parents, children, clinks = parents[new], children[new], clinks[new]
+        visited[children] = True
+        basins[children] = np.maximum(basins[parents], elev[clinks])
+        drain_link[children] = clinks
+        front = children
+
+    # Reverse flow directions from the pass to the bottom of every basin, all basins at once
+    b2 = np.arange(nsing)
+    link = drain_link[:nsing]
+    x, y, isY = bx[link], by[link], isY[link]
+    backward = (x < X) & (y < Y) # Whether water will escape the basin in +X/+Y direction
+    backward[backward] = basin_id[x[backward], y[backward]] == b2[backward]
+    x = x - (~backward & ~isY)
+    y = y - (~backward & isY)
+    d = 2*backward + isY + 1
+
+    offsets = np.array([0, Y, 1, -Y, -1])
+    dir_reverse = np.array([0, 3, 4, 1, 2])
+    dirs_flat = dirs2.reshape(-1)
+    i = x*Y + y
+    while i.size > 0:
+        d_old = dirs_flat[i]
+        dirs_flat[i] = d
+        active = d_old > 0
+        d_old = d_old[active]
+        i = i[active] + offsets[d_old]
+        d = dir_reverse[d_old]
+
+    return basins[basin_id]
+
+basin_methods = {
+    'boruvka' : link_basins_boruvka,
+    'kruskal' : link_basins_kruskal,
+}
+
+def flow(dem, method='semirandom', basin_method='kruskal', return_tree=False, workers=1, band=None, rng=None, compact=False):
+    """
+    Compute flow directions, lake levels and water quantity (and the river tree if 'return_tree' is True).
+    In compact mode, directions are stored in 8 bits and indices and water quantities in 32 bits, and lake levels are in the precision of 'dem'.
+    """
+    if basin_method not in basin_methods:
+        raise KeyError('Basin linking method \'{}\' does not exist'.format(basin_method))
+
+    if compact:
+        dirs_dtype, index_dtype, waterq_dtype = np.uint8, (np.int32 if dem.size < 2**31 else np.int64), np.uint32
+    else:
+        dirs_dtype, index_dtype, waterq_dtype = int, int, int
+
+    # Flow locally
+    with stage('local'):
+        dirs2, dirs1, singular = flow_local(dem, method=method, workers=workers, band=band, rng=rng, dtype=dirs_dtype)
+        profile_count(singular=len(singular))
+
+    # Link basins and make them flow out of the grid
+    with stage('basins'):
+        if basin_method == 'boruvka':
+            lakes = link_basins_boruvka(dem, dirs2, dirs1, singular)
+        else:
+            del dirs1
+            lakes = link_basins_kruskal(dem, dirs2, singular, index_dtype=index_dtype)
+
     # Calculating water quantity
     dirs2[-1,:][dirs2[-1,:]==1] = 0
     dirs2[:,-1][dirs2[:,-1]==2] = 0
     dirs2[0,:][dirs2[0,:]==3] = 0
     dirs2[:,0][dirs2[:,0]==4] = 0
 
-    waterq = accumulate_flow(dirs2)
+    with stage('tree'):
+        tree = flow_tree(dirs2, dtype=index_dtype)
+    with stage('accumulation'):
+        waterq = accumulate_flow(dirs2, tree=tree, dtype=waterq_dtype)
 
-    return dirs2, basins[basin_id], waterq
-
-def accumulate_flow(dirs):
-    ndonors = np.zeros(dirs.shape, dtype=int)
-    ndonors[1:,:] += dirs[:-1,:] == 1
-    ndonors[:,1:] += dirs[:,:-1] == 2
-    ndonors[:-1,:] += dirs[1:,:] == 3
-    ndonors[:,:-1] += dirs[:,1:] == 4
-    waterq = np.ones(dirs.shape, dtype=int)
+    if return_tree:
+        return dirs2, lakes, waterq, tree
+    return dirs2, lakes, waterq
 
+def _steepest_at(dem, nodes, dtype):
+    # Same as flow_dirs(dem, method='steepest') on the given flat node indices only
+    (X, Y) = dem.shape
+    flat = dem.ravel()
+    x, y = np.divmod(nodes, Y)
+    z = flat[nodes]
+    drops = np.zeros((4, nodes.size), dtype=dem.dtype)
+    for k, (valid, neighbour) in enumerate(((x < X-1, nodes+Y), (y < Y-1, nodes+1), (x > 0, nodes-Y), (y > 0, nodes-1))):
+        np.subtract(z, flat[np.where(valid, neighbour, nodes)], out=drops[k], where=valid)
+    np.maximum(drops, 0, out=drops)
+    return flow_local_steepest(drops).astype(dtype, copy=False)
+
+def _donors(dirs, nodes):
+    # Nodes flowing into the given flat node indices, according to 'dirs'
     (X, Y) = dirs.shape
-    rangeX = range(X)
-    rangeY = range(Y)
-    for x in rangeX:
-        for y in rangeY:
-            if ndonors[x,y] > 0:
-                continue
-            xw, yw = x, y
-            w = waterq[xw, yw]
-            while 1:
-                d = dirs[xw, yw]
-                if d <= 0:
-                    break
-                elif d == 1:
-                    xw += 1
-                elif d == 2:
-                    yw += 1
-                elif d == 3:
-                    xw -= 1
-                elif d == 4:
-                    yw -= 1
-
-                w += waterq[xw, yw]
-                waterq[xw, yw] = w
+    flat = dirs.ravel()
+    x, y = np.divmod(nodes, Y)
+    donors = []
+    for valid, neighbour, d in ((x > 0, nodes-Y, 1), (y > 0, nodes-1, 2), (x < X-1, nodes+Y, 3), (y < Y-1, nodes+1, 4)):
+        neighbour = neighbour[valid]
+        donors.append(neighbour[flat[neighbour] == d])
+    return np.concatenate(donors)
+
+def _upstream(dirs, nodes):
+    # Mask of the given nodes and of all nodes flowing through them
+    mask = np.zeros(dirs.size, dtype='?')
+    front = nodes
+    while front.size > 0:
+        mask[front] = True
+        front = _donors(dirs, front)
+    return mask
+
+def _downstream(rcv, nodes):
+    # Mask of the given nodes and of all nodes downstream of them
+    mask = np.zeros(rcv.size, dtype='?')
+    front = nodes
+    while front.size > 0:
+        front = front[~mask[front]]
+        mask[front] = True
+        front = rcv[front]
+    return mask
+
+class IncrementalFlow:
+    """
+    Flow calculation reusing the previous one, for successive calls on a slowly changing elevation model.
+    Local directions are recomputed only around nodes whose elevation changed (with steepest routing), basin membership only upstream of nodes whose local direction changed,
+    and water quantity only downstream of nodes whose receiver changed (in the previous or in the new river tree). Basin linking is always complete, as pass elevations change with the elevation model.
+    When the fraction of changed nodes exceeds 'max_change' at any of these steps, it is fully recomputed.
+    Results are the same as flow(). The previous calculation is kept in memory: about 5 grids.
+    """
+    def __init__(self, max_change=0.1):
+        self.max_change = max_change
+        self.previous = None
+        self.counts = {'incremental': 0, 'full': 0} # Number of incremental and full calculations of every step, summed
+
+    def _count(self, incremental):
+        self.counts['incremental' if incremental else 'full'] += 1
+        profile_count(incremental=incremental, full=not incremental)
+
+    def flow(self, dem, method='semirandom', basin_method='kruskal', return_tree=False, workers=1, band=None, rng=None, compact=False):
+        """
+        Same as flow(). Only the Kruskal basin linking method can be updated incrementally: with Boruvka, flow is fully recomputed.
+        """
+        if basin_method != 'kruskal':
+            self.previous = None
+            return flow(dem, method=method, basin_method=basin_method, return_tree=return_tree, workers=workers, band=band, rng=rng, compact=compact)
+        if method not in flow_local_methods:
+            raise KeyError('Flow method \'{}\' does not exist'.format(method))
+
+        if compact:
+            dirs_dtype, index_dtype, waterq_dtype = np.uint8, (np.int32 if dem.size < 2**31 else np.int64), np.uint32
+        else:
+            dirs_dtype, index_dtype, waterq_dtype = int, int, int
+        prev = self.previous
+        if prev is not None and (prev['local'].shape != dem.shape or prev['local'].dtype != np.dtype(dirs_dtype) or prev['method'] != method):
+            prev = None
+        n = dem.size
+        limit = self.max_change * n
+
+        # Flow locally. Semirandom directions are drawn again for the whole grid.
+        with stage('local'):
+            local = None
+            if prev is not None and method == 'steepest':
+                # Directions depend on elevations of the node and of its neighbours
+                changed = dem != prev['dem']
+                affected = changed.copy()
+                affected[1:,:] |= changed[:-1,:]
+                affected[:-1,:] |= changed[1:,:]
+                affected[:,1:] |= changed[:,:-1]
+                affected[:,:-1] |= changed[:,1:]
+                nodes = np.flatnonzero(affected)
+                del changed, affected
+                if nodes.size <= limit:
+                    self._count(True)
+                    local = prev['local'].copy()
+                    local.ravel()[nodes] = _steepest_at(dem, nodes, dirs_dtype)
+                del nodes
+            if local is None:
+                self._count(False)
+                local = flow_local(dem, method=method, workers=workers, band=band, rng=rng, dtype=dirs_dtype)[0]
+            singular = np.argwhere(local==0)
+            profile_count(singular=len(singular))
+
+        # Link basins and make them flow out of the grid
+        with stage('basins'):
+            root = None
+            if prev is not None:
+                changed = np.flatnonzero(local.ravel() != prev['local'].ravel())
+                if changed.size <= limit:
+                    # Only nodes flowing through a node whose direction changed can change basin
+                    upstream = np.flatnonzero(_upstream(local, changed))
+                    if upstream.size <= limit:
+                        self._count(True)
+                        root = prev['root'].copy()
+                        root[upstream] = self._update_roots(local, upstream, prev['root'])
+                    del upstream
+                del changed
+            if root is None:
+                self._count(False)
+                root = basin_roots(local, dtype=index_dtype)
+            dirs2 = local.copy()
+            lakes = link_basins_kruskal(dem, dirs2, singular, index_dtype=index_dtype, basin_id=basin_ids(root, singular, dem.shape, dtype=index_dtype))
+
+        dirs2[-1,:][dirs2[-1,:]==1] = 0
+        dirs2[:,-1][dirs2[:,-1]==2] = 0
+        dirs2[0,:][dirs2[0,:]==3] = 0
+        dirs2[:,0][dirs2[:,0]==4] = 0
+
+        with stage('tree'):
+            tree = flow_tree(dirs2, dtype=index_dtype)
+        rcv, order, bounds = tree
+
+        with stage('accumulation'):
+            waterq = None
+            if prev is not None:
+                changed = np.flatnonzero(rcv != prev['rcv'])
+                if changed.size <= limit:
+                    # Water quantity changes only downstream of nodes whose receiver changed, in the previous or in the new river tree
+                    nodes = np.flatnonzero(_downstream(rcv, changed) | _downstream(prev['rcv'], changed))
+                    if nodes.size <= limit:
+                        self._count(True)
+                        waterq = prev['waterq'].copy()
+                        self._update_waterq(waterq, rcv, dirs2, nodes)
+                    del nodes
+                del changed
+            if waterq is None:
+                self._count(False)
+                waterq = accumulate_flow(dirs2, tree=tree, dtype=waterq_dtype).ravel()
+
+        self.previous = {'dem': np.array(dem) if method == 'steepest' else None, 'method': method, 'local': local, 'root': root, 'rcv': rcv, 'waterq': waterq}
+        waterq = waterq.reshape(dem.shape)
+        if return_tree:
+            return dirs2, lakes, waterq, tree
+        return dirs2, lakes, waterq
+
+    @staticmethod
+    def _update_roots(local, nodes, root):
+        # Roots of the given nodes (sorted), whose paths can lead to nodes outside of the list: roots of these are given by 'root'
+        Y = local.shape[1]
+        offsets = np.array([0, Y, 1, -Y, -1])
+        nxt = nodes + offsets[local.ravel()[nodes]]
+        pos = np.searchsorted(nodes, nxt)
+        inside = (pos < nodes.size) & (nxt != nodes)
+        inside[inside] = nodes[pos[inside]] == nxt[inside]
+        # Pointer jumping inside the list, until reaching a singular node or a node outside of the list
+        to = np.where(inside, pos, np.arange(nodes.size))
+        end_root = np.where(nxt == nodes, nodes, root[nxt])
+        while True:
+            to_next = to[to]
+            if np.array_equal(to_next, to):
+                return end_root[to]
+            to = to_next
+
+    @staticmethod
+    def _update_waterq(waterq, rcv, dirs, nodes):
+        # Recompute water quantity of the given nodes (sorted): donors outside of the list keep their water quantity
+        donors = _donors(dirs, nodes)
+        inside = np.zeros(donors.size, dtype='?')
+        pos = np.searchsorted(nodes, donors)
+        inside[pos < nodes.size] = nodes[pos[pos < nodes.size]] == donors[pos < nodes.size]
+        # Water coming from outside of the list, and the tree formed by the listed nodes
+        outer = donors[~inside]
+        total = 1 + np.bincount(np.searchsorted(nodes, rcv[outer]), weights=waterq[outer], minlength=nodes.size).astype(np.int64)
+        inner = pos[inside]
+        parent = np.full(nodes.size, -1)
+        parent[inner] = np.searchsorted(nodes, rcv[donors[inside]])
+        ndonors = np.bincount(parent[inner], minlength=nodes.size)
+
+        # Sweep from sources to outlets (Kahn's algorithm): few nodes are listed, so a plain loop is faster than processing levels
+        total, parent, ndonors = total.tolist(), parent.tolist(), ndonors.tolist()
+        stack = [i for i, n in enumerate(ndonors) if n == 0]
+        while stack:
+            i = stack.pop()
+            p = parent[i]
+            if p >= 0:
+                total[p] += total[i]
+                ndonors[p] -= 1
+                if ndonors[p] == 0:
+                    stack.append(p)
+        waterq[nodes] = total
+
+def receivers(dirs, dtype=int):
+    """
+    Give the flat index of the receiver of every node (the node itself for outlets)
+    """
+    (X, Y) = dirs.shape
+    rcv = np.arange(X*Y, dtype=dtype).reshape(X, Y)
+    rcv[dirs==1] += Y
+    rcv[dirs==2] += 1
+    rcv[dirs==3] -= Y
+    rcv[dirs==4] -= 1
+    return rcv.ravel()
+
+def flow_order(rcv):
+    """
+    Sort nodes in topological order, from sources to outlets (Kahn's algorithm).
+    Nodes are grouped by levels: every node comes after all of its donors, and nodes of the same level are independent from each other.
+    Returns the ordered node list and the bounds of each level in it.
+    """
+    n = rcv.size
+    nodes = np.arange(n)
+    ndonors = np.bincount(rcv[rcv!=nodes], minlength=n)
+    front = np.flatnonzero(ndonors==0)
+    levels = []
+    while front.size > 0:
+        levels.append(front)
+        r = rcv[front]
+        r, count = np.unique(r[r!=front], return_counts=True)
+        ndonors[r] -= count
+        front = r[ndonors[r]==0]
+
+    bounds = np.zeros(len(levels)+1, dtype=int)
+    np.cumsum([len(l) for l in levels], out=bounds[1:])
+    if levels:
+        order = np.concatenate(levels).astype(rcv.dtype, copy=False)
+    else:
+        order = nodes[:0]
+    return order, bounds
 
-                if ndonors[xw, yw] > 1:
-                    ndonors[xw, yw] -= 1
-                    break
+def flow_tree(dirs, dtype=int):
+    """
+    Give the receivers and the topological order of the river tree defined by 'dirs', as node indices of type 'dtype'.
+    Reading the order backwards gives the stack order of Braun & Willett (2013), from outlets to sources.
+    """
+    rcv = receivers(dirs, dtype=dtype)
+    order, bounds = flow_order(rcv)
+    return rcv, order, bounds
 
-    return waterq
+def accumulate_flow(dirs, tree=None, dtype=int):
+    """
+    Calculate water quantity (catchment area) for every node, as 'dtype'.
+    'tree' is the (receivers, order, bounds) tuple given by flow_tree; it is computed from 'dirs' if not provided.
+    """
+    if tree is None:
+        tree = flow_tree(dirs)
+    rcv, order, bounds = tree
+
+    waterq = np.ones(rcv.size, dtype=dtype)
+    # Sweep from sources to outlets: all donors of a level are complete when it is reached
+    for i in range(len(bounds)-1):
+        level = order[bounds[i]:bounds[i+1]]
+        r = rcv[level]
+        donor = r != level
+        np.add.at(waterq, r[donor], waterq[level[donor]])
+
+    return waterq.reshape(dirs.shape)
 
 def planar_boruvka(links):
     # Compute basin tree
@@ -1,13 +1,84 @@
 import numpy as np
 import zlib
+import os
+import struct
+from concurrent.futures import ThreadPoolExecutor
 
-def save(data, fname, dtype=None):
-    if dtype is not None:
-        data = data.astype(dtype)
+from .tiled import tiled_plan
 
-    bin_data = data.tobytes()
-    bin_data_comp = zlib.compress(bin_data, 9)
-    if len(bin_data_comp) < len(bin_data):
-        bin_data = bin_data_comp
-    with open(fname, 'wb') as f:
-        f.write(bin_data)
+# Grids are compressed by chunks in a pool of threads (zlib releases the GIL), and written to disk in order as soon as chunks are ready.
+# In flat format, chunks are raw deflate streams ending on a byte boundary, concatenated in a single zlib stream (like pigz does):
+# the result is an ordinary zlib stream, readable by any zlib decompressor.
+
+chunk_size = 2**20 # Uncompressed bytes per chunk in flat format
+
+def _adler32_combine(adler1, adler2, len2):
+    # Adler-32 checksum of the concatenation of two buffers, from their checksums (as adler32_combine in zlib)
+    base = 65521
+    rem = len2 % base
+    sum1 = adler1 & 0xffff
+    sum2 = (rem * sum1) % base
+    sum1 = (sum1 + (adler2 & 0xffff) + base - 1) % base
+    sum2 = (sum2 + (adler1 >> 16) + (adler2 >> 16) + base - rem) % base
+    return sum1 | (sum2 << 16)
+
+def _deflate_rows(data, x0, x1, dtype, level, last):
+    # Compress rows x0 to x1, converted to 'dtype' (copied only if needed)
+    block = memoryview(np.ascontiguousarray(data[x0:x1], dtype=dtype)).cast('B')
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    deflated = compressor.compress(block) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+    return deflated, zlib.adler32(block), len(block)
+
+def flat_plan(data, dtype=None, level=9):
+    """
+    Plan the saving of a 2D array in flat format, zlib-compressed if it makes it smaller: returns a list of independent compression tasks (function, arguments),
+    and a function write(file, results) writing the grid from the results of the tasks, in order.
+    """
+    dtype = np.dtype(data.dtype if dtype is None else dtype)
+    (X, Y) = data.shape
+    raw_size = X * Y * dtype.itemsize
+    rows = max(chunk_size // max(Y * dtype.itemsize, 1), 1)
+    bounds = list(range(0, X, rows)) + [X]
+    tasks = [(_deflate_rows, (data, x0, x1, dtype, level, x1 == X)) for x0, x1 in zip(bounds[:-1], bounds[1:])]
+
+    def write(f, results):
+        f.write(bytes((0x78, (0x01, 0x5e, 0x9c, 0xda)[(level >= 2) + (level >= 6) + (level >= 7)]))) # zlib header
+        adler = 1
+        for deflated, chunk_adler, length in results:
+            f.write(deflated)
+            adler = _adler32_combine(adler, chunk_adler, length)
+        f.write(struct.pack('>I', adler))
+
+        if f.tell() >= raw_size:
+            # Not smaller: save uncompressed
+            f.seek(0)
+            f.truncate()
+            for x0, x1 in zip(bounds[:-1], bounds[1:]):
+                f.write(np.ascontiguousarray(data[x0:x1], dtype=dtype))
+
+    return tasks, write
+
+def save_grids(grids, tile_size=None, level=9, threads=None):
+    """
+    Save several 2D arrays, given as (data, fname, dtype) tuples, in flat or tiled format (if 'tile_size' is given, see tiled.py).
+    'level' is the zlib compression level, from 0 (fastest) to 9 (smallest). Chunks of all grids are compressed by a pool of 'threads' threads (number of CPUs by default).
+    """
+    plans = []
+    for data, fname, dtype in grids:
+        if tile_size:
+            plans.append((fname,) + tiled_plan(data, dtype=dtype, tile_size=tile_size, level=level))
+        else:
+            plans.append((fname,) + flat_plan(data, dtype=dtype, level=level))
+
+    with ThreadPoolExecutor(threads or os.cpu_count() or 1) as executor:
+        futures = [[executor.submit(func, *args) for func, args in tasks] for fname, tasks, write in plans]
+        for (fname, tasks, write), fut in zip(plans, futures):
+            with open(fname, 'wb') as f:
+                write(f, (future.result() for future in fut))
+
+def save(data, fname, dtype=None, tile_size=None, level=9, threads=None):
+    """
+    Save a 2D array, zlib-compressed if it makes it smaller.
+    If 'tile_size' is given, save it in tiled format instead (see tiled.py).
+    """
+    save_grids([(data, fname, dtype)], tile_size=tile_size, level=level, threads=threads)
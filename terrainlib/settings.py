@@ -14,3 +14,35 @@ def read_config_file(fname):
                 settings[prefix.strip()] = suffix.strip()
 
     return settings
+
+def parse_command_line(argv, positional=('config', 'output')):
+    """
+    Parse command-line arguments (argv[0] is the script name): '--name value', '--name=value', or '--name' alone (a flag, given an empty value).
+    Arguments that are not preceded by '--name' are named by 'positional', in order (extra ones are ignored).
+    Returns a dict of all arguments, as strings.
+    """
+    args = {}
+    argc = len(argv)
+    i = 1 # Index of arguments
+    j = 0 # Number of 'orphan' arguments (the ones that are not preceded by '--something')
+    while i < argc:
+        arg = argv[i]
+        if arg[:2] == '--':
+            pname = arg[2:]
+            split = pname.split('=', maxsplit=1)
+            if len(split) == 2:
+                pname, v = split
+                i += 1
+            elif i+1 < argc and argv[i+1][:2] != '--':
+                v = argv[i+1]
+                i += 2
+            else: # Flag without value
+                v = ''
+                i += 1
+            args[pname] = v
+        else:
+            if j < len(positional):
+                args[positional[j]] = arg
+            i += 1
+            j += 1
+    return args
@@ -0,0 +1,147 @@
+import numpy as np
+
+from .parallel import get_executor
+
+# Vectorized 2D simplex noise, reproducing snoise2 from the 'noise' module (by Casey Duncan) on whole arrays.
+# Computations are done in single precision like the original C code, so that both give the same values.
+
+has_noise = True
+try:
+    from noise import snoise2 as snoise2_c
+except ImportError: # No module noise, only the vectorized implementation is available
+    has_noise = False
+
+PERM = np.array([
+    151, 160, 137, 91, 90, 15, 131, 13, 201, 95, 96, 53, 194, 233, 7, 225,
+    140, 36, 103, 30, 69, 142, 8, 99, 37, 240, 21, 10, 23, 190, 6, 148,
+    247, 120, 234, 75, 0, 26, 197, 62, 94, 252, 219, 203, 117, 35, 11, 32,
+    57, 177, 33, 88, 237, 149, 56, 87, 174, 20, 125, 136, 171, 168, 68, 175,
+    74, 165, 71, 134, 139, 48, 27, 166, 77, 146, 158, 231, 83, 111, 229, 122,
+    60, 211, 133, 230, 220, 105, 92, 41, 55, 46, 245, 40, 244, 102, 143, 54,
+    65, 25, 63, 161, 1, 216, 80, 73, 209, 76, 132, 187, 208, 89, 18, 169,
+    200, 196, 135, 130, 116, 188, 159, 86, 164, 100, 109, 198, 173, 186, 3, 64,
+    52, 217, 226, 250, 124, 123, 5, 202, 38, 147, 118, 126, 255, 82, 85, 212,
+    207, 206, 59, 227, 47, 16, 58, 17, 182, 189, 28, 42, 223, 183, 170, 213,
+    119, 248, 152, 2, 44, 154, 163, 70, 221, 153, 101, 155, 167, 43, 172, 9,
+    129, 22, 39, 253, 19, 98, 108, 110, 79, 113, 224, 232, 178, 185, 112, 104,
+    218, 246, 97, 228, 251, 34, 242, 193, 238, 210, 144, 12, 191, 179, 162, 241,
+    81, 51, 145, 235, 249, 14, 239, 107, 49, 192, 214, 31, 181, 199, 106, 157,
+    184, 84, 204, 176, 115, 121, 50, 45, 127, 4, 150, 254, 138, 236, 205, 93,
+    222, 114, 67, 29, 24, 72, 243, 141, 128, 195, 78, 66, 215, 61, 156, 180,
+] * 2, dtype=np.int32)
+
+# Gradients of GRAD3 (only X and Y components are used in 2D)
+GRAD_X = np.array([1, -1, 1, -1, 1, -1, 1, -1, 0, 0, 0, 0], dtype=np.float32)
+GRAD_Y = np.array([1, 1, -1, -1, 0, 0, 0, 0, 1, -1, 1, -1], dtype=np.float32)
+
+# Gradient index for every lattice point: GRAD_INDEX[I*257 + J] = PERM[I + PERM[J]] % 12, for I and J in 0..256
+GRAD_INDEX = (PERM[np.arange(257)[:,None] + PERM[None,:257]] % 12).ravel()
+
+F2 = np.float32(0.3660254037844386)  # 0.5 * (sqrt(3.0) - 1.0)
+G2 = np.float32(0.21132486540518713) # (3.0 - sqrt(3.0)) / 6.0
+
+def noise2(x, y):
+    """
+    Single octave of simplex noise, for float32 arrays of coordinates of the same shape.
+    """
+    s = (x + y) * F2
+    i = np.floor(x + s)
+    j = np.floor(y + s)
+    t = (i + j) * G2
+
+    x0 = x - (i - t)
+    y0 = y - (j - t)
+    i1 = x0 > y0
+
+    lattice = (i.astype(np.int32) & 255) * 257 + (j.astype(np.int32) & 255)
+    corners = (
+        (x0, y0, lattice),
+        (x0 - i1 + G2, y0 - ~i1 + G2, lattice + np.where(i1, 257, 1)),
+        (x0 + G2*2 - 1, y0 + G2*2 - 1, lattice + 258),
+    )
+
+    n = np.zeros(x.shape, dtype=np.float32)
+    for xc, yc, lc in corners:
+        g = GRAD_INDEX[lc]
+        f = np.float32(0.5) - xc*xc
+        f -= yc*yc
+        np.maximum(f, 0, out=f)
+        nc = f*f
+        nc *= f
+        nc *= f
+        nc *= GRAD_X[g]*xc + GRAD_Y[g]*yc
+        n += nc
+    n *= np.float32(70)
+    return n
+
+def snoise2(x, y, octaves=1, persistence=0.5, lacunarity=2.0):
+    """
+    Multi-octave (fBm) simplex noise on arrays of coordinates, equivalent to noise.snoise2.
+    """
+    x, y = np.broadcast_arrays(x, y)
+    shape = x.shape
+    x = x.astype(np.float32).ravel()
+    y = y.astype(np.float32).ravel()
+    persistence = np.float32(persistence)
+    lacunarity = np.float32(lacunarity)
+
+    freq = np.float32(1)
+    amp = np.float32(1)
+    vmax = np.float32(1)
+    total = noise2(x, y)
+    for i in range(1, octaves):
+        freq *= lacunarity
+        amp *= persistence
+        vmax += amp
+        total += noise2(x*freq, y*freq) * amp
+
+    return (total / vmax).astype(np.float64).reshape(shape)[()] # [()] gives a scalar for scalar coordinates
+
+def _noise_band(args):
+    x0, x1, Y, scale, xbase, ybase, params = args
+    x = np.arange(x0, x1)/scale + xbase
+    y = np.arange(Y)/scale + ybase
+    return snoise2(x[:,None], y[None,:], **params)
+
+def _noise_band_c(args):
+    x0, x1, Y, scale, xbase, ybase, params = args
+    n = np.zeros((x1-x0, Y))
+    for x in range(x0, x1):
+        for y in range(Y):
+            n[x-x0,y] = snoise2_c(x/scale + xbase, y/scale + ybase, **params)
+    return n
+
+def noisemap(X, Y, scale=0.01, vscale=1.0, offset=0.0, log=False, xbase=0, ybase=0, method='numpy', workers=1, band=64, rng=None, **params):
+    """
+    Generate a noise map of size X*Y, with noise coordinates starting at (xbase, ybase).
+    If 'rng' (a numpy.random.Generator) is given, a random offset between -4096 and 4095 is added to xbase and ybase.
+    Rows are computed by bands of 'band' rows, in parallel if 'workers' > 1. The result does not depend on the number of workers.
+    'method' is 'numpy' for the vectorized implementation, or 'snoise2' to call the 'noise' module for every cell (much slower).
+    """
+    if method == 'numpy':
+        band_func = _noise_band
+    elif method == 'snoise2':
+        if not has_noise:
+            raise ImportError('Noise method \'snoise2\' requires module \'noise\'')
+        band_func = _noise_band_c
+    else:
+        raise KeyError('Noise method \'{}\' does not exist'.format(method))
+
+    if rng is not None:
+        xbase += int(rng.integers(-4096, 4096))
+        ybase += int(rng.integers(-4096, 4096))
+
+    if log:
+        vscale /= offset
+
+    bands = [(x0, min(x0+band, X), Y, scale, xbase, ybase, params) for x0 in range(0, X, band)]
+    executor = get_executor(workers)
+    if executor is not None:
+        n = np.concatenate(list(executor.map(band_func, bands)))
+    else:
+        n = np.concatenate([band_func(b) for b in bands])
+
+    if log:
+        return np.exp(n*vscale) * offset
+    else:
+        return n*vscale + offset
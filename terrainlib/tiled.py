@@ -0,0 +1,229 @@
+import numpy as np
+import zlib
+import os
+import struct
+from collections import OrderedDict
+
+# Tiled grid format: the grid is cut into square tiles that are compressed independently,
+# so that a reader can decompress only the tiles it needs.
+#
+# Layout (all integers big-endian):
+#   0   4 bytes   magic 'MGRT'
+#   4   u8        format version (1)
+#   5   char      dtype kind ('i' signed integer, 'u' unsigned integer, 'f' float)
+#   6   u8        dtype item size in bytes
+#   7   char      byte order ('>' big-endian, '<' little-endian, '|' not applicable)
+#   8   u32       number of rows
+#   12  u32       number of columns
+#   16  u32       tile size (tiles are square, except at the last row/column of tiles)
+#   20  u32 * (ntiles+1)  offsets of tiles in the file, tiles being stored row by row. Tile k spans offsets[k]:offsets[k+1].
+# Every tile is the zlib-compressed content of the tile in row-major order.
+
+MAGIC = b'MGRT'
+VERSION = 1
+HEADER = struct.Struct('>4sBcBcIII')
+
+# Fields of a grid directory, and the types with which generate.py saves them
+grid_fields = {
+    'dem' : '>i2',
+    'lakes' : '>i2',
+    'dirs' : 'u1',
+    'rivers' : '>u4',
+    'offset_x' : 'i1',
+    'offset_y' : 'i1',
+}
+
+def _compress_tile_row(data, tx, tile_size, dtype, level):
+    # Compress the tiles of row 'tx', converted to 'dtype' tile by tile
+    rows = data[tx*tile_size:(tx+1)*tile_size]
+    return [zlib.compress(np.ascontiguousarray(rows[:, y0:y0+tile_size], dtype=dtype), level) for y0 in range(0, rows.shape[1], tile_size)]
+
+def tiled_plan(data, dtype=None, tile_size=64, level=9):
+    """
+    Plan the saving of a 2D array in tiled format: returns a list of independent compression tasks (function, arguments), one per row of tiles,
+    and a function write(file, results) writing the grid from the results of the tasks, in order.
+    """
+    dtype = np.dtype(data.dtype if dtype is None else dtype)
+    (X, Y) = data.shape
+    ntx, nty = -(-X // tile_size), -(-Y // tile_size)
+    ntiles = ntx * nty
+    offset = HEADER.size + 4 * (ntiles+1)
+
+    tasks = [(_compress_tile_row, (data, tx, tile_size, dtype, level)) for tx in range(ntx)]
+
+    def write(f, results):
+        f.write(HEADER.pack(MAGIC, VERSION, dtype.kind.encode(), dtype.itemsize, dtype.byteorder.encode(), X, Y, tile_size))
+        f.seek(offset)
+        offsets = [offset]
+        for tiles in results:
+            for tile in tiles:
+                f.write(tile)
+                offsets.append(f.tell())
+        f.seek(HEADER.size)
+        f.write(struct.pack('>{:d}I'.format(ntiles+1), *offsets))
+
+    return tasks, write
+
+def save_tiled(data, fname, dtype=None, tile_size=64, level=9):
+    """
+    Save a 2D array in tiled format.
+    """
+    tasks, write = tiled_plan(data, dtype=dtype, tile_size=tile_size, level=level)
+    with open(fname, 'wb') as f:
+        write(f, (func(*args) for func, args in tasks))
+
+class TiledWriter:
+    """
+    Write a grid of the given shape in tiled format, by bands of 'tile_size' rows (the last one can be smaller), without holding the whole grid in memory.
+    """
+    def __init__(self, fname, shape, dtype, tile_size=64, level=9):
+        self.dtype = np.dtype(dtype)
+        self.shape = tuple(shape)
+        self.tile_size = tile_size
+        self.level = level
+        (X, Y) = self.shape
+        ntiles = -(-X // tile_size) * -(-Y // tile_size)
+        self.rows = 0
+
+        self.file = open(fname, 'wb')
+        self.file.write(HEADER.pack(MAGIC, VERSION, self.dtype.kind.encode(), self.dtype.itemsize, self.dtype.byteorder.encode(), X, Y, tile_size))
+        self.offsets = [HEADER.size + 4 * (ntiles+1)]
+        self.file.seek(self.offsets[0])
+
+    def write_rows(self, rows):
+        if rows.shape[1] != self.shape[1] or (rows.shape[0] != self.tile_size and self.rows + rows.shape[0] != self.shape[0]):
+            raise ValueError('Rows do not match the tiles of the grid')
+        for tile in _compress_tile_row(rows, 0, self.tile_size, self.dtype, self.level):
+            self.file.write(tile)
+            self.offsets.append(self.file.tell())
+        self.rows += rows.shape[0]
+
+    def close(self):
+        if self.rows != self.shape[0]:
+            raise ValueError('Grid is incomplete: {:d} rows written out of {:d}'.format(self.rows, self.shape[0]))
+        self.file.seek(HEADER.size)
+        self.file.write(struct.pack('>{:d}I'.format(len(self.offsets)), *self.offsets))
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        if args[0] is None:
+            self.close()
+        else:
+            self.file.close()
+
+def is_tiled(fname):
+    with open(fname, 'rb') as f:
+        return f.read(4) == MAGIC
+
+class TiledGrid:
+    """
+    Random-access reader for tiled grids. Decompressed tiles are kept in a LRU cache of 'cache_size' tiles.
+    Supports slicing: grid[x0:x1, y0:y1] reads only the tiles that are needed.
+    """
+    def __init__(self, fname, cache_size=64):
+        self.file = open(fname, 'rb')
+        magic, version, kind, itemsize, byteorder, X, Y, tile_size = HEADER.unpack(self.file.read(HEADER.size))
+        if magic != MAGIC:
+            raise ValueError('{} is not a tiled grid'.format(fname))
+        if version != VERSION:
+            raise ValueError('Unsupported tiled grid version {:d} in {}'.format(version, fname))
+
+        self.dtype = np.dtype('{}{}{:d}'.format(byteorder.decode(), kind.decode(), itemsize))
+        self.shape = (X, Y)
+        self.tile_size = tile_size
+        self.ntiles = (-(-X // tile_size), -(-Y // tile_size))
+        ntiles = self.ntiles[0] * self.ntiles[1]
+        self.offsets = np.frombuffer(self.file.read(4 * (ntiles+1)), dtype='>u4').astype(int)
+
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
+        self.hits = 0
+        self.misses = 0
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def tile(self, tx, ty):
+        """
+        Give tile (tx, ty) as a 2D array.
+        """
+        key = (tx, ty)
+        if key in self.cache:
+            self.hits += 1
+            self.cache.move_to_end(key)
+            return self.cache[key]
+
+        self.misses += 1
+        k = tx * self.ntiles[1] + ty
+        self.file.seek(self.offsets[k])
+        data = zlib.decompress(self.file.read(self.offsets[k+1] - self.offsets[k]))
+        ts = self.tile_size
+        shape = (min(ts, self.shape[0]-tx*ts), min(ts, self.shape[1]-ty*ts))
+        tile = np.frombuffer(data, dtype=self.dtype).reshape(shape)
+
+        self.cache[key] = tile
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return tile
+
+    def read(self, x0, x1, y0, y1):
+        """
+        Read the rectangle [x0:x1, y0:y1] of the grid.
+        """
+        ts = self.tile_size
+        out = np.empty((x1-x0, y1-y0), dtype=self.dtype)
+        for tx in range(x0 // ts, -(-x1 // ts)):
+            for ty in range(y0 // ts, -(-y1 // ts)):
+                tile = self.tile(tx, ty)
+                ax0, ax1 = max(x0, tx*ts), min(x1, (tx+1)*ts)
+                ay0, ay1 = max(y0, ty*ts), min(y1, (ty+1)*ts)
+                out[ax0-x0:ax1-x0, ay0-y0:ay1-y0] = tile[ax0-tx*ts:ax1-tx*ts, ay0-ty*ts:ay1-ty*ts]
+        return out
+
+    def __getitem__(self, key):
+        xs, ys = key
+        x0, x1, _ = xs.indices(self.shape[0])
+        y0, y1, _ = ys.indices(self.shape[1])
+        return self.read(x0, x1, y0, y1)
+
+    def to_array(self):
+        return self.read(0, self.shape[0], 0, self.shape[1])
+
+def load_grid(fname, dtype, shape):
+    """
+    Load a whole grid, either in tiled or in flat format (zlib-compressed or not).
+    'dtype' and 'shape' are only used for flat format.
+    """
+    dtype = np.dtype(dtype)
+    if is_tiled(fname) and os.path.getsize(fname) != shape[0]*shape[1]*dtype.itemsize:
+        with TiledGrid(fname) as grid:
+            return grid.to_array()
+
+    with open(fname, 'rb') as f:
+        data = f.read()
+    if len(data) < shape[0]*shape[1]*dtype.itemsize:
+        data = zlib.decompress(data)
+    return np.frombuffer(data, dtype=dtype).reshape(shape)
+
+def convert_grid_dir(dirname, tile_size=64, level=9):
+    """
+    Convert grid files of a directory from flat format to tiled format, in place.
+    Files already in tiled format are left unchanged.
+    """
+    shape = tuple(np.loadtxt(os.path.join(dirname, 'size'), dtype='u4'))
+    for field, dtype in grid_fields.items():
+        fname = os.path.join(dirname, field)
+        if not os.path.isfile(fname) or is_tiled(fname):
+            continue
+        data = load_grid(fname, dtype, shape)
+        save_tiled(data, fname + '.tmp', tile_size=tile_size, level=level)
+        os.replace(fname + '.tmp', fname)
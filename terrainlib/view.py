@@ -3,75 +3,214 @@
 import numpy as np
 import sys, traceback
 
-has_matplotlib = True
-try:
-    import matplotlib.colors as mcl
-    import matplotlib.pyplot as plt
-    try:
-        import colorcet as cc
-        cmap1 = cc.cm.CET_L11
-        cmap2 = cc.cm.CET_L12
-    except ImportError: # No module colorcet
-        import matplotlib.cm as cm
-        cmap1 = cm.summer
-        cmap2 = cm.Blues
-except ImportError: # No module matplotlib
-    has_matplotlib = False
-
-if has_matplotlib:
-    def view_map(dem, lakes, scale=1, sea_level=0.0, title=None):
-        lakes_sea = np.maximum(lakes, sea_level)
-        water = np.maximum(lakes_sea - dem, 0)
-        max_elev = dem.max()
-        max_depth = water.max()
-
-        ls = mcl.LightSource(azdeg=315, altdeg=45)
-        norm_ground = plt.Normalize(vmin=sea_level, vmax=max_elev)
-        norm_sea = plt.Normalize(vmin=0, vmax=max_depth)
-        rgb = ls.shade(dem, cmap=cmap1, vert_exag=1/scale, blend_mode='soft', norm=norm_ground)
-
-        (X, Y) = dem.shape
-        extent = (0, Y*scale, 0, X*scale)
-        plt.imshow(np.flipud(rgb), extent=extent, interpolation='antialiased')
-        alpha = (water > 0).astype('u1')
-        plt.imshow(np.flipud(water), alpha=np.flipud(alpha), cmap=cmap2, extent=extent, vmin=0, vmax=max_depth, interpolation='antialiased')
-
-        sm1 = plt.cm.ScalarMappable(cmap=cmap1, norm=norm_ground)
-        plt.colorbar(sm1).set_label('Elevation')
-
-        sm2 = plt.cm.ScalarMappable(cmap=cmap2, norm=norm_sea)
-        plt.colorbar(sm2).set_label('Water depth')
-
-        plt.xlabel('X')
-        plt.ylabel('Z')
-
-        if title is not None:
-            plt.title(title, fontweight='bold')
-
-    def update(*args, t=0.01, **kwargs):
-        try:
-            plt.clf()
-            view_map(*args, **kwargs)
-            plt.pause(t)
-        except:
-            traceback.print_exception(*sys.exc_info())
+import multiprocessing as mp
+import importlib.util
+import queue
+import os
 
-    def plot(*args, **kwargs):
+# matplotlib is only imported when a preview is actually drawn
+has_matplotlib = None
+
+def _import_matplotlib(backend=None):
+    global has_matplotlib, mcl, plt, cmap1, cmap2
+    if has_matplotlib is None:
+        try:
+            import matplotlib
+            if backend is not None:
+                matplotlib.use(backend)
+            import matplotlib.colors as mcl
+            import matplotlib.pyplot as plt
+            try:
+                import colorcet as cc
+                cmap1 = cc.cm.CET_L11
+                cmap2 = cc.cm.CET_L12
+            except ImportError: # No module colorcet
+                import matplotlib.cm as cm
+                cmap1 = cm.summer
+                cmap2 = cm.Blues
+            has_matplotlib = True
+        except ImportError: # No module matplotlib
+            has_matplotlib = False
+    return has_matplotlib
+
+def view_map(dem, lakes, scale=1, sea_level=0.0, title=None):
+    lakes_sea = np.maximum(lakes, sea_level)
+    water = np.maximum(lakes_sea - dem, 0)
+    max_elev = dem.max()
+    max_depth = water.max()
+
+    ls = mcl.LightSource(azdeg=315, altdeg=45)
+    norm_ground = plt.Normalize(vmin=sea_level, vmax=max_elev)
+    norm_sea = plt.Normalize(vmin=0, vmax=max_depth)
+    rgb = ls.shade(dem, cmap=cmap1, vert_exag=1/scale, blend_mode='soft', norm=norm_ground)
+
+    (X, Y) = dem.shape
+    extent = (0, Y*scale, 0, X*scale)
+    plt.imshow(np.flipud(rgb), extent=extent, interpolation='antialiased')
+    alpha = (water > 0).astype('u1')
+    plt.imshow(np.flipud(water), alpha=np.flipud(alpha), cmap=cmap2, extent=extent, vmin=0, vmax=max_depth, interpolation='antialiased')
+
+    sm1 = plt.cm.ScalarMappable(cmap=cmap1, norm=norm_ground)
+    plt.colorbar(sm1, ax=plt.gca()).set_label('Elevation')
+
+    sm2 = plt.cm.ScalarMappable(cmap=cmap2, norm=norm_sea)
+    plt.colorbar(sm2, ax=plt.gca()).set_label('Water depth')
+
+    plt.xlabel('X')
+    plt.ylabel('Z')
+
+    if title is not None:
+        plt.title(title, fontweight='bold')
+
+def update(*args, t=0.01, **kwargs):
+    if not _import_matplotlib():
+        return
+    try:
+        plt.clf()
+        view_map(*args, **kwargs)
+        plt.pause(t)
+    except:
+        traceback.print_exception(*sys.exc_info())
+
+def plot(*args, **kwargs):
+    if not _import_matplotlib():
+        return
+    try:
+        plt.clf()
+        view_map(*args, **kwargs)
+        plt.pause(0.01)
+        plt.show()
+    except Exception as e:
+        traceback.print_exception(*sys.exc_info())
+
+def snapshot(fname, *args, **kwargs):
+    if not _import_matplotlib():
+        return
+    try:
+        plt.clf()
+        view_map(*args, **kwargs)
+        plt.savefig(fname, dpi=150)
+    except Exception:
+        traceback.print_exception(*sys.exc_info())
+
+def downsample(dem, lakes, max_size, scale=1):
+    """
+    Reduce grids so that they are not larger than 'max_size' in any direction, and adjust scale accordingly.
+    """
+    step = max(-(-max(dem.shape) // max_size), 1)
+    if step == 1:
+        return np.asarray(dem, dtype='f4'), np.asarray(lakes, dtype='f4'), scale
+    return dem[::step,::step].astype('f4'), lakes[::step,::step].astype('f4'), scale*step
+
+_draw_functions = {
+    'update' : update,
+    'snapshot' : snapshot,
+    'plot' : plot,
+}
+
+def _draw(frame):
+    kind, args, kwargs = frame
+    _draw_functions[kind](*args, **kwargs)
+
+def _preview_worker(frames, mode):
+    # Render frames until None is received
+    _import_matplotlib('Agg' if mode == 'png' else None)
+    while True:
         try:
-            plt.clf()
-            view_map(*args, **kwargs)
-            plt.pause(0.01)
-            plt.show()
-        except Exception as e:
-            traceback.print_exception(*sys.exc_info())
-
-else:
-    def update(*args, **kwargs):
-        pass
-    def plot(*args, **kwargs):
-        pass
-
-def stats(dem, lakes, scale=1):
+            frame = frames.get(timeout=0.1)
+        except queue.Empty:
+            if mode == 'window' and has_matplotlib and plt.get_fignums():
+                plt.pause(0.1) # Keep the window responsive
+            continue
+        if frame is None:
+            return
+        _draw(frame)
+
+class Preview:
+    """
+    Non-blocking map preview.
+    Frames are downsampled to 'max_size' and drawn by a separate process, fed by a queue of 'queue_size' frames: in 'window' mode, stale frames are dropped when the renderer is late.
+    Modes are 'window' (live matplotlib window), 'png' (snapshot every 'every' iterations in 'directory', no window needed) and 'none'.
+    Where the fork start method is not available, frames are drawn in the calling process.
+    """
+    def __init__(self, mode='window', directory='preview', every=1, max_size=1000, queue_size=2):
+        if mode not in ('window', 'png', 'none'):
+            raise KeyError('Preview mode \'{}\' does not exist'.format(mode))
+        self.mode = mode
+        self.directory = directory
+        self.every = every
+        self.max_size = max_size
+        self.process = None
+        if mode != 'none' and importlib.util.find_spec('matplotlib') is None:
+            print('matplotlib is not installed, preview is disabled')
+            self.mode = mode = 'none'
+        if mode == 'none':
+            return
+        if mode == 'png':
+            os.makedirs(directory, exist_ok=True)
+        if 'fork' in mp.get_all_start_methods():
+            ctx = mp.get_context('fork')
+            self.frames = ctx.Queue(maxsize=queue_size)
+            self.process = ctx.Process(target=_preview_worker, args=(self.frames, mode), daemon=True)
+            self.process.start()
+        else:
+            _import_matplotlib('Agg' if mode == 'png' else None)
+
+    def _send(self, frame, drop=True):
+        if self.process is None:
+            _draw(frame)
+            return
+        if not drop:
+            self.frames.put(frame)
+            return
+        while True:
+            try:
+                self.frames.put_nowait(frame)
+                return
+            except queue.Full:
+                try:
+                    self.frames.get_nowait() # Drop the oldest frame
+                except queue.Empty:
+                    pass
+
+    def update(self, dem, lakes, iteration=None, scale=1, t=0.01, **kwargs):
+        """
+        Show the current state of the map. In 'png' mode, save it if 'iteration' is a multiple of 'every'.
+        """
+        if self.mode == 'none':
+            return
+        if self.mode == 'png':
+            if iteration is None or iteration % self.every != 0:
+                return
+            dem, lakes, scale = downsample(dem, lakes, self.max_size, scale)
+            fname = os.path.join(self.directory, 'iter_{:05d}.png'.format(iteration))
+            self._send(('snapshot', (fname, dem, lakes), dict(scale=scale, **kwargs)), drop=False)
+        else:
+            dem, lakes, scale = downsample(dem, lakes, self.max_size, scale)
+            self._send(('update', (dem, lakes), dict(scale=scale, t=t, **kwargs)))
+
+    def close(self, dem=None, lakes=None, scale=1, **kwargs):
+        """
+        Show the final map if given (and wait for the window to be closed in 'window' mode), then stop the renderer.
+        """
+        if self.mode == 'none':
+            return
+        if dem is not None:
+            dem, lakes, scale = downsample(dem, lakes, self.max_size, scale)
+            if self.mode == 'png':
+                fname = os.path.join(self.directory, 'final.png')
+                self._send(('snapshot', (fname, dem, lakes), dict(scale=scale, **kwargs)), drop=False)
+            else:
+                self._send(('plot', (dem, lakes), dict(scale=scale, **kwargs)), drop=False)
+        if self.process is not None:
+            self.frames.put(None)
+            self.process.join()
+            self.process = None
+
+def stats(dem, lakes, scale=1, quiet=False):
+    """
+    Print statistics of the map, and return them as a dict.
+    """
     surface = dem.size
 
     continent = np.maximum(dem, lakes) >= 0
@@ -80,20 +219,35 @@ def stats(dem, lakes, scale=1):
     lake = continent & (lakes>dem)
     lake_surface = lake.sum()
 
+    values = {
+        'continents': continent_surface/surface,
+        'ground': (continent_surface-lake_surface)/surface,
+        'lakes': lake_surface/surface,
+        'oceans': 1-continent_surface/surface,
+        'mean_elevation': dem.mean(),
+        'mean_ocean_depth': (dem*~continent).sum()/(surface-continent_surface),
+        'mean_continent_elevation': (dem*continent).sum()/continent_surface,
+        'lowest_elevation': dem.min(),
+        'highest_elevation': dem.max(),
+    }
+    if quiet:
+        return values
+
     print('---   General    ---')
     print('Grid size:    {:5d}x{:5d}'.format(dem.shape[0], dem.shape[1]))
     if scale > 1:
         print('Map size:     {:5d}x{:5d}'.format(int(dem.shape[0]*scale), int(dem.shape[1]*scale)))
     print()
     print('---   Surfaces   ---')
-    print('Continents:        {:6.2%}'.format(continent_surface/surface))
-    print('-> Ground:         {:6.2%}'.format((continent_surface-lake_surface)/surface))
-    print('-> Lakes:          {:6.2%}'.format(lake_surface/surface))
-    print('Oceans:            {:6.2%}'.format(1-continent_surface/surface))
+    print('Continents:        {:6.2%}'.format(values['continents']))
+    print('-> Ground:         {:6.2%}'.format(values['ground']))
+    print('-> Lakes:          {:6.2%}'.format(values['lakes']))
+    print('Oceans:            {:6.2%}'.format(values['oceans']))
     print()
     print('---  Elevations  ---')
-    print('Mean elevation:      {:4.0f}'.format(dem.mean()))
-    print('Mean ocean depth:    {:4.0f}'.format((dem*~continent).sum()/(surface-continent_surface)))
-    print('Mean continent elev: {:4.0f}'.format((dem*continent).sum()/continent_surface))
-    print('Lowest elevation:    {:4.0f}'.format(dem.min()))
-    print('Highest elevation:   {:4.0f}'.format(dem.max()))
+    print('Mean elevation:      {:4.0f}'.format(values['mean_elevation']))
+    print('Mean ocean depth:    {:4.0f}'.format(values['mean_ocean_depth']))
+    print('Mean continent elev: {:4.0f}'.format(values['mean_continent_elevation']))
+    print('Lowest elevation:    {:4.0f}'.format(values['lowest_elevation']))
+    print('Highest elevation:   {:4.0f}'.format(values['highest_elevation']))
+    return values
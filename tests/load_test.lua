@@ -0,0 +1,102 @@
+-- Check that load.lua reads the grids written by tests/test_load.py, with every decoding method available in this Lua version (FFI, string.unpack, string.byte).
+-- Usage: lua tests/load_test.lua <mod path> <world path> [python]
+-- Outside Minetest, zlib decompression is done by the Python interpreter given as third argument.
+-- When run from Python (see test_load.py), 'minetest' is already defined and arguments are given in 'arg'.
+
+local modpath, worldpath, python = arg[1], arg[2], arg[3] or 'python3'
+
+if not minetest then
+	minetest = {
+		get_modpath = function()
+			return modpath
+		end,
+		get_current_modname = function()
+			return 'mapgen_rivers'
+		end,
+		get_worldpath = function()
+			return worldpath
+		end,
+		decompress = function(data)
+			local tmp = os.tmpname()
+			local f = io.open(tmp, 'wb')
+			f:write(data)
+			f:close()
+			local p = io.popen(python .. [[ -c "import sys, zlib; sys.stdout.buffer.write(zlib.decompress(open(sys.argv[1], 'rb').read()))" ]] .. tmp, 'r')
+			local out = p:read('*a')
+			p:close()
+			os.remove(tmp)
+			return out
+		end,
+	}
+end
+mapgen_rivers = mapgen_rivers or {tile_cache_size = 4}
+
+local function read_numbers(filename)
+	local file = io.open(worldpath .. '/expected/' .. filename, 'r')
+	local numbers = {}
+	for n in file:read('*a'):gmatch('%S+') do
+		numbers[#numbers+1] = tonumber(n)
+	end
+	file:close()
+	return numbers
+end
+
+-- Decoding methods, from the fastest. load.lua picks the first available one when it is loaded.
+local methods = {}
+local has_ffi, ffi = false, nil
+if rawget(_G, 'require') then
+	has_ffi, ffi = pcall(require, 'ffi')
+end
+if has_ffi then
+	methods[#methods+1] = 'ffi'
+end
+local sunpack = string.unpack
+if sunpack then
+	methods[#methods+1] = 'unpack'
+end
+methods[#methods+1] = 'bytes'
+
+local function load_with(method)
+	-- The FFI library is given by init.lua, if available
+	mapgen_rivers.ffi = method == 'ffi' and ffi or nil
+	if method == 'bytes' then
+		string.unpack = nil
+	end
+	local load_map = dofile(modpath .. '/load.lua')
+	mapgen_rivers.ffi = nil
+	string.unpack = sunpack
+	return load_map
+end
+
+-- Every line of 'cases': file name, bytes, signed (1 or 0), size, file of expected values, and optionally 'offset' to convert values like offset_x and offset_y
+local cases = {}
+for line in io.lines(worldpath .. '/expected/cases') do
+	local filename, bytes, signed, size, expected, convert = line:match('^(%S+) (%d+) (%d) (%d+) (%S+) ?(%S*)$')
+	cases[#cases+1] = {filename = filename, bytes = tonumber(bytes), signed = signed == '1', size = tonumber(size), expected = expected, convert = convert == 'offset'}
+end
+
+local function offset_conv(v)
+	return (v+0.5)/256
+end
+
+local failures = 0
+for _, method in ipairs(methods) do
+	local load_map = load_with(method)
+	for _, case in ipairs(cases) do
+		local map = load_map(case.filename, case.bytes, case.signed, case.size, case.convert and offset_conv or nil)
+		local expected = read_numbers(case.expected)
+		for i=1, case.size do
+			local v = case.convert and offset_conv(expected[i]) or expected[i]
+			if map[i] ~= v then
+				print(('%s: %s[%d] is %s instead of %s'):format(method, case.filename, i, tostring(map[i]), tostring(v)))
+				failures = failures + 1
+				break
+			end
+		end
+	end
+	print(method .. ': ' .. #cases .. ' grids checked')
+end
+
+if failures > 0 then
+	error(failures .. ' grids were not read correctly (counted once per decoding method)')
+end
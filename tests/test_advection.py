@@ -0,0 +1,33 @@
+import numpy as np
+import pytest
+
+from terrainlib import noisemap
+from terrainlib.rivermapper import flow
+from terrainlib.erosion import advection, advection_vectorized
+
+def seeded_flow(seed, shape=(41, 53), flow_method='semirandom'):
+    rng = np.random.default_rng(seed)
+    xbase, ybase = rng.integers(-4096, 4096, size=2)
+    dem = noisemap(*shape, scale=20.0, vscale=100.0, offset=10.0, octaves=4, persistence=0.6, lacunarity=2.0, xbase=xbase, ybase=ybase)
+    dirs, lakes, rivers = flow(dem, method=flow_method, rng=rng)
+    return np.maximum(dem, lakes), dirs, rivers
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+@pytest.mark.parametrize('time', [0.1, 1.0, 10.0])
+def test_vectorized_matches_loop(seed, time):
+    dem, dirs, rivers = seeded_flow(seed)
+    expected = advection(dem, dirs, rivers, time, K=0.5, m=0.5, sea_level=0)
+    result = advection_vectorized(dem, dirs, rivers, time, K=0.5, m=0.5, sea_level=0)
+    assert np.allclose(result, expected, rtol=0, atol=1e-9)
+
+def test_vectorized_steepest_sea_level():
+    dem, dirs, rivers = seeded_flow(3, flow_method='steepest')
+    expected = advection(dem, dirs, rivers, 2.0, K=1.0, m=0.4, sea_level=5.0)
+    result = advection_vectorized(dem, dirs, rivers, 2.0, K=1.0, m=0.4, sea_level=5.0)
+    assert np.allclose(result, expected, rtol=0, atol=1e-9)
+
+def test_vectorized_workers():
+    dem, dirs, rivers = seeded_flow(4)
+    expected = advection(dem, dirs, rivers, 1.0, K=0.5, m=0.5, sea_level=0)
+    result = advection_vectorized(dem, dirs, rivers, 1.0, K=0.5, m=0.5, sea_level=0, workers=2)
+    assert np.allclose(result, expected, rtol=0, atol=1e-9)
@@ -0,0 +1,15 @@
+import numpy as np
+
+from terrainlib.rivermapper import flow
+from terrainlib.bounds import make_bounds
+
+def test_unsigned_rivers():
+    # Compact and out-of-core modes store discharge as uint32: bounds must be the same as with signed discharge
+    rng = np.random.default_rng(0)
+    dem = rng.random((30, 40)) * 100
+    dirs, lakes, rivers = flow(dem, rng=rng)
+    bh, bv = make_bounds(dirs, rivers)
+    bh32, bv32 = make_bounds(dirs.astype(np.uint8), rivers.astype(np.uint32))
+    assert bv.min() < 0 and bh.min() < 0
+    assert np.array_equal(bh32, bh)
+    assert np.array_equal(bv32, bv)
@@ -0,0 +1,98 @@
+import numpy as np
+import importlib
+import os
+import shutil
+import zlib
+import pytest
+
+from terrainlib.heightmap import Heightmaps
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+demo_data = os.path.join(root, 'demo_data')
+
+default_settings = dict(blocksize=12, sea_level=1, min_catchment=25, max_catchment=40000, riverbed_slope=0.4, center=False, glaciers=False, glacier_factor=8)
+other_settings = dict(blocksize=7, sea_level=3, min_catchment=10, max_catchment=4000, riverbed_slope=1.0, center=True, glaciers=False, glacier_factor=8)
+
+# Rectangles (minp, maxp) of 80x80 nodes: outside the grid, around the origin (a corner of the grid if it is not centered), and 2 inside the grid with rivers and lakes
+chunks = [((-3000, -3000), (-2921, -2921)), ((-40, -40), (39, 39)), ((160, 320), (239, 399)), ((800, 1280), (879, 1359))]
+
+def checksum(terrain, lake):
+    return zlib.crc32(terrain.astype('<i4').tobytes()), zlib.crc32(lake.astype('<i4').tobytes())
+
+# Checksums of (terrain, lake) of the demo grid for every chunk, checked against the Lua code of the mod (see test_same_as_lua)
+pinned = {
+    'default': [(2463680318, 2463680318), (4293798762, 4293798762), (1986653692, 1687390262), (4240065090, 2203587746)],
+    'other': [(2463680318, 2463680318), (1731527027, 3693170671), (1295345766, 4153739265), (2651841745, 1185226108)],
+}
+
+@pytest.mark.parametrize('name, settings', [('default', default_settings), ('other', other_settings)])
+def test_pinned(name, settings):
+    hm = Heightmaps.from_dir(demo_data, **settings)
+    results = [hm.heightmaps(minp, maxp) for minp, maxp in chunks]
+    assert (results[0][0] == -31000).all()
+    assert all((terrain < lake).any() for terrain, lake in results[2:])
+    assert [checksum(*r) for r in results] == pinned[name]
+
+@pytest.mark.parametrize('tile_size, workers', [(100, 1), (37, 1), (64, 2)])
+def test_render(tile_size, workers):
+    # Rendering by tiles, in parallel or not, gives the same heightmaps as in one piece
+    hm = Heightmaps.from_dir(demo_data, **default_settings)
+    minp, maxp = (-30, 150), (229, 349)
+    expected = hm.heightmaps(minp, maxp)
+    terrain, lake = hm.render(minp, maxp, tile_size=tile_size, workers=workers)
+    assert np.array_equal(terrain, expected[0])
+    assert np.array_equal(lake, expected[1])
+
+def heat(x, z):
+    return 20*np.sin(x/150.0) + 10*np.cos(z/97.0) - 5
+
+def lua_runtime():
+    # Lua in Python, with the Lua versions of Minetest: LuaJIT or Lua 5.1
+    for name in ('luajit21', 'luajit20', 'lua51'):
+        try:
+            return importlib.import_module('lupa.' + name).LuaRuntime(encoding=None)
+        except ImportError:
+            pass
+    pytest.skip('lupa with LuaJIT or Lua 5.1 is not installed')
+
+def lua_heightmaps(world, settings):
+    # Load heightmap.lua of the mod, with the grid in world/river_data, and return a function giving heightmaps as arrays
+    lua = lua_runtime()
+    g = lua.globals()
+    mt = lua.eval('{}')
+    mt[b'get_worldpath'] = lambda: world.encode()
+    mt[b'get_modpath'] = lambda name: root.encode()
+    mt[b'get_current_modname'] = lambda: b'mapgen_rivers'
+    mt[b'mkdir'] = lambda path: None
+    mt[b'register_on_shutdown'] = lambda func: None
+    mt[b'log'] = lambda level, msg: None
+    mt[b'decompress'] = lambda data: zlib.decompress(bytes(data))
+    mt[b'get_perlin'] = lambda params: lua.table_from({b'get2d': lambda self, pos: float(heat(pos[b'x'], pos[b'y']))})
+    g[b'minetest'] = mt
+    lua.execute(b'mapgen_rivers = {tile_cache_size=16, polygon_cache_size=4096, elevation_chill=0.25, noise_params={}}')
+    mr = g[b'mapgen_rivers']
+    for key, value in settings.items():
+        mr[key.encode()] = value
+    mr[b'riverbed_slope'] = settings['riverbed_slope'] * settings['blocksize']
+    heightmaps = lua.execute(open(os.path.join(root, 'heightmap.lua'), 'rb').read())
+
+    def run(minp, maxp):
+        terrain, lake = heightmaps(lua.table_from({b'x': minp[0], b'z': minp[1]}), lua.table_from({b'x': maxp[0], b'z': maxp[1]}))
+        shape = (maxp[1]-minp[1]+1, maxp[0]-minp[0]+1)
+        n = shape[0] * shape[1]
+        return np.array([terrain[i] for i in range(1, n+1)]).reshape(shape), np.array([lake[i] for i in range(1, n+1)]).reshape(shape)
+    return run
+
+@pytest.mark.parametrize('settings', [default_settings, other_settings, dict(other_settings, glaciers=True)])
+def test_same_as_lua(tmp_path, settings):
+    # Runs only if lupa is installed
+    world = str(tmp_path)
+    shutil.copytree(demo_data, os.path.join(world, 'river_data'))
+    run = lua_heightmaps(world, settings)
+    temperature = (lambda x, y, z: heat(x, z) - y*0.25) if settings['glaciers'] else None
+    hm = Heightmaps.from_dir(demo_data, temperature=temperature, **settings)
+    for minp, maxp in chunks:
+        terrain, lake = run(minp, maxp)
+        expected = hm.heightmaps(minp, maxp)
+        assert np.array_equal(terrain, expected[0])
+        assert np.array_equal(lake, expected[1])
@@ -0,0 +1,63 @@
+import numpy as np
+import pytest
+
+from terrainlib import noisemap, EvolutionModel
+from terrainlib.rivermapper import flow, IncrementalFlow
+
+def seeded_dem(seed, size=120):
+    rng = np.random.default_rng(seed)
+    xbase, ybase = rng.integers(-4096, 4096, size=2)
+    return noisemap(size, size, scale=30.0, vscale=300.0, octaves=6, persistence=0.6, lacunarity=2.0, xbase=xbase, ybase=ybase)
+
+def assert_same_flow(a, b):
+    for x, y in zip(a[:3], b[:3]):
+        assert x.dtype == y.dtype
+        assert np.array_equal(x, y)
+    for x, y in zip(a[3], b[3]):
+        assert np.array_equal(x, y)
+
+def local_edits(dem, rng):
+    # Lower a few small patches
+    dem = dem.copy()
+    for i in range(3):
+        x0, y0 = rng.integers(0, dem.shape[0]-10, size=2)
+        dem[x0:x0+8, y0:y0+8] -= (rng.random((8, 8)) * 20).astype(dem.dtype)
+    return dem
+
+@pytest.mark.parametrize('method', ['steepest', 'semirandom'])
+@pytest.mark.parametrize('compact', [False, True])
+def test_same_as_full(method, compact):
+    dem = seeded_dem(0)
+    if compact:
+        dem = dem.astype(np.float32)
+    incremental = IncrementalFlow(max_change=1.0) # Never fall back
+    rng_full, rng_inc, rng_edit = (np.random.default_rng(1) for i in range(3))
+    for i in range(5):
+        expected = flow(dem, method=method, return_tree=True, rng=rng_full, compact=compact)
+        result = incremental.flow(dem, method=method, return_tree=True, rng=rng_inc, compact=compact)
+        assert_same_flow(expected, result)
+        dem = local_edits(dem, rng_edit)
+    assert incremental.counts['incremental'] > 0
+
+def test_fallback():
+    incremental = IncrementalFlow(max_change=0.01)
+    for seed in range(3):
+        dem = seeded_dem(seed) # Completely different at every call
+        assert_same_flow(flow(dem, method='steepest', return_tree=True), incremental.flow(dem, method='steepest', return_tree=True))
+    assert incremental.counts['incremental'] == 0
+
+@pytest.mark.parametrize('method', ['steepest', 'semirandom'])
+def test_model(method):
+    # Whole simulation: elevations change everywhere at every iteration
+    results = []
+    for incremental in (False, True):
+        model = EvolutionModel(seeded_dem(2), K=0.5, d=0.5, flex_radius=10, flow_method=method, rng=np.random.default_rng(3), incremental_flow=incremental, max_flow_change=1.0)
+        for i in range(3):
+            model.diffusion(1)
+            model.calculate_flow()
+            model.advection(1)
+            model.adjust_isostasy()
+        model.calculate_flow()
+        results.append((model.dem, model.lakes, model.dirs, model.rivers))
+    for x, y in zip(*results):
+        assert np.array_equal(x, y)
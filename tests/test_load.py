@@ -0,0 +1,96 @@
+import numpy as np
+import importlib
+import os
+import shutil
+import subprocess
+import sys
+import zlib
+import pytest
+
+import terrainlib
+from terrainlib.tiled import load_grid
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+harness = os.path.join(root, 'tests', 'load_test.lua')
+
+# Types of the grids read by the mod
+dtypes = ('>i2', 'i1', 'u1', '>u4')
+shape = (37, 45)
+
+@pytest.fixture
+def world(tmp_path):
+    """
+    World directory with grids of every type in river_data, saved by terrainlib.save in flat format (raw and compressed) and in tiled format,
+    and their expected values in 'expected', listed in expected/cases.
+    """
+    rng = np.random.default_rng(0)
+    data_dir = tmp_path / 'river_data'
+    expected_dir = tmp_path / 'expected'
+    data_dir.mkdir()
+    expected_dir.mkdir()
+    cases = []
+    grids = {}
+    for dtype in dtypes:
+        dtype = np.dtype(dtype)
+        info = np.iinfo(dtype)
+        values = rng.integers(info.min, info.max, size=shape, endpoint=True, dtype=np.int64)
+        values.flat[:4] = info.min, info.max, 0, -1 if info.min < 0 else 1
+        # Few distinct values: zlib compresses them
+        few = rng.choice(values.flat[:4], size=shape)
+
+        name = 'i{:d}'.format(dtype.itemsize) if info.min < 0 else 'u{:d}'.format(dtype.itemsize)
+        for kind, array, options in (('flat', values, {}), ('compressed', few, {}), ('tiled', values, {'tile_size': 16})):
+            fname = '{}_{}'.format(name, kind)
+            terrainlib.save(array, str(data_dir / fname), dtype=dtype, **options)
+            np.savetxt(expected_dir / fname, array.ravel(), fmt='%d')
+            cases.append('{} {:d} {:d} {:d} {}'.format(fname, dtype.itemsize, info.min < 0, array.size, fname))
+            grids[fname] = (array, dtype)
+    # Conversion of offsets, as done by polygons.lua
+    cases.append('i1_tiled 1 1 {:d} i1_tiled offset'.format(grids['i1_tiled'][0].size))
+
+    with open(expected_dir / 'cases', 'w') as f:
+        f.write('\n'.join(cases) + '\n')
+    return tmp_path, grids
+
+def test_python(world):
+    path, grids = world
+    for fname, (array, dtype) in grids.items():
+        assert np.array_equal(load_grid(str(path / 'river_data' / fname), dtype, shape), array)
+    # Random values are saved raw, few distinct values compressed
+    assert os.path.getsize(path / 'river_data' / 'i2_flat') == 2 * shape[0] * shape[1]
+    assert os.path.getsize(path / 'river_data' / 'i2_compressed') < 2 * shape[0] * shape[1]
+
+@pytest.mark.parametrize('lua', ['luajit', 'lua5.1', 'lua5.3', 'lua5.4', 'lua'])
+def test_lua(world, lua):
+    # Runs the harness with every Lua interpreter found
+    lua = shutil.which(lua)
+    if lua is None:
+        pytest.skip('Lua interpreter not found')
+    path, grids = world
+    result = subprocess.run([lua, harness, root, str(path), sys.executable], capture_output=True, text=True)
+    assert result.returncode == 0, result.stdout + result.stderr
+
+@pytest.mark.parametrize('runtime, methods', [('luajit21', ['ffi', 'bytes']), ('lua54', ['unpack', 'bytes']), ('lua51', ['bytes'])])
+def test_lupa(world, runtime, methods):
+    # Same with Lua in Python, if lupa is installed
+    try:
+        lupa = importlib.import_module('lupa.' + runtime)
+    except ImportError:
+        pytest.skip('lupa.{} is not installed'.format(runtime))
+    path, grids = world
+    lua = lupa.LuaRuntime(encoding=None)
+    g = lua.globals()
+    mt = lua.eval('{}')
+    mt[b'get_modpath'] = lambda name: root.encode()
+    mt[b'get_current_modname'] = lambda: b'mapgen_rivers'
+    mt[b'get_worldpath'] = lambda: str(path).encode()
+    mt[b'decompress'] = lambda data: zlib.decompress(bytes(data))
+    # Only works from the main scope of init.lua: load.lua must not call it
+    mt[b'request_insecure_environment'] = lambda: pytest.fail('request_insecure_environment called outside of init.lua')
+    g[b'minetest'] = mt
+    lua.execute(b'mapgen_rivers = {tile_cache_size=2}') # Smaller than a row of tiles: tiles are evicted and loaded again
+    g[b'arg'] = lua.table_from([root.encode(), str(path).encode()])
+    output = []
+    g[b'print'] = lambda line: output.append(line.decode())
+    lua.execute(open(harness, 'rb').read())
+    assert output == ['{}: 13 grids checked'.format(method) for method in methods]
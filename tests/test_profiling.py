@@ -0,0 +1,20 @@
+import pytest
+
+from terrainlib import noisemap
+from terrainlib.profiling import profiler, stage
+
+@pytest.fixture
+def enabled_profiler():
+    profiler.enable()
+    yield profiler
+    profiler.enabled = False
+    profiler.records.clear()
+
+def test_worker_cpu(enabled_profiler):
+    # CPU time of the worker processes is counted in the stage and its parents, although the pool is still running
+    with stage('outer'):
+        with stage('noise'):
+            noisemap(501, 501, scale=100.0, octaves=8, workers=2)
+    records = {r['stage']: r for r in enabled_profiler.records}
+    for name in ('outer/noise', 'outer'):
+        assert records[name]['cpu'] > 0.5 * records[name]['wall']
@@ -0,0 +1,5 @@
+from terrainlib.settings import parse_command_line
+
+def test_parse_command_line():
+    args = parse_command_line(['script.py', 'my.conf', '--K', '0.5,1', '--offset=-5', '--compact', '--sea_level', '-2', 'out', 'extra', '--heightmaps'])
+    assert args == {'config': 'my.conf', 'output': 'out', 'K': '0.5,1', 'offset': '-5', 'compact': '', 'sea_level': '-2', 'heightmaps': ''}